@@ -0,0 +1,3 @@
+"""
+Benchmark harness: synthetic data generator (synthetic.py) and stage timings (run.py).
+"""
@@ -0,0 +1,122 @@
+"""
+Load test of the Foursquare fetch paths against the local stub server (benchmarks/stub_server.py).
+
+    python -m benchmarks.fetch_load --queries 200 --workers 1 4 8 16 --rate 50 --latency 80 --throttle-rate 0.05
+    python -m benchmarks.fetch_load --mode crawl --synthetic 3000 --workers 4 --output benchmarks/results/crawl.json
+
+For every worker count it starts a fresh stub, runs api.fetch_many over --queries queries
+(or crawl.crawl over a bounding box) with the venue cache off, and reports throughput, the
+client-side HTTP latency quantiles, retries, backoff time and the responses the stub sent.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+from src import api
+from src import crawl
+from src import grid
+from src import metrics
+from src import scoring
+from . import stub_server
+
+
+def query_names(count):
+    """
+    count distinct queries: the real categories first (served from data/), then numbered
+    synthetic ones.
+    """
+    base = list(scoring.VENUE_QUERIES.values())
+    return [query if position < len(base) else f'{query} {position // len(base)}'
+            for position, query in ((position, base[position % len(base)]) for position in range(count))]
+
+
+def run_fetch(args, workers):
+    queries = query_names(args.queries)
+    results = api.fetch_many(queries, ll=(args.lat, args.lng), limit=args.limit, token='stub', radius=args.radius,
+                             max_workers=workers, rate=args.rate, use_cache=False)
+    return {'queries': len(queries), 'empty': sum(1 for venues in results.values() if not venues)}
+
+
+def run_crawl(args, workers):
+    with tempfile.TemporaryDirectory() as directory:
+        state = crawl.crawl(args.crawl_query, args.bbox, token='stub', path=os.path.join(directory, 'crawl.json'),
+                            max_workers=workers, rate=args.rate)
+    return {'venues': len(state['venues']), 'tiles': state['tiles'], 'complete': state['complete']}
+
+
+def load_test(args, workers):
+    server, base_url = stub_server.start(state=stub_server.build_state(args))
+    previous = os.environ.get('FOURSQUARE_API_URL')
+    os.environ['FOURSQUARE_API_URL'] = base_url
+    metrics.reset()
+    try:
+        start = time.perf_counter()
+        outcome = (run_crawl if args.mode == 'crawl' else run_fetch)(args, workers)
+        seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+        if previous is None:
+            os.environ.pop('FOURSQUARE_API_URL', None)
+        else:
+            os.environ['FOURSQUARE_API_URL'] = previous
+
+    data = metrics.report()
+    timers = data['timers']
+    stats = server.state.snapshot()
+    latency = timers.get('api.http', {}).get('quantiles', {})
+    entry = {
+        'mode': args.mode,
+        'workers': workers,
+        'seconds': seconds,
+        'requests': stats['requests'],
+        'requests_per_second': stats['requests'] / seconds if seconds else 0.0,
+        'latency': latency,
+        'retries': data['counters'].get('api.retries', 0),
+        'errors': data['counters'].get('api.errors', 0),
+        'retry_sleep_seconds': timers.get('sleep.retry', {}).get('seconds', 0.0),
+        'rate_limit_sleep_seconds': timers.get('sleep.rate_limit', {}).get('seconds', 0.0),
+        'status': stats['status'],
+        **outcome
+    }
+    print(f"{workers:>7} {seconds:9.2f} {entry['requests']:>8} {entry['requests_per_second']:9.1f} "
+          f"{latency.get('p50', 0) * 1000:8.1f} {latency.get('p95', 0) * 1000:8.1f} {latency.get('p99', 0) * 1000:8.1f} "
+          f"{entry['retries']:>7} {entry['errors']:>6} {entry['retry_sleep_seconds']:8.2f}  {json.dumps(stats['status'])}")
+    return entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the Foursquare fetch paths against the local stub")
+    parser.add_argument('--mode', choices=('fetch', 'crawl'), default='fetch')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--queries', type=int, default=100, help="Queries fetched by --mode fetch")
+    parser.add_argument('--limit', type=int, default=50, help="Results per query")
+    parser.add_argument('--lat', type=float, default=37.7749)
+    parser.add_argument('--lng', type=float, default=-122.4194)
+    parser.add_argument('--radius', type=int, default=None)
+    parser.add_argument('--crawl-query', default='bar', help="Query crawled by --mode crawl")
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'),
+                        default=grid.SAN_FRANCISCO_BBOX)
+    parser.add_argument('--rate', type=float, default=50, help="Client-side requests per second (token bucket)")
+    parser.add_argument('--output', default=None, help="Write the results as JSON")
+    stub_server.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    print(f"{'workers':>7} {'seconds':>9} {'requests':>8} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'retries':>7} {'errors':>6} {'backoff':>8}  responses")
+    results = [load_test(args, workers) for workers in args.workers]
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump({'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'arguments': vars(args)},
+                       'results': results}, file, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
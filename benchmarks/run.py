@@ -0,0 +1,227 @@
+"""
+Benchmarks for the pipeline stages against a local mongod, on synthetic data.
+
+    python -m benchmarks.run --companies 1000 10000 --venues 100 1000 --output benchmarks/results/latest.json
+    python -m benchmarks.run --compare benchmarks/results/previous.json
+
+Every stage runs on its own database (BENCH_DATABASE), which is dropped at the end. Results
+are written as JSON so two runs can be compared for regressions.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+from src import api
+from src import mongo
+from src import pipeline
+from src import scoring
+from . import synthetic
+
+
+BENCH_DATABASE = 'OfficeLocatorBench'
+REGRESSION_THRESHOLD = 1.2  # flag stages more than 20% slower than the baseline
+
+
+def timed(function, repeat):
+    """
+    Run function `repeat` times and return (times in seconds, last result).
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def record(results, name, size, times, **extra):
+    entry = {
+        'name': name,
+        'size': size,
+        'repeat': len(times),
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        **extra
+    }
+    results.append(entry)
+    print(f"{name:<45} {str(size):<22} median {entry['median'] * 1000:10.2f} ms")
+    return entry
+
+
+def load_companies(db, count, seed=0, batch_size=10000):
+    collection = db[pipeline.COMPANIES]
+    collection.drop()
+    batch = []
+    for document in synthetic.companies(count, seed):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+    return collection
+
+
+def venue_frames(count, seed=0):
+    return {
+        venue_type: api.venues_to_dataframe(synthetic.venues(query, count, seed=seed), query)
+        for venue_type, query in scoring.VENUE_QUERIES.items()
+    }
+
+
+def bench_companies(db, count, repeat, results):
+    collection = load_companies(db, count)
+    condition1, condition2 = pipeline.CONDITIONS['games_video']
+
+    times, counts = timed(lambda: mongo.count_offices_by_condition(collection, condition1, condition2), repeat)
+    record(results, 'count_offices_by_condition', {'companies': count}, times, rows=len(counts))
+
+    times, counts = timed(lambda: mongo.count_offices_by_condition_agg(collection, condition1, condition2), repeat)
+    record(results, 'count_offices_by_condition_agg', {'companies': count}, times, rows=len(counts))
+
+    times, _ = timed(lambda: mongo.count_offices_by_conditions(collection, pipeline.CONDITIONS), repeat)
+    record(results, 'count_offices_by_conditions (facet)', {'companies': count}, times)
+
+    for name, finder in (('gaming_startup_finder', mongo.gaming_startup_finder),
+                         ('design_web_startup_finder', mongo.design_web_startup_finder)):
+        times, df = timed(lambda: finder(collection, pipeline.CITY), repeat)
+        record(results, name, {'companies': count}, times, rows=len(df))
+
+    times, df = timed(lambda: mongo.find_offices_by_criteria(collection, pipeline.CITY, 10, 500), repeat)
+    record(results, 'find_offices_by_criteria', {'companies': count}, times, rows=len(df))
+
+    times, _ = timed(lambda: mongo.insert_offices_data_create_index(pipeline.CITY, 10, 500, pipeline.OFFICES_COLLECTION,
+                                                                    db, collection), repeat)
+    record(results, 'insert_offices_data_create_index', {'companies': count}, times,
+           offices=db[pipeline.OFFICES_COLLECTION].count_documents({}))
+
+
+def bench_venues(db, count, repeat, results, with_sleeps):
+    venues_by_type = venue_frames(count)
+    size = {'venues_per_category': count, 'offices': db[pipeline.OFFICES_COLLECTION].count_documents({})}
+
+    if with_sleeps:
+        # converting_to_collection sleeps 2 s per category, so it only runs once
+        times, _ = timed(lambda: mongo.converting_to_collection(db, venues_by_type), 1)
+        record(results, 'converting_to_collection', size, times)
+    else:
+        print(f"{'converting_to_collection':<45} skipped (sleeps 22 s per run, use --with-sleeps)")
+
+    db[mongo.VENUES_COLLECTION].drop()
+    times, _ = timed(lambda: mongo.sync_venues(db, venues_by_type), 1)
+    record(results, 'sync_venues (initial load)', size, times)
+    times, summary = timed(lambda: mongo.sync_venues(db, venues_by_type), repeat)
+    record(results, 'sync_venues (unchanged)', size, times, **summary)
+
+    if not with_sleeps:
+        # The per-type collections are still needed for the $near scorer
+        for venue_type, df in venues_by_type.items():
+            db[venue_type].drop()
+            records = [{**row, 'location': {'type': 'Point', 'coordinates': [row['Lng'], row['Lat']]}}
+                       for row in df.to_dict(orient='records')]
+            if records:
+                db[venue_type].insert_many(records)
+            db[venue_type].create_index([('location', '2dsphere')])
+
+    times, scores = timed(lambda: mongo.best_office_location(database=db.name), repeat)
+    record(results, 'best_office_location ($near)', size, times, offices=len(scores))
+
+    times, scores = timed(lambda: mongo.best_office_location(batch=True, database=db.name), repeat)
+    record(results, 'best_office_location (batch)', size, times, offices=len(scores))
+
+    times, scores = timed(lambda: mongo.best_office_location(venues_collection=mongo.VENUES_COLLECTION, database=db.name), repeat)
+    record(results, 'best_office_location ($near, venues)', size, times, offices=len(scores))
+
+    if scores:
+        with tempfile.TemporaryDirectory() as directory:
+            map_file = os.path.join(directory, 'map.html')
+            times, _ = timed(lambda: mongo.final_location(scores, venues_by_type, map_file=map_file, open_browser=False), repeat)
+            record(results, 'final_location', size, times, html_bytes=os.path.getsize(map_file))
+            times, _ = timed(lambda: mongo.final_location(scores, venues_by_type, map_file=map_file, open_browser=False,
+                                                          fast=True), repeat)
+            record(results, 'final_location (fast)', size, times, html_bytes=os.path.getsize(map_file))
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(current, baseline_path, threshold=REGRESSION_THRESHOLD):
+    """
+    Print the median ratio of every benchmark against a previous run and return the
+    regressions (ratio above threshold).
+    """
+    with open(baseline_path, 'r') as file:
+        baseline = json.load(file)
+
+    previous = {(entry['name'], json.dumps(entry['size'], sort_keys=True)): entry for entry in baseline['results']}
+    regressions = []
+    for entry in current['results']:
+        before = previous.get((entry['name'], json.dumps(entry['size'], sort_keys=True)))
+        if before is None or not before['median']:
+            continue
+        ratio = entry['median'] / before['median']
+        flag = 'REGRESSION' if ratio > threshold else ''
+        print(f"{entry['name']:<45} {str(entry['size']):<22} x{ratio:6.2f} {flag}")
+        if flag:
+            regressions.append({'name': entry['name'], 'size': entry['size'], 'ratio': ratio})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Office Locator stages on synthetic data")
+    parser.add_argument('--companies', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--venues', type=int, nargs='+', default=[100, 1000], help="Venues per category")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--with-sleeps', action='store_true', help="Also time converting_to_collection")
+    parser.add_argument('--output', default='benchmarks/results/latest.json')
+    parser.add_argument('--compare', default=None, help="Previous results file to check for regressions")
+    args = parser.parse_args(argv)
+
+    db = mongo.get_database(BENCH_DATABASE)
+    results = []
+    try:
+        for count in args.companies:
+            bench_companies(db, count, args.repeat, results)
+            for venue_count in args.venues:
+                bench_venues(db, venue_count, args.repeat, results, args.with_sleeps)
+    finally:
+        mongo.get_client().drop_database(BENCH_DATABASE)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'companies': args.companies,
+            'venues': args.venues,
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        return 1 if compare(report, args.compare) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Latency test of the scoring service (src/service.py) on synthetic offices and venues.
+
+    python -m benchmarks.service_load --offices 2000 --venues 300 --requests 5000 --clients 1 4
+    python -m benchmarks.service_load --rank 500 --output benchmarks/results/service.json
+
+The service runs in its own process (one event loop, one core); every client is a thread
+with its own keep-alive connection sending GET /score for random points around the city
+(or POST /rank with --rank candidates). Reports the client-side latency quantiles and the
+throughput for each client count.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import http.client
+import multiprocessing
+
+from src import scoring
+from src import service
+from . import synthetic
+from .run import venue_frames
+
+
+CENTER = synthetic.CITIES['San Francisco'][0]
+
+
+class SyntheticSource:
+    """
+    Data source for the service: random offices and synthetic venues of every category.
+    """
+
+    def __init__(self, offices, venues, seed=0):
+        self.offices = offices
+        self.venues = venues
+        self.seed = seed
+
+    def version(self):
+        return [self.offices, self.venues, self.seed]
+
+    def load(self):
+        rng = random.Random(self.seed)
+        office_points = [synthetic.jitter(rng, CENTER, 4000) for _ in range(self.offices)]
+        return ([f'Office {position}' for position in range(self.offices)],
+                [[lng, lat] for lat, lng in office_points],
+                scoring.venue_arrays(venue_frames(self.venues, self.seed)))
+
+
+def run_service(source, port, ready):
+    async def main():
+        service_ = service.ScoringService(source, reload_interval=0)
+        server = await service_.start(service.HOST, port)
+        ready.set()
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def client(port, bodies, latencies, errors):
+    connection = http.client.HTTPConnection(service.HOST, port)
+    for method, path, body in bodies:
+        start = time.perf_counter()
+        connection.request(method, path, body=body, headers={'Content-Type': 'application/json'} if body else {})
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors.append(response.status)
+    connection.close()
+
+
+def requests_for(args, count, seed):
+    rng = random.Random(seed)
+    result = []
+    for _ in range(count):
+        if args.rank:
+            candidates = [list(synthetic.jitter(rng, CENTER, 4000)) for _ in range(args.rank)]
+            result.append(('POST', '/rank', json.dumps({'candidates': candidates, 'top': 10})))
+        else:
+            lat, lng = synthetic.jitter(rng, CENTER, 4000)
+            result.append(('GET', f'/score?lat={lat:.6f}&lng={lng:.6f}', None))
+    return result
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def load_test(args, port, clients):
+    # Warm up the connection path and the index before measuring
+    client(port, requests_for(args, 50, -1), [], [])
+
+    per_client = args.requests // clients
+    plans = [requests_for(args, per_client, seed) for seed in range(clients)]
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client, args=(port, plan, latencies, errors)) for plan in plans]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    entry = {
+        'clients': clients,
+        'requests': len(latencies),
+        'seconds': seconds,
+        'requests_per_second': len(latencies) / seconds if seconds else 0.0,
+        'latency': {name: quantile(latencies, q) for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+        'max': max(latencies),
+        'errors': len(errors)
+    }
+    latency = entry['latency']
+    print(f"{clients:>7} {entry['requests']:>8} {entry['requests_per_second']:9.1f} {latency['p50'] * 1000:8.2f} "
+          f"{latency['p95'] * 1000:8.2f} {latency['p99'] * 1000:8.2f} {entry['max'] * 1000:8.2f} {entry['errors']:>6}")
+    return entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency test of the scoring service")
+    parser.add_argument('--offices', type=int, default=2000)
+    parser.add_argument('--venues', type=int, default=300, help="Synthetic venues per category")
+    parser.add_argument('--requests', type=int, default=5000, help="Requests per client count")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--rank', type=int, default=0, help="Send POST /rank with this many candidates instead of /score")
+    parser.add_argument('--port', type=int, default=8181)
+    parser.add_argument('--output', default=None, help="Write the results as JSON")
+    args = parser.parse_args(argv)
+
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=run_service, args=(SyntheticSource(args.offices, args.venues), args.port,
+                                                                ready), daemon=True)
+    process.start()
+    try:
+        if not ready.wait(120):
+            print("The service did not start")
+            return 1
+        print(f"{'clients':>7} {'requests':>8} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+              f"{'errors':>6}")
+        results = [load_test(args, args.port, clients) for clients in args.clients]
+    finally:
+        process.terminate()
+        process.join()
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump({'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'arguments': vars(args)},
+                       'results': results}, file, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
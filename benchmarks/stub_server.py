@@ -0,0 +1,306 @@
+"""
+Local stand-in for the Foursquare place search API, for measuring the fetch paths offline.
+
+    python -m benchmarks.stub_server --port 8765 --latency 80 --error-rate 0.02 --throttle-rate 0.05
+    FOURSQUARE_API_URL=http://127.0.0.1:8765/v3 python -m src venues
+
+Serves GET {base}/places/search with the payloads of data/*.json (one file per query),
+optionally multiplied into jittered synthetic variants, and synthetic venues for queries
+without a file. Supports the ll/radius and sw/ne filters, limit and cursor pagination
+through the Link header, like the real API. Latency is lognormal around a median; requests
+over the server-side rate limit or picked by --throttle-rate get a 429 with Retry-After, and
+--error-rate of them a 5xx. GET /stats returns the request counters as JSON.
+"""
+import os
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlencode, urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import synthetic
+
+
+DATA_DIR = './data'
+PORT = 8765
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50  # largest page the real API returns
+ERROR_STATUS = (500, 502, 503)
+
+
+def load_payloads(directory=DATA_DIR):
+    """
+    The places of every data/{query}.json file, keyed by query.
+    """
+    payloads = {}
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.endswith('.json'):
+            with open(os.path.join(directory, file_name), 'r') as file:
+                payloads[file_name[:-len('.json')]] = json.load(file)
+    return payloads
+
+
+def variants(places, copies, spread_meters=500, seed=0):
+    """
+    The places followed by copies - 1 jittered copies of each (new fsq_id, coordinates moved
+    by spread_meters on average), so the real payloads can be scaled to any size.
+    """
+    rng = random.Random(seed)
+    result = list(places)
+    for copy in range(1, copies):
+        for place in places:
+            main = place.get('geocodes', {}).get('main', {})
+            if main.get('latitude') is None or main.get('longitude') is None:
+                continue
+            latitude, longitude = synthetic.jitter(rng, (main['latitude'], main['longitude']), spread_meters)
+            variant = json.loads(json.dumps(place))
+            variant['fsq_id'] = synthetic.object_id(rng)
+            variant['name'] = f"{place.get('name', 'Unknown Name')} #{copy}"
+            variant['geocodes'] = {key: {'latitude': latitude, 'longitude': longitude} for key in place['geocodes']}
+            result.append(variant)
+    return result
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+def parse_point(value):
+    latitude, longitude = value.split(',')
+    return float(latitude), float(longitude)
+
+
+class StubState:
+    """
+    Payloads, behaviour settings and counters shared by the handler threads.
+
+    Parameters:
+    - payloads: Dict mapping query to its list of places.
+    - synthetic_size: Venues generated for a query without payload (0: empty results).
+    - latency: Median response time in seconds; sigma is the lognormal spread (0: constant).
+    - rate: Requests per second served before answering 429 (0: unlimited).
+    - throttle_rate, error_rate: Fraction of requests answered 429 / 5xx at random.
+    - retry_after: Retry-After seconds sent with 429s.
+    """
+
+    def __init__(self, payloads=None, synthetic_size=0, latency=0.0, sigma=0.5, rate=0, throttle_rate=0.0,
+                 error_rate=0.0, retry_after=1, seed=0):
+        self.payloads = payloads or {}
+        self.synthetic_size = synthetic_size
+        self.latency = latency
+        self.sigma = sigma
+        self.rate = rate
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.stats = {'requests': 0, 'status': {}, 'results': 0, 'pages': 0}
+
+    def places(self, query):
+        with self.lock:
+            if query not in self.payloads:
+                self.payloads[query] = synthetic.venues(query, self.synthetic_size, seed=self.seed) \
+                    if self.synthetic_size else []
+            return self.payloads[query]
+
+    def delay(self):
+        if not self.latency:
+            return 0.0
+        with self.lock:
+            return self.latency * math.exp(self.rng.gauss(0, self.sigma)) if self.sigma else self.latency
+
+    def admit(self):
+        """
+        The status to answer with: 429 over the rate limit or for a throttled request, a 5xx
+        for an injected error, else 200.
+        """
+        with self.lock:
+            if self.rate:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens < 1:
+                    return 429
+                self.tokens -= 1
+            draw = self.rng.random()
+            if draw < self.throttle_rate:
+                return 429
+            if draw < self.throttle_rate + self.error_rate:
+                return self.rng.choice(ERROR_STATUS)
+            return 200
+
+    def record(self, status, results=0):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['status'][str(status)] = self.stats['status'].get(str(status), 0) + 1
+            if status == 200:
+                self.stats['pages'] += 1
+                self.stats['results'] += results
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+
+def search(places, params):
+    """
+    Apply the ll/radius and sw/ne filters of a place search to a list of places.
+    """
+    if 'sw' in params and 'ne' in params:
+        south, west = parse_point(params['sw'])
+        north, east = parse_point(params['ne'])
+    else:
+        south = west = north = east = None
+    center = parse_point(params['ll']) if 'll' in params else None
+    radius = float(params['radius']) if 'radius' in params and center else None
+
+    result = []
+    for place in places:
+        main = place.get('geocodes', {}).get('main', {})
+        latitude, longitude = main.get('latitude'), main.get('longitude')
+        if latitude is None or longitude is None:
+            continue
+        if south is not None and not (south <= latitude <= north and west <= longitude <= east):
+            continue
+        if radius is not None and haversine(center[0], center[1], latitude, longitude) > radius:
+            continue
+        result.append(place)
+    return result
+
+
+def make_handler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+        disable_nagle_algorithm = True  # headers and body go out as two writes
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path.rstrip('/') == '/stats':
+                self.send_json(200, state.snapshot())
+                return
+            if not url.path.rstrip('/').endswith('/places/search'):
+                self.send_json(404, {'message': 'Not Found'})
+                return
+
+            delay = state.delay()
+            if delay:
+                time.sleep(delay)
+
+            if not self.headers.get('Authorization'):
+                state.record(401)
+                self.send_json(401, {'message': 'Invalid request token.'})
+                return
+            status = state.admit()
+            if status == 429:
+                state.record(429)
+                self.send_json(429, {'message': 'Quota exceeded'}, {'Retry-After': str(state.retry_after)})
+                return
+            if status != 200:
+                state.record(status)
+                self.send_json(status, {'message': 'Internal Server Error'})
+                return
+
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                limit = min(int(params.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+                offset = int(params.get('cursor', 0))
+                matches = search(state.places(params.get('query', '')), params)
+            except ValueError as e:
+                state.record(400)
+                self.send_json(400, {'message': str(e)})
+                return
+
+            page = matches[offset:offset + limit]
+            headers = {}
+            if offset + limit < len(matches):
+                next_params = {**params, 'cursor': offset + limit}
+                next_url = f"http://{self.headers.get('Host')}{url.path}?{urlencode(next_params)}"
+                headers['Link'] = f'<{next_url}>; rel="next"'
+            state.record(200, len(page))
+            self.send_json(200, {'results': page, 'context': {}}, headers)
+
+    return StubHandler
+
+
+def start(host='127.0.0.1', port=0, state=None):
+    """
+    Serve the stub from a background thread.
+
+    Returns:
+    - A tuple (server, base_url): call server.shutdown() to stop it; base_url is the value
+      for FOURSQUARE_API_URL.
+    """
+    state = state or StubState()
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, name='foursquare-stub', daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}/v3'
+
+
+def build_state(args):
+    payloads = load_payloads(args.data) if args.data else {}
+    if args.variants > 1:
+        payloads = {query: variants(places, args.variants, seed=args.seed) for query, places in payloads.items()}
+    return StubState(payloads, args.synthetic, args.latency / 1000, args.sigma, args.server_rate, args.throttle_rate,
+                     args.error_rate, args.retry_after, args.seed)
+
+
+def add_arguments(parser):
+    parser.add_argument('--data', default=DATA_DIR, help="Directory of {query}.json payloads ('' for none)")
+    parser.add_argument('--variants', type=int, default=1, help="Copies of each payload venue (jittered)")
+    parser.add_argument('--synthetic', type=int, default=200,
+                        help="Synthetic venues served for queries without a payload file")
+    parser.add_argument('--latency', type=float, default=50, help="Median response time in ms")
+    parser.add_argument('--sigma', type=float, default=0.5, help="Lognormal spread of the latency")
+    parser.add_argument('--server-rate', type=float, default=0,
+                        help="Requests per second served before answering 429 (0: no limit)")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of requests answered 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered 5xx")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds of the 429s")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.stub_server', description="Foursquare API stub")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(build_state(args)))
+    server.daemon_threads = True
+    print(f"Serving the Foursquare stub on http://{args.host}:{server.server_address[1]}/v3 "
+          f"(set FOURSQUARE_API_URL to it)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
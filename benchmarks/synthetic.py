@@ -0,0 +1,171 @@
+import os
+import json
+import math
+import random
+
+
+# City centers the synthetic offices are spread around, with their relative weight
+CITIES = {
+    'San Francisco': ((37.7804301, -122.4103305), 0.25),
+    'New York': ((40.7127753, -74.0059728), 0.2),
+    'Seattle': ((47.6062095, -122.3320708), 0.1),
+    'Los Angeles': ((34.0522342, -118.2436849), 0.1),
+    'London': ((51.5072178, -0.1275862), 0.1),
+    'Austin': ((30.267153, -97.7430608), 0.05),
+    'Boston': ((42.3600825, -71.0588801), 0.05),
+    'Chicago': ((41.8781136, -87.6297982), 0.05),
+    'Palo Alto': ((37.4418834, -122.1430195), 0.05),
+    'Mountain View': ((37.3860517, -122.0838511), 0.05)
+}
+
+CATEGORY_CODES = ['games_video', 'web', 'design', 'software', 'mobile', 'advertising', 'enterprise', 'ecommerce']
+
+# Foursquare category ids/names used for the synthetic venues of each query
+VENUE_CATEGORIES = {
+    'school': (12058, 'Elementary School'),
+    'pet grooming': (11134, 'Pet Grooming Service'),
+    'basketball stadium': (18009, 'Basketball Stadium'),
+    'vegan restaurant': (13377, 'Vegan and Vegetarian Restaurant'),
+    'ferry': (19010, 'Ferry'),
+    'train station': (19047, 'Rail Station'),
+    'airport': (19040, 'Airport'),
+    'night club': (10032, 'Night Club'),
+    'bar': (13003, 'Bar'),
+    'starbucks': (13035, 'Coffee Shop'),
+    'design talks': (12000, 'Community and Government')
+}
+
+
+def jitter(rng, center, spread_meters):
+    """
+    A random point around center, normally distributed with the given spread.
+    """
+    lat, lng = center
+    dlat = rng.gauss(0, spread_meters) / 111320.0
+    dlng = rng.gauss(0, spread_meters) / (111320.0 * math.cos(math.radians(lat)))
+    return round(lat + dlat, 6), round(lng + dlng, 6)
+
+
+def object_id(rng):
+    return ''.join(rng.choice('0123456789abcdef') for _ in range(24))
+
+
+def company(rng, index):
+    """
+    One Companies document with the fields the pipeline reads (offices[], funding_rounds[],
+    category_code, number_of_employees).
+    """
+    names = list(CITIES)
+    weights = [weight for _, weight in CITIES.values()]
+
+    offices = []
+    for _ in range(rng.choices([0, 1, 2, 3], weights=[0.1, 0.6, 0.2, 0.1])[0]):
+        city = rng.choices(names, weights=weights)[0]
+        latitude, longitude = jitter(rng, CITIES[city][0], 4000)
+        offices.append({
+            'description': rng.choice(['HQ', 'Office', '']),
+            'address1': f'{rng.randint(1, 2000)} Market St',
+            'address2': '',
+            'zip_code': f'{rng.randint(10000, 99999)}',
+            'city': city,
+            'state_code': 'CA',
+            'country_code': 'USA',
+            # Some real documents lack coordinates
+            'latitude': latitude if rng.random() > 0.1 else None,
+            'longitude': longitude if rng.random() > 0.1 else None
+        })
+
+    funding_rounds = [
+        {
+            'id': rng.randint(1, 10 ** 6),
+            'round_code': rng.choice(['angel', 'seed', 'a', 'b', 'c']),
+            'raised_amount': rng.choice([None, round(rng.lognormvariate(14, 1.5), -3)]),
+            'raised_currency_code': 'USD',
+            'funded_year': rng.randint(1999, 2013)
+        }
+        for _ in range(rng.choices([0, 1, 2, 3, 4], weights=[0.3, 0.3, 0.2, 0.1, 0.1])[0])
+    ]
+
+    return {
+        'name': f'Company {index}',
+        'permalink': f'company-{index}',
+        'category_code': rng.choice(CATEGORY_CODES),
+        'number_of_employees': rng.choice([None, int(rng.lognormvariate(3.5, 1.2))]),
+        'founded_year': rng.randint(1990, 2013),
+        'offices': offices,
+        'funding_rounds': funding_rounds
+    }
+
+
+def companies(count, seed=0):
+    """
+    Yield `count` synthetic Companies documents (deterministic for a given seed).
+    """
+    rng = random.Random(seed)
+    for index in range(count):
+        yield company(rng, index)
+
+
+def venue(rng, query, center, spread_meters):
+    """
+    One Foursquare-shaped place, like the entries of the files in data/.
+    """
+    category_id, category_name = VENUE_CATEGORIES.get(query, (10000, query.title()))
+    latitude, longitude = jitter(rng, center, spread_meters)
+    return {
+        'fsq_id': object_id(rng),
+        'categories': [{
+            'id': category_id,
+            'name': category_name,
+            'short_name': category_name,
+            'plural_name': category_name + 's',
+            'icon': {'prefix': 'https://ss3.4sqi.net/img/categories_v2/building/default_', 'suffix': '.png'}
+        }],
+        'chains': [],
+        'closed_bucket': rng.choice(['VeryLikelyOpen', 'LikelyOpen', 'Unsure']),
+        'distance': int(abs(rng.gauss(0, spread_meters))),
+        'geocodes': {
+            'main': {'latitude': latitude, 'longitude': longitude},
+            'roof': {'latitude': latitude, 'longitude': longitude}
+        },
+        'link': '/v3/places/' + object_id(rng),
+        'location': {
+            'address': f'{rng.randint(1, 2000)} Mission St',
+            'census_block': f'{rng.randint(10 ** 14, 10 ** 15 - 1)}',
+            'country': 'US',
+            'cross_street': '',
+            'dma': 'San Francisco-Oakland-San Jose',
+            'formatted_address': 'San Francisco, CA',
+            'locality': 'San Francisco',
+            'postcode': f'{rng.randint(94000, 94199)}',
+            'region': 'CA'
+        },
+        'name': f'{category_name} {rng.randint(1, 10 ** 6)}',
+        'related_places': {},
+        'timezone': 'America/Los_Angeles'
+    }
+
+
+def venues(query, count, center=CITIES['San Francisco'][0], spread_meters=3000, seed=0):
+    """
+    A list of `count` synthetic Foursquare results for one query.
+    """
+    rng = random.Random(f'{seed}-{query}')
+    return [venue(rng, query, center, spread_meters) for _ in range(count)]
+
+
+def write_venue_files(directory, count, queries=VENUE_CATEGORIES, seed=0):
+    """
+    Write one {query}.json file per query, in the same format as the files in data/.
+
+    Returns:
+    - A dict mapping each query to its file path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for query in queries:
+        path = os.path.join(directory, f'{query}.json')
+        with open(path, 'w') as file:
+            json.dump(venues(query, count, seed=seed), file)
+        paths[query] = path
+    return paths
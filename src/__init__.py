@@ -0,0 +1,7 @@
+"""
+Office Locator: find the best office location from MongoDB company data and Foursquare venues.
+
+Importing the package is cheap; the heavy dependencies (pandas, numpy, folium, geopy, pymongo,
+requests) are only loaded when a pipeline stage needs them. Run the pipeline with
+`python -m src run` (see `python -m src --help`).
+"""
@@ -1,66 +1,87 @@
-from dotenv import load_dotenv
 import os
 import time
-import json
-import requests
-import pandas as pd
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import cache
+from . import metrics
+from .lazy import lazy_module
 
+requests = lazy_module('requests')
+requests_adapters = lazy_module('requests.adapters')
+pd = lazy_module('pandas')
 
-load_dotenv()
-token = os.getenv('token')
 
-CACHE_DIR = './data'
+def get_token():
+    """
+    Read the Foursquare API key from the 'token' variable in the environment or .env file.
+    """
+    from dotenv import load_dotenv
 
-def foursquare_places(venue, token, latitude=None, longitude=None, limit=5):
-    cache_file_path = os.path.join(CACHE_DIR, f'{venue}.json')
+    load_dotenv()
+    return os.getenv('token')
 
-    try:
-        with open(cache_file_path, 'r') as file:
-            return json.load(file)
-    except FileNotFoundError:
-        pass  
 
-    endpoint = f'https://api.foursquare.com/v3/places/search?query={venue}'
+def places_url():
+    """
+    The place search endpoint under the API base URL: FOURSQUARE_API_URL from the environment
+    or .env file (e.g. http://127.0.0.1:8765/v3 for benchmarks/stub_server.py), defaulting to
+    the public API.
+    """
+    from dotenv import load_dotenv
 
-    if latitude is not None and longitude is not None:
-        endpoint += f'&ll={latitude},{longitude}'
+    load_dotenv()
+    return os.getenv('FOURSQUARE_API_URL', API_URL).rstrip('/') + '/places/search'
 
-    endpoint += f'&limit={limit}'
 
-    headers = {
-        "accept": "application/json",
-        "Authorization": token
-    }
+venue_cache = cache.VenueCache()
 
-    try:
-        response = requests.get(endpoint, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        venues = data.get('results', [])
+API_URL = 'https://api.foursquare.com/v3'
+RATE_LIMIT = 10  # requests per second allowed by our Foursquare quota
+MAX_RETRIES = 4
+RETRY_STATUS = {429, 500, 502, 503, 504}
 
-        with open(cache_file_path, 'w') as file:
-            json.dump(venues, file)
+serial_client = {}  # session and rate limiter shared by the foursquare_places calls
+serial_lock = threading.Lock()
 
-        return venues
-    except requests.exceptions.RequestException as e:
-        print(f"Error: {e}")
+
+def foursquare_places(venue, token, latitude=None, longitude=None, limit=5, radius=None):
+    cached = venue_cache.get(venue, latitude, longitude, radius, limit)
+    if cached is not None:
+        return cached
+
+    params = {'query': venue}
+    if latitude is not None and longitude is not None:
+        params['ll'] = f'{latitude},{longitude}'
+    if radius is not None:
+        params['radius'] = radius
+    params['limit'] = limit
+
+    # Paced by the RATE_LIMIT token bucket (with retries on 429/5xx) instead of a fixed sleep
+    # after every call, so cache hits and errors no longer wait
+    with serial_lock:
+        if not serial_client:
+            serial_client.update(session=create_session(pool_size=1), limiter=TokenBucket(RATE_LIMIT))
+    venues, _ = request_places(serial_client['session'], serial_client['limiter'], params, token)
+    if venues is None:
         return []
-    finally:
-        time.sleep(2)
-        
 
-def get_venues_dataframe(venue, token, latitude=None, longitude=None, limit=5):
-    cache_file_path = os.path.join(CACHE_DIR, f'{venue}.json')
+    venue_cache.set(venue, venues, latitude, longitude, radius, limit)
+    return venues
 
-    try:
-        with open(cache_file_path, 'r') as file:
-            venues = json.load(file)
-    except FileNotFoundError:
-        venues = foursquare_places(venue, token, latitude=latitude, longitude=longitude, limit=limit)
 
-        with open(cache_file_path, 'w') as file:
-            json.dump(venues, file)
+def venues_to_dataframe(venues, venue):
+    """
+    Build the name/Lat/Lng/category DataFrame from raw Foursquare results.
+
+    Parameters:
+    - venues: List of Foursquare place dicts (as returned by foursquare_places or fetch_many).
+    - venue: Query string, stored in the 'category' column.
 
+    Returns:
+    - A Pandas DataFrame with columns 'fsq_id', 'name', 'Lat', 'Lng' and 'category'.
+    """
+    fsq_ids = []
     names = []
     latitudes = []
     longitudes = []
@@ -71,48 +92,181 @@ def get_venues_dataframe(venue, token, latitude=None, longitude=None, limit=5):
             latitude = location.get('latitude')
             longitude = location.get('longitude')
 
+            fsq_ids.append(venue_info.get('fsq_id'))
             names.append(venue_info.get('name', 'Unknown Name'))
             latitudes.append(latitude)
             longitudes.append(longitude)
 
-    df_venues = pd.DataFrame({'name': names, 'Lat': latitudes, 'Lng': longitudes, 'category': venue})
+    df_venues = pd.DataFrame({'fsq_id': fsq_ids, 'name': names, 'Lat': latitudes, 'Lng': longitudes, 'category': venue})
 
     return df_venues
 
 
-latitude = 37.7804301
-longitude = -122.4103305
-limit= 30
-
-venue = "design talks"
-df_design_talks = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
-
-venue = "bar"
-df_bars = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
-
-venue = "night club"
-df_clubs = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
-
-venue = "airport"
-df_airport = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=5)
-
-venue = "train station"
-df_train = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
-
-venue = "ferry"
-df_ferry = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=5)
-
-venue = "vegan restaurant"
-df_vegan = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
-
-venue = "basketball stadium"
-df_basketball = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
-
-venue = "pet grooming"
-df_grooming = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
+def get_venues_dataframe(venue, token, latitude=None, longitude=None, limit=5, radius=None):
+    venues = foursquare_places(venue, token, latitude=latitude, longitude=longitude, limit=limit, radius=radius)
+
+    return venues_to_dataframe(venues, venue)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: allows `rate` requests per second with bursts up to `capacity`.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            with metrics.timer('sleep.rate_limit'):
+                time.sleep(wait)
+
+
+def create_session(pool_size=16):
+    """
+    Create a requests Session with a keep-alive connection pool shared by all fetch threads.
+    """
+    session = requests.Session()
+    adapter = requests_adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({"accept": "application/json"})
+    return session
+
+
+def retry_delay(response, attempt, backoff=0.5):
+    """
+    Seconds to wait before the next attempt: the server's Retry-After if present,
+    otherwise exponential backoff with jitter.
+    """
+    if response is not None and response.headers.get('Retry-After'):
+        try:
+            return float(response.headers['Retry-After'])
+        except ValueError:
+            pass
+    return backoff * 2 ** attempt + random.uniform(0, backoff)
+
+
+def request_places(session, limiter, params, token, url=None, max_retries=MAX_RETRIES):
+    """
+    One Foursquare search request through the shared session, honouring the rate limiter and
+    retrying on 429/5xx responses and connection errors. url defaults to places_url().
+
+    Returns:
+    - A tuple (results, next_url): the list of results (None if every attempt failed) and
+      the URL of the next page from the Link header, or None on the last page.
+    """
+    url = url or places_url()
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        response = None
+        try:
+            metrics.count('api.requests')
+            with metrics.timer('api.http', sample=True):
+                response = session.get(url, params=params, headers={"Authorization": token}, timeout=10)
+            if response.status_code not in RETRY_STATUS:
+                response.raise_for_status()
+                next_page = response.links.get('next', {}).get('url')
+                return response.json().get('results', []), next_page
+            error = f"HTTP {response.status_code}"
+        except requests.exceptions.HTTPError as e:
+            metrics.count('api.errors')
+            print(f"Error: {e}")
+            return None, None
+        except requests.exceptions.RequestException as e:
+            error = e
+
+        if attempt < max_retries:
+            metrics.count('api.retries')
+            with metrics.timer('sleep.retry'):
+                time.sleep(retry_delay(response, attempt))
+
+    metrics.count('api.errors')
+    print(f"Error: giving up on '{(params or {}).get('query', url)}' after {max_retries + 1} attempts ({error})")
+    return None, None
+
+
+def fetch_places(session, limiter, venue, token, latitude=None, longitude=None, limit=5, radius=None,
+                 max_retries=MAX_RETRIES, url=None):
+    """
+    Fetch one Foursquare query through the shared session (see request_places).
+
+    Returns:
+    - The list of Foursquare results, or an empty list if every attempt failed.
+    """
+    params = {'query': venue, 'limit': limit}
+    if latitude is not None and longitude is not None:
+        params['ll'] = f'{latitude},{longitude}'
+    if radius is not None:
+        params['radius'] = radius
+
+    results, _ = request_places(session, limiter, params, token, url=url, max_retries=max_retries)
+    return results or []
+
+
+def fetch_many(venues, ll=None, limit=5, token=None, radius=None, max_workers=8, rate=RATE_LIMIT, use_cache=True):
+    """
+    Fetch several venue categories concurrently from the Foursquare API.
+
+    Uses one keep-alive connection pool, a token-bucket rate limiter instead of fixed sleeps,
+    and retry with backoff on 429/5xx. Results go through the same keyed venue_cache as
+    foursquare_places, so get_venues_dataframe picks them up afterwards.
+
+    Parameters:
+    - venues: List of query strings, or a dict mapping query string to its own limit.
+    - ll: Optional (latitude, longitude) tuple to search around.
+    - limit: Default number of results per query.
+    - token: Foursquare API key. Defaults to get_token().
+    - radius: Optional search radius in meters.
+    - max_workers: Number of concurrent requests.
+    - rate: Requests per second allowed by the quota.
+    - use_cache: Read and write venue_cache.
+
+    Returns:
+    - A dict mapping each query string to its list of Foursquare results.
+    """
+    limits = venues if isinstance(venues, dict) else {venue: limit for venue in venues}
+    token = token or get_token()
+    latitude, longitude = ll if ll is not None else (None, None)
+
+    results = {}
+    pending = []
+    for venue, venue_limit in limits.items():
+        cached = venue_cache.get(venue, latitude, longitude, radius, venue_limit) if use_cache else None
+        if cached is not None:
+            results[venue] = cached
+        else:
+            pending.append(venue)
+
+    if not pending:
+        return results
+
+    session = create_session(pool_size=max_workers)
+    limiter = TokenBucket(rate)
+    url = places_url()
+
+    def fetch(venue):
+        return venue, fetch_places(session, limiter, venue, token, latitude, longitude, limits[venue], radius, url=url)
 
-venue = "school"
-df_school = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for venue, venue_results in executor.map(fetch, pending):
+                results[venue] = venue_results
+                if use_cache and venue_results:
+                    venue_cache.set(venue, venue_results, latitude, longitude, radius, limits[venue])
+    finally:
+        session.close()
 
-venue = "starbucks"
-df_starbucks = get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
\ No newline at end of file
+    return {venue: results[venue] for venue in limits}
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from . import metrics
+
+
+CACHE_DIR = './data/cache'
+LEGACY_DIR = './data'
+# The flat ./data/{venue}.json files were all fetched around this point (center of San Francisco)
+LEGACY_CENTER = (37.7804301, -122.4103305)
+LEGACY_RADIUS = None  # ...without a radius, i.e. Foursquare's default search area
+
+DEFAULT_TTL = 7 * 24 * 3600  # one week
+MAX_ENTRIES = 512
+MEMORY_ENTRIES = 64
+PRECISION = 3  # decimals kept from lat/lng in the key (~110 m)
+
+
+def expired(created, ttl, now=None):
+    """
+    Expiry rule shared by the cache and store.VenueStore: entries expire ttl seconds after
+    they were fetched; the legacy seeds (no creation time) never do.
+    """
+    if created is None:
+        return False
+    return (time.time() if now is None else now) - created > ttl
+
+
+class VenueCache:
+    """
+    Two-tier cache for Foursquare results keyed on the full query: (query, rounded lat/lng,
+    radius, limit).
+
+    A small in-process LRU sits in front of a JSON file per entry on disk. Disk entries expire
+    after `ttl` seconds and the disk tier is trimmed to `max_entries` by least-recent use.
+    Writes go to a temporary file that is renamed into place, so a crash never leaves a
+    half-written entry behind.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES,
+                 memory_entries=MEMORY_ENTRIES, precision=PRECISION, legacy_dir=LEGACY_DIR):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.precision = precision
+        self.legacy_dir = legacy_dir
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, query, latitude=None, longitude=None, radius=None, limit=None):
+        """
+        Return the normalized key tuple for a query.
+        """
+        if latitude is not None and longitude is not None:
+            latitude = round(float(latitude), self.precision)
+            longitude = round(float(longitude), self.precision)
+        else:
+            latitude = longitude = None
+        return (query.strip().lower(), latitude, longitude, radius, limit)
+
+    def path(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+        slug = ''.join(ch if ch.isalnum() else '_' for ch in key[0])
+        return os.path.join(self.cache_dir, f'{slug}-{digest}.json')
+
+    def _remember(self, key, created, venues):
+        self.memory[key] = (created, venues)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _legacy_path(self, key):
+        # Seed files from before the keyed cache: only valid for the query they were fetched with
+        query, latitude, longitude, radius, _ = key
+        if self.legacy_dir is None or latitude is None or radius != LEGACY_RADIUS:
+            return None
+        if (latitude, longitude) != (round(LEGACY_CENTER[0], self.precision), round(LEGACY_CENTER[1], self.precision)):
+            return None
+        return os.path.join(self.legacy_dir, f'{query}.json')
+
+    def _legacy(self, key):
+        # The seeds ship with the repository, so they never expire; a limit above what a seed
+        # holds is a miss rather than a short answer
+        legacy_path = self._legacy_path(key)
+        if legacy_path is None:
+            return None
+        try:
+            with open(legacy_path, 'r') as file:
+                venues = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        limit = key[4]
+        if limit and limit > len(venues):
+            return None
+        return venues[:limit] if limit else venues
+
+    def get(self, query, latitude=None, longitude=None, radius=None, limit=None):
+        """
+        Return the cached results for a query, or None on a miss or an expired entry.
+        """
+        key = self.key(query, latitude, longitude, radius, limit)
+        now = time.time()
+
+        with self.lock:
+            if key in self.memory:
+                created, venues = self.memory[key]
+                if not expired(created, self.ttl, now):
+                    self.memory.move_to_end(key)
+                    metrics.count('cache.hits')
+                    return venues
+                del self.memory[key]
+
+        path = self.path(key)
+        try:
+            with open(path, 'r') as file:
+                entry = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            entry = None
+
+        if entry is not None and not expired(entry['created'], self.ttl, now):
+            os.utime(path)  # mark as recently used for LRU trimming
+            with self.lock:
+                self._remember(key, entry['created'], entry['venues'])
+            metrics.count('cache.hits')
+            return entry['venues']
+
+        if entry is not None:
+            self._remove(path)
+
+        venues = self._legacy(key)
+        metrics.count('cache.hits' if venues is not None else 'cache.misses')
+        return venues
+
+    def source(self, query, latitude=None, longitude=None, radius=None, limit=None):
+        """
+        Path of the file get() would read a query from (its disk entry, or the legacy
+        ./data file for the legacy center and radius), or None when it is not on disk. Expiry
+        is not checked; see store.VenueStore.expired, which like get() never expires the seeds.
+        """
+        key = self.key(query, latitude, longitude, radius, limit)
+        path = self.path(key)
+        if os.path.exists(path):
+            return path
+
+        return self._legacy_path(key) if self._legacy(key) is not None else None
+
+    def set(self, query, venues, latitude=None, longitude=None, radius=None, limit=None):
+        """
+        Store the results of a query in both tiers.
+        """
+        key = self.key(query, latitude, longitude, radius, limit)
+        created = time.time()
+        entry = {'key': list(key), 'created': created, 'venues': venues}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(entry, file)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+        with self.lock:
+            self._remember(key, created, venues)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Drop expired disk entries and trim the disk tier to max_entries (least recently used first).
+        """
+        try:
+            names = [name for name in os.listdir(self.cache_dir) if name.endswith('.json')]
+        except FileNotFoundError:
+            return
+
+        now = time.time()
+        entries = []
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                used = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            entries.append((used, path))
+
+        entries.sort(reverse=True)
+        for position, (used, path) in enumerate(entries):
+            # mtime is refreshed on every hit, so it is an upper bound on the entry's age only;
+            # get() still checks the stored creation time
+            if position >= self.max_entries or now - used > self.ttl:
+                self._remove(path)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        for name in os.listdir(self.cache_dir) if os.path.isdir(self.cache_dir) else []:
+            if name.endswith('.json'):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,291 @@
+import os
+import argparse
+from . import distance
+from . import metrics
+from . import pipeline
+
+
+def print_scores(office_scores, top=10):
+    for position, office in enumerate(office_scores[:top], start=1):
+        lng, lat = office['location']
+        print(f"{position:>3}. {office['score']:.2f}  {office['office']}  ({lat:.6f}, {lng:.6f})")
+
+
+def load_venues(args):
+    if args.columnar:
+        return pipeline.load_venue_store(args.lat, args.lng, args.limit).dataframes()
+    return pipeline.load_venues(args.lat, args.lng, args.limit)
+
+
+def parse_overrides(values, defaults, cast=float):
+    """
+    Apply TYPE=VALUE overrides (e.g. df_bars=0.3) on top of a weights or cutoffs dict.
+    """
+    overrides = dict(defaults)
+    for value in values or []:
+        venue_type, _, number = value.partition('=')
+        if not number:
+            raise SystemExit(f"Expected TYPE=VALUE, got '{value}'")
+        overrides[venue_type] = cast(number)
+    return overrides
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m src', description="Office Locator pipeline")
+    parser.add_argument('--city', default=pipeline.CITY, help="City to search for offices")
+    parser.add_argument('--lat', type=float, default=pipeline.CENTER[0], help="Latitude of the venue search center")
+    parser.add_argument('--lng', type=float, default=pipeline.CENTER[1], help="Longitude of the venue search center")
+    parser.add_argument('--limit', type=int, default=pipeline.LIMIT, help="Venues fetched per category")
+    parser.add_argument('--min-employees', type=int, default=pipeline.MIN_EMPLOYEES)
+    parser.add_argument('--max-employees', type=int, default=pipeline.MAX_EMPLOYEES)
+    parser.add_argument('--batch', action='store_true', help="Use the vectorized batch scorer")
+    parser.add_argument('--sync', action='store_true',
+                        help="Keep the venues in the single incrementally synced 'venues' collection")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Issue the scoring queries concurrently through Motor (needs motor)")
+    parser.add_argument('--top', type=int, default=10, help="Offices to print")
+    parser.add_argument('--columnar', action='store_true',
+                        help="Load the venues through the memory-mapped columnar store in data/store")
+    parser.add_argument('--tier', choices=distance.TIERS, default=None,
+                        help="Distance tier: cheap bound first, exact geodesic only near the cutoffs (score, map, maps, grid)")
+    parser.add_argument('--index', choices=['kdtree', 'grid', 'mongo'], default=None,
+                        help="Find the nearest venues in this spatial index instead of one $near per office "
+                             "(score, map, maps without --batch)")
+    parser.add_argument('--network', default=None, metavar='GRAPH',
+                        help="Score on walking distances along this street graph (.npz or .json, see src/network.py)")
+    parser.add_argument('--api-url', default=None,
+                        help="Foursquare API base URL (default: FOURSQUARE_API_URL or the public API), "
+                             "e.g. http://127.0.0.1:8765/v3 for benchmarks/stub_server.py")
+    parser.add_argument('--report', default=None, help="Write the run report (stage timings, counters, memory) as JSON")
+    parser.add_argument('--prometheus', default=None, help="Write the run metrics in Prometheus text format")
+    parser.add_argument('--profile', default=None, metavar='DIR', help="Capture a cProfile .prof file per stage in DIR")
+
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('run', help="Run the whole pipeline and render the map")
+    commands.add_parser('offices', help="Store the candidate offices of --city")
+    venues_parser = commands.add_parser('venues', help="Load the venues around --lat/--lng and store them in MongoDB")
+    venues_parser.add_argument('--crawl', action='store_true',
+                               help="Store the venues of the last crawl of the city instead (see the crawl command)")
+
+    crawl_parser = commands.add_parser('crawl', help="Crawl every venue of each category inside a bounding box")
+    crawl_parser.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'),
+                              default=pipeline.grid.SAN_FRANCISCO_BBOX)
+    crawl_parser.add_argument('--queries', nargs='+', default=None, help="Queries to crawl (default: every category)")
+    crawl_parser.add_argument('--max-pages', type=int, default=pipeline.crawl.MAX_PAGES,
+                              help="Pages followed per tile before splitting it")
+    crawl_parser.add_argument('--min-tile', type=float, default=pipeline.crawl.MIN_TILE, help="Smallest tile in meters")
+    crawl_parser.add_argument('--directory', default=pipeline.crawl.CRAWL_DIR, help="Checkpoint directory")
+    crawl_parser.add_argument('--refresh', action='store_true',
+                              help="Crawl again even if a finished crawl has not expired yet")
+    score_parser = commands.add_parser('score', help="Score the stored offices")
+    score_parser.add_argument('--mode', choices=pipeline.density.MODES, default='nearest',
+                              help="nearest venue (default), venue count, Gaussian kernel sum or k-nearest average")
+    score_parser.add_argument('--k', type=int, default=pipeline.density.K, help="Neighbours averaged by --mode knn")
+    score_parser.add_argument('--saturation', type=float, default=pipeline.density.SATURATION,
+                              help="Venues at which a category scores 1 with --mode count/kernel")
+    rerank_parser = commands.add_parser('rerank', help="Rank the offices from the stored distance matrix under new weights")
+    rerank_parser.add_argument('--weight', nargs='+', metavar='TYPE=WEIGHT', help="e.g. df_bars=0.3 df_vegan=0")
+    rerank_parser.add_argument('--cutoff', nargs='+', metavar='TYPE=METERS', help="e.g. df_bars=500")
+    rerank_parser.add_argument('--no-refresh', dest='refresh', action='store_false',
+                               help="Use the stored matrix as is, without checking for changed offices or venues")
+
+    profiles_parser = commands.add_parser('profiles', help="Rank the offices under every weight profile of a JSON file")
+    profiles_parser.add_argument('file', help="JSON object of named profiles ({'weights': {...}, 'max_distance': {...}})")
+    profiles_parser.add_argument('--samples', type=int, default=0,
+                                 help="Perturbed weight samples per profile for the rank-stability report")
+    profiles_parser.add_argument('--noise', type=float, default=0.2, help="Lognormal sigma of the weight perturbation")
+    profiles_parser.add_argument('--output', default=None, help="Write the full result as JSON")
+
+    map_parser = commands.add_parser('map', help="Score the stored offices and render the map of the best one")
+    map_parser.add_argument('--fast', action='store_true', help="One clustered layer per category instead of one marker per venue")
+    map_parser.add_argument('--no-browser', dest='open_browser', action='store_false', help="Only write the HTML file")
+    map_parser.add_argument('--output', default=pipeline.mongo.MAP_FILE)
+
+    maps_parser = commands.add_parser('maps', help="Score the stored offices and render a fast map for each of them")
+    maps_parser.add_argument('--directory', default='./maps/offices')
+    maps_parser.add_argument('--layer', choices=['cluster', 'geojson'], default='cluster')
+    maps_parser.add_argument('--count', type=int, default=None, help="Only render the best COUNT offices")
+
+    grid_parser = commands.add_parser('grid', help="Score a lattice over the city and render a suitability heatmap")
+    grid_parser.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'),
+                             default=pipeline.grid.SAN_FRANCISCO_BBOX)
+    grid_parser.add_argument('--spacing', type=float, default=pipeline.grid.SPACING, help="Lattice spacing in meters")
+    grid_parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: all CPUs)")
+    grid_parser.add_argument('--raster', default='./data/grid/scores.npy')
+    grid_parser.add_argument('--geojson', default='./maps/grid_scores.geojson')
+    grid_parser.add_argument('--heatmap', default='./maps/grid_heatmap.html')
+
+    cities_parser = commands.add_parser('cities', help="Run the pipeline for several cities in parallel")
+    cities_parser.add_argument('--cities', nargs='+', default=None, help="Cities to run (default: top cities by office count)")
+    cities_parser.add_argument('--top-cities', type=int, default=5)
+    cities_parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per city)")
+
+    topk_parser = commands.add_parser('topk', help="Find the --top best candidates by branch and bound")
+    topk_parser.add_argument('--source', choices=['offices', 'companies', 'grid'], default='offices',
+                             help="Stored offices, every office in Companies (all cities) or the --bbox/--spacing lattice")
+    topk_parser.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'),
+                             default=pipeline.grid.SAN_FRANCISCO_BBOX)
+    topk_parser.add_argument('--spacing', type=float, default=pipeline.grid.SPACING, help="Lattice spacing in meters")
+    topk_parser.add_argument('--cell-size', type=float, default=None,
+                             help="Side of the pruning cells in meters (default: 100, or 3 lattice steps)")
+
+    serve_parser = commands.add_parser('serve', help="Serve scores over HTTP from offices and venues kept in memory")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--reload-interval', type=float, default=30,
+                              help="Seconds between checks for changed offices or venues (0: never reload)")
+    serve_parser.add_argument('--backend', choices=['kdtree', 'grid'], default=None,
+                              help="Spatial index (default: kdtree when scipy is installed)")
+
+    watch_parser = commands.add_parser('watch', help="Keep the offices of --city and their distances in sync with Companies")
+    watch_parser.add_argument('--collection', default=None,
+                              help="Derived offices collection (default: the one the offices command writes)")
+    watch_parser.add_argument('--batch-size', type=int, default=500, help="Changed companies applied per round")
+    watch_parser.add_argument('--no-rescore', action='store_true', help="Only maintain the offices, not the distance matrix")
+
+    indexes_parser = commands.add_parser('indexes', help="Ensure the Companies indexes and optionally explain the queries")
+    indexes_parser.add_argument('--explain', action='store_true', help="Report query plans, COLLSCANs and docs examined")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    metrics.configure(profile_dir=args.profile)
+    if args.api_url:
+        # Through the environment so grid/cities worker processes inherit it
+        os.environ['FOURSQUARE_API_URL'] = args.api_url
+    try:
+        run_command(args)
+    finally:
+        if args.report:
+            metrics.write_report(args.report, command=args.command)
+        if args.prometheus:
+            metrics.write_prometheus(args.prometheus)
+    return 0
+
+
+def run_command(args):
+
+    if args.command == 'run':
+        office_scores = pipeline.run(args.city, (args.lat, args.lng), args.limit, args.min_employees,
+                                     args.max_employees, batch=args.batch, sync=args.sync)
+        print_scores(office_scores, args.top)
+
+    elif args.command == 'offices':
+        db, collection = pipeline.mongo.connection_database(pipeline.DATABASE, pipeline.COMPANIES)
+        print(pipeline.offices_stage(db, collection, args.city, args.min_employees, args.max_employees))
+
+    elif args.command == 'venues':
+        db, _ = pipeline.mongo.connection_database(pipeline.DATABASE, pipeline.COMPANIES)
+        if args.crawl:
+            venues_by_type = pipeline.crawl_stage()
+        else:
+            venues_by_type = load_venues(args)
+        summary = pipeline.venues_stage(db, venues_by_type, sync=args.sync)
+        if summary:
+            print(summary)
+
+    elif args.command == 'crawl':
+        queries = None
+        if args.queries:
+            queries = {venue_type: query for venue_type, query in pipeline.scoring.VENUE_QUERIES.items()
+                       if query in args.queries}
+            queries.update({query: query for query in args.queries if query not in queries.values()})
+        venues_by_type = pipeline.crawl_stage(tuple(args.bbox), queries, directory=args.directory,
+                                              max_pages=args.max_pages, min_tile=args.min_tile, refresh=args.refresh)
+        for venue_type, df in venues_by_type.items():
+            print(f"{venue_type}: {len(df)} venues")
+
+    elif args.command == 'score':
+        office_scores = pipeline.score_stage(batch=args.batch, sync=args.sync, use_async=args.use_async, mode=args.mode,
+                                             k=args.k, saturation=args.saturation, network_graph=args.network,
+                                             tier=args.tier, index_backend=args.index)
+        print_scores(office_scores, args.top)
+
+    elif args.command == 'rerank':
+        weights = parse_overrides(args.weight, pipeline.scoring.WEIGHTS)
+        max_distance = parse_overrides(args.cutoff, pipeline.scoring.MAX_DISTANCE)
+        print_scores(pipeline.rerank_stage(weights, max_distance, sync=args.sync, refresh=args.refresh), args.top)
+
+    elif args.command == 'profiles':
+        import json
+
+        result = pipeline.profiles_stage(pipeline.profiles.load_profiles(args.file), k=args.top, samples=args.samples,
+                                         noise=args.noise, sync=args.sync)
+        for name, ranking in result.items():
+            print(f"{name}:")
+            print_scores(ranking['top'], args.top)
+            for office in ranking.get('stability', [])[:3]:
+                print(f"     top-3 in {office['top_share']:.0%} of samples, mean rank {office['mean_rank']:.1f}  "
+                      f"{office['office']}")
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(result, file, indent=2)
+
+    elif args.command == 'map':
+        office_scores = pipeline.score_stage(batch=args.batch, sync=args.sync, network_graph=args.network,
+                                             tier=args.tier, index_backend=args.index)
+        print_scores(office_scores, args.top)
+        if office_scores:
+            pipeline.map_stage(office_scores, load_venues(args), args.output,
+                               open_browser=args.open_browser, fast=args.fast)
+
+    elif args.command == 'maps':
+        office_scores = pipeline.score_stage(batch=args.batch, sync=args.sync, network_graph=args.network,
+                                             tier=args.tier, index_backend=args.index)
+        paths = pipeline.maps_stage(office_scores, load_venues(args), args.directory,
+                                    top=args.count, layer=args.layer)
+        print(f"Rendered {len(paths)} maps into {args.directory}")
+
+    elif args.command == 'grid':
+        result = pipeline.grid_stage(load_venues(args), tuple(args.bbox), args.spacing,
+                                     top_n=args.top, workers=args.workers, raster_path=args.raster,
+                                     geojson_path=args.geojson, map_file=args.heatmap, network_graph=args.network,
+                                     tier=args.tier)
+        print(f"Scored {result['shape'][0] * result['shape'][1]} cells, best {result['max_score']:.2f}")
+        for position, cell in enumerate(result['top'], start=1):
+            print(f"{position:>3}. {cell['score']:.2f}  ({cell['Lat']:.6f}, {cell['Lng']:.6f})")
+
+    elif args.command == 'cities':
+        from . import multicity
+
+        result = multicity.run_cities(args.cities, args.top_cities, workers=args.workers, min_employees=args.min_employees,
+                                      max_employees=args.max_employees, limit=args.limit)
+        for position, office in enumerate(result['ranking'][:args.top], start=1):
+            print(f"{position:>3}. {office['score']:.2f}  {office['office']}  [{office['city']}]")
+        print(multicity.format_timings(result))
+
+    elif args.command == 'topk':
+        venues_by_type = load_venues(args) if args.source == 'grid' else None
+        result = pipeline.topk_stage(args.top, args.source, sync=args.sync, min_employees=args.min_employees,
+                                     max_employees=args.max_employees, venues_by_type=venues_by_type,
+                                     bbox=tuple(args.bbox), spacing=args.spacing, cell_size=args.cell_size)
+        if args.source == 'grid':
+            for position, cell in enumerate(result, start=1):
+                print(f"{position:>3}. {cell['score']:.4f}  ({cell['Lat']:.6f}, {cell['Lng']:.6f})")
+        else:
+            print_scores(result, args.top)
+
+    elif args.command == 'serve':
+        from . import service
+
+        service.serve(args.host, args.port, args.reload_interval, pipeline.DATABASE, pipeline.OFFICES_COLLECTION,
+                      pipeline.mongo.VENUES_COLLECTION if args.sync else None,
+                      pipeline.store.STORE_DIR if args.columnar else None, args.backend)
+
+    elif args.command == 'watch':
+        from . import watcher
+
+        watcher.watch(args.city, args.min_employees, args.max_employees, args.collection or pipeline.OFFICES_COLLECTION,
+                      pipeline.DATABASE, pipeline.COMPANIES, pipeline.mongo.VENUES_COLLECTION if args.sync else None,
+                      rescore_offices=not args.no_rescore, batch_size=args.batch_size)
+
+    elif args.command == 'indexes':
+        from . import indexes
+
+        _, collection = pipeline.mongo.connection_database(pipeline.DATABASE, pipeline.COMPANIES)
+        for name, status in indexes.ensure_indexes(collection).items():
+            print(f"{name}: {status}")
+        if args.explain:
+            queries = indexes.companies_queries(args.city, args.min_employees, args.max_employees, pipeline.CONDITIONS)
+            print(indexes.format_report(indexes.explain_report(collection, queries)))
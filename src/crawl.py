@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from . import api
+from . import cache
+from . import metrics
+from . import scoring
+
+
+CRAWL_DIR = './data/crawl'
+PAGE_LIMIT = 50  # largest page Foursquare returns
+MAX_PAGES = 5  # pages followed per tile before it is considered too dense and split
+MIN_TILE = 200  # meters; tiles are not split below this size
+CHECKPOINT_EVERY = 1  # waves of tiles between checkpoints
+
+
+def tile_size(tile):
+    """
+    Height and width of a (south, west, north, east) tile in meters.
+    """
+    south, west, north, east = tile
+    middle = (south + north) / 2
+    height = scoring.distance_matrix([south], [west], [north], [west])[0, 0]
+    width = scoring.distance_matrix([middle], [west], [middle], [east])[0, 0]
+    return float(height), float(width)
+
+
+def split_tile(tile):
+    """
+    The four quadrants of a (south, west, north, east) tile.
+    """
+    south, west, north, east = tile
+    lat = (south + north) / 2
+    lng = (west + east) / 2
+    return [(south, west, lat, lng), (south, lng, lat, east), (lat, west, north, lng), (lat, lng, north, east)]
+
+
+def checkpoint_path(query, directory=CRAWL_DIR):
+    slug = ''.join(ch if ch.isalnum() else '_' for ch in query.strip().lower())
+    return os.path.join(directory, f'{slug}.json')
+
+
+def new_state(query, bbox, limit):
+    return {
+        'query': query,
+        'bbox': list(bbox),
+        'limit': limit,
+        'pending': [list(bbox)],
+        'venues': {},
+        'requests': 0,
+        'tiles': 0,
+        'unsplittable': 0,
+        'complete': False
+    }
+
+
+def load_state(path, query, bbox, limit):
+    """
+    Resume a crawl from its checkpoint when it was started with the same query, bounding
+    box and page limit; otherwise start over.
+    """
+    try:
+        with open(path, 'r') as file:
+            state = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return new_state(query, bbox, limit)
+
+    if state.get('query') != query or state.get('bbox') != list(bbox) or state.get('limit') != limit:
+        return new_state(query, bbox, limit)
+    return state
+
+
+def save_state(path, state):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    state['updated'] = time.time()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(state, file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def fetch_tile(session, limiter, query, token, tile, limit=PAGE_LIMIT, max_pages=MAX_PAGES, url=None):
+    """
+    Fetch every page of one query inside a tile, following the Link header. url defaults to
+    api.places_url().
+
+    Returns:
+    - A tuple (venues, requests, status): status is 'split' when the last page fetched was
+      full, i.e. the tile may hold more venues than the API returned for it, 'failed' when a
+      request failed after its retries, and 'done' otherwise.
+    """
+    south, west, north, east = tile
+    params = {'query': query, 'limit': limit, 'sw': f'{south},{west}', 'ne': f'{north},{east}'}
+    venues = []
+    url = url or api.places_url()
+    for pages in range(1, max_pages + 1):
+        page, url = api.request_places(session, limiter, params, token, url=url)
+        if page is None:
+            return venues, pages, 'failed'
+        venues.extend(page)
+        # The next-page URL already carries the query and cursor
+        params = None
+        if not url:
+            break
+    return venues, pages, 'split' if len(page) >= limit else 'done'
+
+
+def crawl(query, bbox, token=None, limit=PAGE_LIMIT, max_pages=MAX_PAGES, min_tile=MIN_TILE, path=None,
+          max_workers=4, rate=api.RATE_LIMIT, checkpoint_every=CHECKPOINT_EVERY, ttl=None, refresh=False):
+    """
+    Crawl every venue of a query inside a bounding box.
+
+    Starts from the whole box and splits a tile into quadrants only when its last page comes
+    back full, so sparse areas cost one request and dense ones are refined until each tile
+    fits in max_pages pages (or is smaller than min_tile meters). Venues are deduplicated by
+    fsq_id. The state is checkpointed to path after each wave of tiles, so an interrupted
+    crawl resumes where it stopped, and a finished crawl is returned without any request
+    until it is older than ttl (cache.expired(), like the venue cache entries). Tiles whose
+    requests failed are queued again for the next call, which leaves the crawl
+    incomplete.
+
+    Parameters:
+    - query: Foursquare query string (e.g. 'bar').
+    - bbox: (south, west, north, east) in degrees.
+    - token: Foursquare API key. Defaults to api.get_token().
+    - limit: Results per page.
+    - max_pages: Pages followed per tile.
+    - min_tile: Smallest tile edge in meters.
+    - path: Checkpoint file. Defaults to ./data/crawl/{query}.json.
+    - max_workers: Tiles fetched concurrently.
+    - rate: Requests per second allowed by the quota.
+    - checkpoint_every: Waves of tiles between checkpoints.
+    - ttl: Seconds a finished crawl stays valid. Defaults to the venue cache's TTL.
+    - refresh: Crawl again even if the finished crawl has not expired.
+
+    Returns:
+    - The crawl state: 'venues' (dict by fsq_id), 'requests', 'tiles', 'unsplittable'
+      (saturated tiles already at min_tile), 'complete' and 'completed' (when it finished).
+    """
+    path = path or checkpoint_path(query)
+    state = load_state(path, query, bbox, limit)
+    if state['complete']:
+        # Checkpoints written before 'completed' existed fall back to their last save
+        completed = state.get('completed', state.get('updated'))
+        if not refresh and not cache.expired(completed, api.venue_cache.ttl if ttl is None else ttl):
+            return state
+        state = new_state(query, bbox, limit)
+
+    token = token or api.get_token()
+    session = api.create_session(pool_size=max_workers)
+    limiter = api.TokenBucket(rate)
+    url = api.places_url()
+
+    def fetch(tile):
+        return tile, fetch_tile(session, limiter, query, token, tuple(tile), limit, max_pages, url)
+
+    waves = 0
+    wave, processed, failed = [], 0, []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while state['pending']:
+                wave, processed, state['pending'] = state['pending'], 0, []
+                for tile, (venues, pages, status) in executor.map(fetch, wave):
+                    processed += 1
+                    state['requests'] += pages
+                    for venue in venues:
+                        if venue.get('fsq_id'):
+                            state['venues'][venue['fsq_id']] = venue
+                    if status == 'failed':
+                        failed.append(tile)
+                        continue
+                    state['tiles'] += 1
+                    if status == 'done':
+                        continue
+                    if min(tile_size(tile)) / 2 < min_tile:
+                        state['unsplittable'] += 1
+                    else:
+                        state['pending'].extend(list(child) for child in split_tile(tile))
+
+                waves += 1
+                if waves % checkpoint_every == 0:
+                    save_state(path, state)
+        state['pending'] = failed
+        state['complete'] = not failed
+        if state['complete']:
+            state['completed'] = time.time()
+    except BaseException:
+        # The unprocessed tiles of the interrupted wave go back to the queue
+        state['pending'] = failed + wave[processed:] + state['pending']
+        save_state(path, state)
+        raise
+    finally:
+        session.close()
+
+    save_state(path, state)
+    metrics.count('crawl.venues', len(state['venues']))
+    return state
+
+
+def crawl_venues(bbox, queries=None, token=None, directory=CRAWL_DIR, **options):
+    """
+    Crawl several categories, one checkpoint file per query.
+
+    Parameters:
+    - bbox: (south, west, north, east) in degrees.
+    - queries: Dict mapping venue type to query string. Defaults to scoring.VENUE_QUERIES.
+    - options: Passed to crawl().
+
+    Returns:
+    - A dict mapping venue type to its venue DataFrame (same columns as api.get_venues_dataframe).
+    """
+    queries = queries or scoring.VENUE_QUERIES
+    token = token or api.get_token()
+    venues_by_type = {}
+    for venue_type, query in queries.items():
+        state = crawl(query, bbox, token, path=checkpoint_path(query, directory), **options)
+        venues_by_type[venue_type] = api.venues_to_dataframe(list(state['venues'].values()), query)
+    return venues_by_type
@@ -0,0 +1,93 @@
+from . import scoring
+from . import spatial
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+
+
+# Scoring modes. 'nearest' is the score of best_office_location (nearest venue only); the
+# others reward offices with several venues of a category around them.
+MODES = ('nearest', 'count', 'kernel', 'knn')
+SATURATION = 5  # venues (or summed kernel weight) at which a category scores 1 in 'count'/'kernel'
+K = 3  # neighbours averaged in 'knn'
+
+
+def category_scores(index, office_coords, venue_types, mode='count', max_distance=scoring.MAX_DISTANCE, k=K,
+                    saturation=SATURATION, bandwidth=None):
+    """
+    Score every office against every venue category with one of the density modes.
+
+    - nearest: sqrt(1 - (d / cutoff)^2) of the nearest venue, as in best_office_location.
+    - count: venues within the category cutoff, divided by saturation (capped at 1).
+    - kernel: sum of Gaussian weights exp(-d^2 / 2 sigma^2) over the venues within the
+      cutoff, sigma = bandwidth or half the cutoff, divided by saturation (capped at 1).
+    - knn: the nearest-venue score applied to the mean distance of the k nearest venues;
+      missing neighbours count as the cutoff distance.
+
+    Parameters:
+    - index: spatial.VenueIndex over the venues (the radius and k-nearest queries run on it).
+    - office_coords: (n, 2) array of [longitude, latitude].
+    - venue_types: The venue types to score (columns of the result).
+    - mode: One of MODES.
+    - max_distance: Dict mapping venue type to its cutoff distance in meters.
+    - k, saturation, bandwidth: Parameters of the modes above.
+
+    Returns:
+    - An (n, len(venue_types)) array of category scores in [0, 1].
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown scoring mode: {mode}")
+
+    office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+    lat, lng = office_coords[:, 1], office_coords[:, 0]
+    result = np.zeros((len(office_coords), len(venue_types)))
+
+    for column, venue_type in enumerate(venue_types):
+        cutoff = max_distance.get(venue_type, scoring.DEFAULT_MAX_DISTANCE)
+
+        if mode == 'nearest':
+            distances = index.k_nearest_distances(venue_type, lat, lng, 1)[:, 0]
+            result[:, column] = scoring.normalized_scores(distances, cutoff)
+
+        elif mode == 'knn':
+            distances = np.minimum(index.k_nearest_distances(venue_type, lat, lng, k), cutoff)
+            result[:, column] = scoring.normalized_scores(distances.mean(axis=1), cutoff)
+
+        else:
+            points, _, distances = index.pairs_within(venue_type, lat, lng, cutoff)
+            if mode == 'count':
+                totals = np.bincount(points, minlength=len(office_coords))
+            else:
+                sigma = bandwidth or cutoff / 2
+                totals = np.bincount(points, weights=np.exp(-distances ** 2 / (2 * sigma ** 2)),
+                                     minlength=len(office_coords))
+            result[:, column] = np.minimum(totals / saturation, 1.0)
+
+    return result
+
+
+def score_offices(office_coords, venues_by_type, mode='count', weights=scoring.WEIGHTS,
+                  max_distance=scoring.MAX_DISTANCE, backend=None, k=K, saturation=SATURATION, bandwidth=None):
+    """
+    Density version of scoring.score_offices(): builds an in-memory spatial index over the
+    venues and weights the category_scores() of every office.
+
+    Parameters:
+    - office_coords: (n, 2) array of [longitude, latitude].
+    - venues_by_type: Dict mapping venue type to an (m, 2) array of [longitude, latitude], or
+      an already built spatial.VenueIndex.
+    - mode, k, saturation, bandwidth: See category_scores().
+    - weights, max_distance: As in scoring.score_offices().
+    - backend: Spatial index backend ('kdtree' or 'grid', see spatial.VenueIndex).
+
+    Returns:
+    - A NumPy array of shape (n,) with the unrounded score of each office.
+    """
+    if isinstance(venues_by_type, spatial.VenueIndex):
+        index = venues_by_type
+    else:
+        index = spatial.VenueIndex.from_arrays(venues_by_type, backend)
+
+    venue_types = list(weights)
+    scores = category_scores(index, office_coords, venue_types, mode, max_distance, k, saturation, bandwidth)
+    return scores @ np.array([weights[venue_type] for venue_type in venue_types], dtype=float)
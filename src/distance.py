@@ -0,0 +1,340 @@
+import math
+from . import metrics
+from . import scoring
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+geopy_distance = lazy_module('geopy.distance')
+
+
+# Distance tiers, cheapest first, with their relative error against geopy's geodesic
+# (Karney), measured on random pairs with |latitude| <= 80 degrees:
+#
+# - equirectangular: flat local projection with the WGS-84 meridian and normal radii of the
+#   mean latitude. <= 1e-7 + 2 (d / R)^2, i.e. 6e-7 at 5 km, 2e-5 at 20 km, 5e-4 at 100 km.
+#   Valid up to EQUIRECTANGULAR_RANGE; beyond it (or past MAX_LATITUDE) haversine is used.
+# - haversine: great circle on the mean-radius sphere. <= 0.57% anywhere.
+# - ellipsoidal: Andoyer-Lambert (scoring.distance_matrix). <= 2e-6 up to ~100 km.
+# - exact: geopy's geodesic, the distance of the original scorer.
+#
+# Only the score sqrt(1 - (d / cutoff)^2) matters, so a distance is good enough once every
+# value inside its error interval gives (nearly) the same score: pairs farther than the
+# cutoff score 0 whatever their exact distance, and in the middle of the range a relative
+# error e moves the score by at most e (d / cutoff)^2 / sqrt(1 - (d / cutoff)^2). Only pairs
+# close to the cutoff, where that slope blows up, need the exact solve. With the default
+# SCORE_TOLERANCE every category score is within 1e-5 of the exact one, so an office score
+# (weights sum to 1) moves by less than 1e-5: rankings only change between offices whose
+# exact scores are closer than 2e-5, and the scores rounded to 2 decimals only when one sits
+# within 1e-5 of a rounding edge (the same caveat as the batch scorer's Andoyer distances).
+TIERS = ('equirectangular', 'haversine', 'ellipsoidal', 'exact')
+DEFAULT_TIER = 'equirectangular'
+SCORE_TOLERANCE = 1e-5
+EARTH_RADIUS = 6371008.8
+EQUIRECTANGULAR_RANGE = 500000  # meters
+MAX_LATITUDE = 80
+HAVERSINE_ERROR = 0.0057
+ELLIPSOIDAL_ERROR = 2e-6
+ABSOLUTE_ERROR = 1e-3  # meters, covers rounding on coincident points
+
+WGS84_E2 = scoring.WGS84_F * (2 - scoring.WGS84_F)
+
+
+def equirectangular(lat1, lng1, lat2, lng2):
+    """
+    Local flat-earth distance in meters between broadcastable arrays of points in degrees.
+
+    The trigonometry runs on the (unbroadcast) inputs only: the sine and cosine of the mean
+    latitude of each pair come from the half-angle products, so an (n, 1) x (1, m) call costs
+    O(n + m) trigonometric evaluations and only multiplications per pair.
+    """
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lng1, lat2, lng2))
+    sin1, cos1 = np.sin(lat1 / 2), np.cos(lat1 / 2)
+    sin2, cos2 = np.sin(lat2 / 2), np.cos(lat2 / 2)
+    sin_middle = sin1 * cos2 + cos1 * sin2
+    cos_middle = cos1 * cos2 - sin1 * sin2
+    w = 1 - WGS84_E2 * sin_middle ** 2
+    sqrt_w = np.sqrt(w)
+    dlng = lng2 - lng1
+    if np.size(dlng) and np.abs(dlng).max() > np.pi:
+        dlng = (dlng + np.pi) % (2 * np.pi) - np.pi
+    return np.hypot(scoring.WGS84_A * (1 - WGS84_E2) / (w * sqrt_w) * (lat2 - lat1),
+                    scoring.WGS84_A / sqrt_w * cos_middle * dlng)
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance in meters on the mean-radius sphere, for broadcastable arrays of
+    points in degrees.
+    """
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lng1, lat2, lng2))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def exact(lat1, lng1, lat2, lng2):
+    """
+    geopy's geodesic, one pair at a time.
+    """
+    lat1, lng1, lat2, lng2 = np.broadcast_arrays(*(np.asarray(value, dtype=float) for value in (lat1, lng1, lat2, lng2)))
+    result = np.empty(lat1.shape)
+    metrics.count('distance.exact', result.size)
+    with metrics.timer('distance.geodesic'):
+        for position in np.ndindex(result.shape):
+            result[position] = geopy_distance.geodesic((lat1[position], lng1[position]),
+                                                       (lat2[position], lng2[position])).meters
+    return result
+
+
+def tier_distances(tier, lat1, lng1, lat2, lng2):
+    """
+    Distances of one tier between broadcastable arrays of points in degrees.
+    """
+    if tier == 'equirectangular':
+        return equirectangular(lat1, lng1, lat2, lng2)
+    if tier == 'haversine':
+        return haversine(lat1, lng1, lat2, lng2)
+    if tier == 'ellipsoidal':
+        lat1, lng1, lat2, lng2 = np.broadcast_arrays(*(np.asarray(value, dtype=float) for value in (lat1, lng1, lat2, lng2)))
+        return scoring.pair_distances(lat1, lng1, lat2, lng2)
+    if tier == 'exact':
+        return exact(lat1, lng1, lat2, lng2)
+    raise ValueError(f"Unknown distance tier: {tier}")
+
+
+def relative_error(tier, distances):
+    """
+    Bound on the relative error of a tier's distances (see TIERS above).
+    """
+    if tier == 'equirectangular':
+        return 1e-7 + 2 * (np.asarray(distances, dtype=float) / EARTH_RADIUS) ** 2
+    if tier == 'haversine':
+        return np.full(np.shape(distances), HAVERSINE_ERROR)
+    if tier == 'ellipsoidal':
+        return np.full(np.shape(distances), ELLIPSOIDAL_ERROR)
+    return np.zeros(np.shape(distances))
+
+
+def bounds(lat1, lng1, lat2, lng2):
+    """
+    Cheap estimate of the distances with its error bound: equirectangular, or haversine for
+    pairs outside the equirectangular domain.
+
+    Returns:
+    - A tuple (estimate, relative_error) of arrays with the broadcast shape of the inputs.
+    """
+    lat1, lng1, lat2, lng2 = np.broadcast_arrays(*(np.asarray(value, dtype=float) for value in (lat1, lng1, lat2, lng2)))
+    estimate = equirectangular(lat1, lng1, lat2, lng2)
+    error = relative_error('equirectangular', estimate)
+    outside = (estimate > EQUIRECTANGULAR_RANGE) | (np.maximum(np.abs(lat1), np.abs(lat2)) > MAX_LATITUDE)
+    if outside.any():
+        estimate[outside] = haversine(lat1[outside], lng1[outside], lat2[outside], lng2[outside])
+        error[outside] = HAVERSINE_ERROR
+    return estimate, error
+
+
+def score_uncertainty(distances, error, cutoff):
+    """
+    Width of the normalized-score interval of distances known within a relative error.
+    """
+    lower = np.maximum(distances * (1 - error) - ABSOLUTE_ERROR, 0)
+    upper = distances * (1 + error) + ABSOLUTE_ERROR
+    return scoring.normalized_scores(lower, cutoff) - scoring.normalized_scores(upper, cutoff)
+
+
+def tiered_distances(lat1, lng1, lat2, lng2, cutoff, tier=DEFAULT_TIER, tolerance=SCORE_TOLERANCE):
+    """
+    Element-wise distances in meters, computed only as precisely as the normalized score
+    against cutoff needs (see TIERS above): a cheap bound first, nothing more for pairs
+    certainly beyond the cutoff, the chosen tier for the others, and geopy's exact geodesic
+    for the pairs whose score is still uncertain by more than tolerance (those near the
+    cutoff). tier='exact' requests the exact solve for every pair within reach.
+
+    Parameters:
+    - lat1, lng1, lat2, lng2: Broadcastable arrays of points in degrees.
+    - cutoff: Cutoff distance in meters (scalar or broadcastable).
+    - tier: One of TIERS.
+    - tolerance: Largest acceptable error of the normalized score of a pair.
+
+    Returns:
+    - An array of distances with the broadcast shape of the inputs. Pairs beyond the cutoff
+      keep their cheap estimate.
+    """
+    if tier not in TIERS:
+        raise ValueError(f"Unknown distance tier: {tier}")
+    lat1, lng1, lat2, lng2, cutoff = np.broadcast_arrays(
+        *(np.asarray(value, dtype=float) for value in (lat1, lng1, lat2, lng2, cutoff)))
+    result, error = bounds(lat1, lng1, lat2, lng2)
+    active = result * (1 - error) - ABSOLUTE_ERROR <= cutoff
+    metrics.count('distance.pruned', int(result.size - active.sum()))
+
+    if tier != 'equirectangular' and active.any():
+        result[active] = tier_distances(tier, lat1[active], lng1[active], lat2[active], lng2[active])
+        error[active] = relative_error(tier, result[active])
+
+    if tier != 'exact':
+        uncertain = active & (score_uncertainty(result, error, cutoff) > tolerance)
+        if uncertain.any():
+            result[uncertain] = exact(lat1[uncertain], lng1[uncertain], lat2[uncertain], lng2[uncertain])
+    return result
+
+
+def pair_equirectangular(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    w = 1 - WGS84_E2 * math.sin((phi1 + phi2) / 2) ** 2
+    dlng = (math.radians(lng2 - lng1) + math.pi) % (2 * math.pi) - math.pi
+    return math.hypot(scoring.WGS84_A * (1 - WGS84_E2) / w ** 1.5 * (phi2 - phi1),
+                      scoring.WGS84_A / math.sqrt(w) * math.cos((phi1 + phi2) / 2) * dlng)
+
+
+def pair_haversine(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    h = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(max(h, 0.0), 1.0)))
+
+
+def pair_ellipsoidal(lat1, lng1, lat2, lng2):
+    """
+    Scalar scoring.andoyer_distance(), without the NumPy overhead on single values.
+    """
+    f = scoring.WGS84_F
+    beta1 = math.atan((1 - f) * math.tan(math.radians(lat1)))
+    beta2 = math.atan((1 - f) * math.tan(math.radians(lat2)))
+    h = math.sin((beta2 - beta1) / 2) ** 2 + math.cos(beta1) * math.cos(beta2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    sigma = 2 * math.asin(math.sqrt(min(max(h, 0.0), 1.0)))
+    if sigma == 0:
+        return 0.0
+    p, q = (beta1 + beta2) / 2, (beta2 - beta1) / 2
+    x = (sigma - math.sin(sigma)) * math.sin(p) ** 2 * math.cos(q) ** 2 / math.cos(sigma / 2) ** 2
+    y = (sigma + math.sin(sigma)) * math.cos(p) ** 2 * math.sin(q) ** 2 / math.sin(sigma / 2) ** 2
+    return scoring.WGS84_A * (sigma - f / 2 * (x + y))
+
+
+def pair_exact(lat1, lng1, lat2, lng2):
+    metrics.count('distance.exact')
+    with metrics.timer('distance.geodesic'):
+        return geopy_distance.geodesic((lat1, lng1), (lat2, lng2)).meters
+
+
+PAIR_TIERS = {
+    'equirectangular': pair_equirectangular,
+    'haversine': pair_haversine,
+    'ellipsoidal': pair_ellipsoidal,
+    'exact': pair_exact
+}
+
+
+def pair_score(distance, cutoff):
+    return 0.0 if distance > cutoff else math.sqrt(max(1 - (distance / cutoff) ** 2, 0.0))
+
+
+def pair_distance(point1, point2, cutoff, tier=DEFAULT_TIER, tolerance=SCORE_TOLERANCE):
+    """
+    tiered_distances() for a single pair of (latitude, longitude) points, in plain math
+    (the per-office path of mongo.best_office_location).
+    """
+    if tier not in PAIR_TIERS:
+        raise ValueError(f"Unknown distance tier: {tier}")
+    lat1, lng1 = point1
+    lat2, lng2 = point2
+    estimate = pair_equirectangular(lat1, lng1, lat2, lng2)
+    if estimate > EQUIRECTANGULAR_RANGE or max(abs(lat1), abs(lat2)) > MAX_LATITUDE:
+        estimate, error = pair_haversine(lat1, lng1, lat2, lng2), HAVERSINE_ERROR
+    else:
+        error = 1e-7 + 2 * (estimate / EARTH_RADIUS) ** 2
+    if estimate * (1 - error) - ABSOLUTE_ERROR > cutoff:
+        metrics.count('distance.pruned')
+        return estimate
+
+    if tier != 'equirectangular':
+        estimate = PAIR_TIERS[tier](lat1, lng1, lat2, lng2)
+        error = {'haversine': HAVERSINE_ERROR, 'ellipsoidal': ELLIPSOIDAL_ERROR}.get(tier, 0.0)
+    if tier != 'exact':
+        uncertainty = pair_score(max(estimate * (1 - error) - ABSOLUTE_ERROR, 0.0), cutoff) - \
+            pair_score(estimate * (1 + error) + ABSOLUTE_ERROR, cutoff)
+        if uncertainty > tolerance:
+            return pair_exact(lat1, lng1, lat2, lng2)
+    return estimate
+
+
+def candidate_threshold(best_upper):
+    """
+    Largest equirectangular estimate whose lower bound can still be below best_upper: the
+    estimates above it are certainly farther than the venue that gave best_upper.
+    """
+    reach = 2 * best_upper + 1  # the threshold is below this, and the error bound grows with distance
+    return (best_upper + ABSOLUTE_ERROR) / (1 - relative_error('equirectangular', reach))
+
+
+def nearest_distances(office_coords, venue_coords, cutoff, tier=DEFAULT_TIER, tolerance=SCORE_TOLERANCE):
+    """
+    Tiered version of scoring.nearest_distances(): the nearest venue is found on the cheap
+    equirectangular estimate, and only the candidates that could still be nearest (their
+    lower bound is below the best upper bound) are evaluated with tiered_distances().
+
+    Parameters:
+    - office_coords, venue_coords: (n, 2) and (m, 2) arrays of [longitude, latitude].
+    - cutoff: Cutoff of the category in meters.
+    - tier, tolerance: See tiered_distances().
+
+    Returns:
+    - An (n,) array of distances in meters, inf when there are no venues.
+    """
+    office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+    venue_coords = np.asarray(venue_coords, dtype=float).reshape(-1, 2)
+    nearest = np.full(len(office_coords), np.inf)
+    if not len(venue_coords) or not len(office_coords):
+        return nearest
+
+    block_size = scoring.venue_block(len(office_coords))
+
+    def estimates(start):
+        block = venue_coords[start:start + block_size]
+        return equirectangular(office_coords[:, 1, None], office_coords[:, 0, None], block[None, :, 1], block[None, :, 0])
+
+    starts = range(0, len(venue_coords), block_size)
+    cached = estimates(0) if len(starts) == 1 else None
+    best = np.full(len(office_coords), np.inf)
+    for start in starts:
+        np.minimum(best, (estimates(start) if cached is None else cached).min(axis=1), out=best)
+
+    in_domain = max(np.abs(office_coords[:, 1]).max(), np.abs(venue_coords[:, 1]).max()) <= MAX_LATITUDE and \
+        best.max() <= EQUIRECTANGULAR_RANGE / 2
+    if not in_domain:
+        # Far or polar pairs: every pair goes through tiered_distances (haversine bounds)
+        for start in starts:
+            block = venue_coords[start:start + block_size]
+            distances = tiered_distances(office_coords[:, 1, None], office_coords[:, 0, None], block[None, :, 1],
+                                         block[None, :, 0], cutoff, tier, tolerance)
+            np.minimum(nearest, distances.min(axis=1), out=nearest)
+        return nearest
+
+    threshold = candidate_threshold(best * (1 + relative_error('equirectangular', best)))
+    offices, venues = [], []
+    for start in starts:
+        rows, columns = np.nonzero((estimates(start) if cached is None else cached) <= threshold[:, None])
+        offices.append(rows)
+        venues.append(columns + start)
+    offices, venues = np.concatenate(offices), np.concatenate(venues)
+    metrics.count('distance.candidates', len(offices))
+
+    distances = tiered_distances(office_coords[offices, 1], office_coords[offices, 0],
+                                 venue_coords[venues, 1], venue_coords[venues, 0], cutoff, tier, tolerance)
+    np.minimum.at(nearest, offices, distances)
+    return nearest
+
+
+def score_offices(office_coords, venues_by_type, weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE,
+                  tier=DEFAULT_TIER, tolerance=SCORE_TOLERANCE):
+    """
+    Tiered version of scoring.score_offices(), with the same arguments plus tier and tolerance.
+    """
+    office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+    scores = np.zeros(len(office_coords))
+    for venue_type, weight in weights.items():
+        venue_coords = venues_by_type.get(venue_type)
+        if venue_coords is None or len(venue_coords) == 0:
+            continue
+        cutoff = max_distance.get(venue_type, scoring.DEFAULT_MAX_DISTANCE)
+        distances = nearest_distances(office_coords, venue_coords, cutoff, tier, tolerance)
+        scores += scoring.normalized_scores(distances, cutoff) * weight
+    return scores
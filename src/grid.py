@@ -0,0 +1,268 @@
+import os
+import json
+import math
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from . import distance as tiers
+from . import network as street_network
+from . import scoring
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+folium = lazy_module('folium')
+folium_plugins = lazy_module('folium.plugins')
+
+
+# (south, west, north, east) of San Francisco
+SAN_FRANCISCO_BBOX = (37.7081, -122.5149, 37.8324, -122.3570)
+SPACING = 50  # meters between lattice points
+CELLS_PER_CHUNK = 8192
+METERS_PER_DEGREE = 111320.0
+
+# Venue arrays and scoring model shared with the worker processes (set by init_worker)
+worker_state = {}
+
+
+def lattice_axes(bbox, spacing=SPACING):
+    """
+    Latitudes and longitudes of a regular lattice over a bounding box.
+
+    Parameters:
+    - bbox: (south, west, north, east) in degrees.
+    - spacing: Distance between neighbouring points in meters (longitude step taken at the
+      box's middle latitude).
+
+    Returns:
+    - A tuple (lats, lngs) of 1D NumPy arrays; the lattice is their outer product.
+    """
+    south, west, north, east = bbox
+    dlat = spacing / METERS_PER_DEGREE
+    dlng = spacing / (METERS_PER_DEGREE * math.cos(math.radians((south + north) / 2)))
+    lats = south + dlat * np.arange(int(math.floor((north - south) / dlat)) + 1)
+    lngs = west + dlng * np.arange(int(math.floor((east - west) / dlng)) + 1)
+    return lats, lngs
+
+
+def init_worker(venues, weights, max_distance, lats, lngs, raster_path, network=None, tier=None):
+    worker_state.update(venues=venues, weights=weights, max_distance=max_distance,
+                        lats=lats, lngs=lngs, raster_path=raster_path, network=network, tier=tier)
+
+
+def score_rows(task):
+    """
+    Score the lattice rows [row_start, row_end) and return their top-N cells.
+
+    Runs in a worker process. Scores are written straight into the shared raster file, so
+    only the chunk's best cells travel back to the parent.
+    """
+    row_start, row_end, top_n = task
+    lats, lngs = worker_state['lats'], worker_state['lngs']
+
+    lat_block = np.repeat(lats[row_start:row_end], len(lngs))
+    lng_block = np.tile(lngs, row_end - row_start)
+    if worker_state['network']:
+        graph, distances_by_type = worker_state['network']
+        venue_types = list(worker_state['weights'])
+        distances = street_network.office_distances(graph, distances_by_type, np.column_stack([lng_block, lat_block]),
+                                                    venue_types)
+        scores = scoring.score_distances(distances, venue_types, worker_state['weights'], worker_state['max_distance'])
+    elif worker_state['tier']:
+        scores = tiers.score_offices(np.column_stack([lng_block, lat_block]), worker_state['venues'],
+                                     worker_state['weights'], worker_state['max_distance'], worker_state['tier'])
+    else:
+        scores = scoring.score_offices(np.column_stack([lng_block, lat_block]), worker_state['venues'],
+                                       worker_state['weights'], worker_state['max_distance'])
+    scores = scores.astype(np.float32).reshape(row_end - row_start, len(lngs))
+
+    if worker_state['raster_path']:
+        raster = np.load(worker_state['raster_path'], mmap_mode='r+')
+        raster[row_start:row_end] = scores
+        raster.flush()
+        del raster
+
+    flat = scores.ravel()
+    best = np.argpartition(-flat, min(top_n, flat.size) - 1)[:top_n] if flat.size > top_n else np.arange(flat.size)
+    top = [(float(flat[i]), row_start + int(i) // len(lngs), int(i) % len(lngs)) for i in best]
+
+    return top, float(flat.sum()), float(flat.max()), int(flat.size)
+
+
+def grid_search(venues_by_type, bbox=SAN_FRANCISCO_BBOX, spacing=SPACING, top_n=20, workers=None,
+                raster_path=None, weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE,
+                cells_per_chunk=CELLS_PER_CHUNK, network=None, tier=None):
+    """
+    Evaluate the WEIGHTS/MAX_DISTANCE model on every point of a regular lattice over a city.
+
+    The lattice is never materialized: it is split into chunks of whole rows that are scored
+    in worker processes, each chunk writes its rows into a memory-mapped .npy raster and
+    returns only its best cells. Memory therefore does not grow with the grid: each worker
+    peaks around 300 MB, the distance temporaries of one scoring.PAIR_BLOCK block of
+    cells x venues, plus its chunk of cells_per_chunk scores.
+
+    Parameters:
+    - venues_by_type: Dict mapping venue type to its venue DataFrame or (m, 2) [lng, lat] array.
+    - bbox: (south, west, north, east) of the area to search.
+    - spacing: Lattice spacing in meters.
+    - top_n: Number of best cells to return.
+    - workers: Worker processes. None uses every CPU; 1 scores in-process.
+    - raster_path: Optional .npy file receiving the full (rows, cols) float32 score raster.
+    - weights, max_distance: Scoring model, as in scoring.score_offices().
+    - cells_per_chunk: Approximate number of cells scored per task.
+    - network: Optional (network.StreetGraph, node distances by venue type from
+      network.precompute()) to score with street-network distances: each cell is snapped to
+      its nearest node instead of searching the venues.
+    - tier: Optional distance tier (see distance.TIERS) to score on tiered distances.
+
+    Returns:
+    - A dict with 'bbox', 'spacing', 'shape', 'lats', 'lngs', 'raster_path', 'max_score',
+      'mean_score' and 'top' (list of dicts with 'score', 'Lat', 'Lng', 'row', 'col', best first).
+    """
+    venues = {venue_type: venues if isinstance(venues, np.ndarray) else scoring.venue_arrays({venue_type: venues})[venue_type]
+              for venue_type, venues in venues_by_type.items()}
+    lats, lngs = lattice_axes(bbox, spacing)
+    shape = (len(lats), len(lngs))
+
+    if raster_path:
+        os.makedirs(os.path.dirname(os.path.abspath(raster_path)), exist_ok=True)
+        np.lib.format.open_memmap(raster_path, mode='w+', dtype=np.float32, shape=shape).flush()
+
+    rows_per_chunk = max(1, cells_per_chunk // max(len(lngs), 1))
+    tasks = [(start, min(start + rows_per_chunk, shape[0]), top_n) for start in range(0, shape[0], rows_per_chunk)]
+
+    workers = workers or os.cpu_count() or 1
+    init_args = (venues, weights, max_distance, lats, lngs, raster_path, network, tier)
+
+    top = []
+    total = 0.0
+    max_score = 0.0
+    count = 0
+
+    def collect(result):
+        nonlocal top, total, max_score, count
+        chunk_top, chunk_sum, chunk_max, chunk_count = result
+        top = heapq.nlargest(top_n, top + chunk_top)
+        total += chunk_sum
+        max_score = max(max_score, chunk_max)
+        count += chunk_count
+
+    if workers == 1:
+        init_worker(*init_args)
+        for task in tasks:
+            collect(score_rows(task))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=init_args) as executor:
+            # Keep a bounded number of chunks in flight so results never pile up in memory
+            pending = []
+            for task in tasks:
+                pending.append(executor.submit(score_rows, task))
+                if len(pending) >= 2 * workers:
+                    collect(pending.pop(0).result())
+            for future in pending:
+                collect(future.result())
+
+    if raster_path:
+        with open(raster_path + '.json', 'w') as file:
+            json.dump({'bbox': list(bbox), 'spacing': spacing, 'shape': list(shape),
+                       'lat0': float(lats[0]), 'lng0': float(lngs[0]),
+                       'dlat': float(lats[1] - lats[0]) if len(lats) > 1 else 0.0,
+                       'dlng': float(lngs[1] - lngs[0]) if len(lngs) > 1 else 0.0}, file)
+
+    return {
+        'bbox': bbox,
+        'spacing': spacing,
+        'shape': shape,
+        'lats': lats,
+        'lngs': lngs,
+        'raster_path': raster_path,
+        'max_score': max_score,
+        'mean_score': total / count if count else 0.0,
+        'top': [{'score': round(score, 4), 'Lat': float(lats[row]), 'Lng': float(lngs[col]), 'row': row, 'col': col}
+                for score, row, col in top]
+    }
+
+
+def load_raster(raster_path):
+    """
+    Open a score raster written by grid_search() read-only via memory mapping.
+
+    Returns:
+    - A tuple (raster, metadata).
+    """
+    with open(raster_path + '.json', 'r') as file:
+        metadata = json.load(file)
+    return np.load(raster_path, mmap_mode='r'), metadata
+
+
+def write_geojson(result, geojson_path, min_score=0.0, stride=1):
+    """
+    Stream the score raster of a grid_search() result to a GeoJSON FeatureCollection of points.
+
+    Rows are read one at a time from the memory-mapped raster, so the file can be larger
+    than memory.
+
+    Parameters:
+    - result: Dict returned by grid_search() (with a raster_path).
+    - geojson_path: Output file.
+    - min_score: Skip cells scoring below this value.
+    - stride: Keep every stride-th row and column.
+
+    Returns:
+    - The number of features written.
+    """
+    raster, _ = load_raster(result['raster_path'])
+    lats, lngs = result['lats'], result['lngs']
+    written = 0
+
+    with open(geojson_path, 'w') as file:
+        file.write('{"type": "FeatureCollection", "features": [')
+        for row in range(0, raster.shape[0], stride):
+            values = np.asarray(raster[row, ::stride])
+            for col in np.flatnonzero(values >= min_score):
+                feature = {'type': 'Feature',
+                           'geometry': {'type': 'Point', 'coordinates': [round(float(lngs[col * stride]), 6), round(float(lats[row]), 6)]},
+                           'properties': {'score': round(float(values[col]), 4)}}
+                file.write((',' if written else '') + json.dumps(feature))
+                written += 1
+        file.write(']}')
+
+    return written
+
+
+def heatmap_layer(result, max_points=20000, min_score=0.01, name='Suitability'):
+    """
+    Build a folium HeatMap layer from a grid_search() result, subsampling the raster so the
+    layer holds at most about max_points points.
+    """
+    raster, _ = load_raster(result['raster_path'])
+    lats, lngs = result['lats'], result['lngs']
+    stride = max(1, int(math.ceil(math.sqrt(raster.size / max_points))))
+
+    points = []
+    for row in range(0, raster.shape[0], stride):
+        values = np.asarray(raster[row, ::stride])
+        for col in np.flatnonzero(values >= min_score):
+            points.append([float(lats[row]), float(lngs[col * stride]), float(values[col])])
+
+    return folium_plugins.HeatMap(points, name=name, radius=max(8, 2 * stride), blur=15,
+                                  max_zoom=16, min_opacity=0.2)
+
+
+def render_heatmap(result, map_file, top_markers=10):
+    """
+    Save a folium map with the suitability heatmap and markers on the best cells.
+    """
+    south, west, north, east = result['bbox']
+    suitability_map = folium.Map(location=[(south + north) / 2, (west + east) / 2], zoom_start=13)
+    heatmap_layer(result).add_to(suitability_map)
+
+    for position, cell in enumerate(result['top'][:top_markers], start=1):
+        folium.Marker(
+            location=[cell['Lat'], cell['Lng']],
+            popup=f"#{position} - Score: {cell['score']:.2f}",
+            tooltip=f"#{position}",
+            icon=folium.Icon(color='red', icon='star')
+        ).add_to(suitability_map)
+
+    folium.LayerControl().add_to(suitability_map)
+    suitability_map.save(map_file)
+    return map_file
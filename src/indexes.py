@@ -0,0 +1,165 @@
+from . import mongo
+
+
+# Indexes the Companies queries need. Equality fields come before range fields, and each index
+# holds at most one array field (offices[] or funding_rounds[]), as MongoDB requires for
+# compound multikey indexes.
+COMPANIES_INDEXES = [
+    {
+        'name': 'category_city_employees',
+        'keys': [('category_code', 1), ('offices.city', 1), ('number_of_employees', 1)],
+        'used_by': 'find_offices_by_criteria, gaming/design_web_startup_finder'
+    },
+    {
+        'name': 'category_funding',
+        'keys': [('category_code', 1), ('funding_rounds.raised_amount', 1)],
+        'used_by': 'count_offices_by_condition(s)'
+    },
+    {
+        'name': 'offices_city',
+        'keys': [('offices.city', 1)],
+        'used_by': 'city lookups without a category'
+    }
+]
+
+
+def ensure_indexes(collection, specs=COMPANIES_INDEXES):
+    """
+    Create the declared indexes that do not exist yet.
+
+    Parameters:
+    - collection: MongoDB collection (normally Companies).
+    - specs: List of dicts with 'name' and 'keys'.
+
+    Returns:
+    - A dict mapping each index name to 'created' or 'exists'.
+    """
+    existing = {tuple(info['key']) for info in collection.index_information().values()}
+    status = {}
+    for spec in specs:
+        if tuple(spec['keys']) in existing:
+            status[spec['name']] = 'exists'
+            continue
+        collection.create_index(spec['keys'], name=spec['name'])
+        status[spec['name']] = 'created'
+    return status
+
+
+def walk_plan(stage):
+    """
+    Yield every stage of a query-plan tree (inputStage/inputStages), root first.
+    """
+    if not stage:
+        return
+    yield stage
+    if 'inputStage' in stage:
+        yield from walk_plan(stage['inputStage'])
+    for child in stage.get('inputStages', []):
+        yield from walk_plan(child)
+    for key in ('queryPlan', 'thenStage', 'elseStage', 'innerStage', 'outerStage'):
+        if key in stage:
+            yield from walk_plan(stage[key])
+
+
+def find_execution_stats(explain):
+    """
+    Locate the executionStats of the query layer in an aggregate explain, whether the
+    pipeline was pushed into the query layer entirely or runs behind a $cursor stage.
+    """
+    if 'executionStats' in explain:
+        return explain['executionStats']
+    for stage in explain.get('stages', []):
+        if '$cursor' in stage and 'executionStats' in stage['$cursor']:
+            return stage['$cursor']['executionStats']
+    for shard in explain.get('shards', {}).values():
+        stats = find_execution_stats(shard)
+        if stats:
+            return stats
+    return {}
+
+
+def explain_pipeline(collection, pipeline_stages):
+    """
+    Run an aggregation under explain('executionStats') and summarize its plan.
+
+    Returns:
+    - A dict with 'collscan' (True if any COLLSCAN was used), 'plan' (one entry per plan
+      stage with docs/keys examined and documents returned), 'pipeline' (documents returned
+      per aggregation stage when reported) and the totals 'docs_examined', 'keys_examined'
+      and 'returned'.
+    """
+    explain = collection.database.command(
+        'explain', {'aggregate': collection.name, 'pipeline': pipeline_stages, 'cursor': {}},
+        verbosity='executionStats'
+    )
+    stats = find_execution_stats(explain)
+
+    plan = [
+        {
+            'stage': stage.get('stage'),
+            'index': stage.get('indexName'),
+            'docs_examined': stage.get('docsExamined'),
+            'keys_examined': stage.get('keysExamined'),
+            'returned': stage.get('nReturned')
+        }
+        for stage in walk_plan(stats.get('executionStages', {}))
+    ]
+
+    pipeline_report = []
+    for stage in explain.get('stages', []):
+        name = next((key for key in stage if key.startswith('$')), None)
+        pipeline_report.append({'stage': name, 'returned': stage.get('nReturned')})
+
+    return {
+        'collscan': any(entry['stage'] == 'COLLSCAN' for entry in plan),
+        'plan': plan,
+        'pipeline': pipeline_report,
+        'docs_examined': stats.get('totalDocsExamined'),
+        'keys_examined': stats.get('totalKeysExamined'),
+        'returned': stats.get('nReturned')
+    }
+
+
+def companies_queries(city, min_employees, max_employees, conditions=None):
+    """
+    The aggregation pipelines the pipeline runs against Companies, by name.
+
+    Parameters:
+    - city, min_employees, max_employees: Arguments of the finder functions.
+    - conditions: Optional dict of named (condition1, condition2) pairs for the office counts,
+      e.g. pipeline.CONDITIONS.
+    """
+    queries = {
+        'find_offices_by_criteria': mongo.offices_by_criteria_pipeline(city, min_employees, max_employees),
+        'gaming_startup_finder': mongo.gaming_startup_pipeline(city),
+        'design_web_startup_finder': mongo.design_web_startup_pipeline(city)
+    }
+    for name, (condition1, condition2) in (conditions or {}).items():
+        queries[f'count_offices ({name})'] = mongo.office_count_stages({"$and": [condition1, condition2]})
+    return queries
+
+
+def explain_report(collection, queries):
+    """
+    Explain every query of a companies_queries() dict and return the summaries by query name.
+    """
+    return {name: explain_pipeline(collection, stages) for name, stages in queries.items()}
+
+
+def format_report(report):
+    """
+    Render explain_report() as text, flagging collection scans.
+    """
+    lines = []
+    for name, summary in report.items():
+        flag = 'COLLSCAN' if summary['collscan'] else 'ok'
+        lines.append(f"{name}: [{flag}] docs examined {summary['docs_examined']}, "
+                     f"keys examined {summary['keys_examined']}, returned {summary['returned']}")
+        for entry in summary['plan']:
+            index = f" ({entry['index']})" if entry['index'] else ''
+            lines.append(f"    {entry['stage']}{index}: docs {entry['docs_examined']}, "
+                         f"keys {entry['keys_examined']}, returned {entry['returned']}")
+        for entry in summary['pipeline']:
+            if entry['stage'] != '$cursor' and entry['returned'] is not None:
+                lines.append(f"    {entry['stage']}: returned {entry['returned']}")
+    return '\n'.join(lines)
@@ -0,0 +1,33 @@
+import importlib
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is only imported on first attribute access.
+
+    Keeps `import src.mongo` and friends cheap: pandas, numpy, folium, geopy and the
+    database/HTTP clients are loaded when a function actually needs them.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_module(name):
+    """
+    Return a LazyModule for `name`, e.g. pd = lazy_module('pandas').
+    """
+    return LazyModule(name)
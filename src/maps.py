@@ -0,0 +1,191 @@
+import os
+from . import metrics
+from . import scoring
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+folium = lazy_module('folium')
+folium_plugins = lazy_module('folium.plugins')
+
+
+RADIUS = 4000  # venues farther than this from the office are left out (airports are always shown)
+ALWAYS_SHOWN = ('airport',)
+# Venue collections that are scored but not drawn: the original map never showed the vegan
+# restaurants, so neither renderer has a style for them
+HIDDEN = ('df_vegan',)
+RINGS = ((1000, 'red', '1 km radius'), (2000, 'orange', '2 km radius'), (3500, 'pink', '3.5 km radius'))
+
+# Same colors/icons as final_location, with the hex value of each folium color for the
+# circle markers of the fast layers
+CATEGORY_STYLES = {
+    'school': ('green', 'graduation-cap', '#72b026'),
+    'airport': ('cadetblue', 'plane', '#436978'),
+    'bar': ('blue', 'beer', '#38aadd'),
+    'basketball stadium': ('orange', 'bullseye', '#f69730'),
+    'night club': ('red', 'star', '#d63e2a'),
+    'design talks': ('purple', 'thumb-tack', '#d252b9'),
+    'ferry': ('darkblue', 'ship', '#0067a3'),
+    'pet grooming': ('brown', 'paw', '#a0522d'),
+    'starbucks': ('darkgreen', 'coffee', '#728224'),
+    'train station': ('lightblue', 'train', '#8adaff')
+}
+DEFAULT_STYLE = ('gray', 'flag', '#575757')
+
+CLUSTER_CALLBACK = """
+function callback(row) {
+    return L.circleMarker([row[0], row[1]], {radius: 6, color: '%s', weight: 1, fillOpacity: 0.8})
+        .bindTooltip(row[2]);
+}
+"""
+
+
+def venue_table(venues_by_type):
+    """
+    Concatenate the venue DataFrames into one table with the Lat/Lng columns as float arrays,
+    dropping venues without coordinates and the HIDDEN collections.
+    """
+    frames = [df[['name', 'Lat', 'Lng', 'category']] for venue_type, df in venues_by_type.items()
+              if venue_type not in HIDDEN and not df.empty]
+    if not frames:
+        return pd.DataFrame(columns=['name', 'Lat', 'Lng', 'category'])
+    all_venues = pd.concat(frames, ignore_index=True)
+    all_venues = all_venues.dropna(subset=['Lat', 'Lng'])
+    return all_venues.astype({'Lat': float, 'Lng': float}).reset_index(drop=True)
+
+
+def visible_mask(all_venues, distances, radius=RADIUS, always_shown=ALWAYS_SHOWN):
+    """
+    Boolean mask of the venues within radius (distances from scoring.distance_matrix, one
+    row per office or a single row), plus the always_shown categories.
+    """
+    always = all_venues['category'].isin(always_shown).to_numpy()
+    return (distances <= radius) | always
+
+
+def category_layer(venues, category, layer='cluster'):
+    """
+    One layer with every venue of a category: a FastMarkerCluster whose markers are built in
+    the browser from a compact [lat, lng, name] array, or a GeoJSON layer of circle markers.
+    """
+    color = CATEGORY_STYLES.get(category, DEFAULT_STYLE)[2]
+    names = (venues['name'].astype(str) + f' ({category})').tolist()
+    lats = venues['Lat'].round(6).tolist()
+    lngs = venues['Lng'].round(6).tolist()
+
+    if layer == 'geojson':
+        features = [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lng, lat]}, 'properties': {'name': name}}
+            for lat, lng, name in zip(lats, lngs, names)
+        ]
+        return folium.GeoJson(
+            {'type': 'FeatureCollection', 'features': features},
+            name=category,
+            marker=folium.CircleMarker(radius=6, color=color, weight=1, fill=True, fill_opacity=0.8),
+            tooltip=folium.GeoJsonTooltip(fields=['name'], labels=False)
+        )
+
+    return folium_plugins.FastMarkerCluster(
+        [[lat, lng, name] for lat, lng, name in zip(lats, lngs, names)],
+        callback=CLUSTER_CALLBACK % color,
+        name=category,
+        disableClusteringAtZoom=16
+    )
+
+
+def office_map(office, venues, layer='cluster'):
+    """
+    Build the folium map of one office: its marker, the 1/2/3.5 km rings and one layer per
+    venue category.
+
+    Parameters:
+    - office: Entry of an office_scores list ('office', 'score', 'location' as [lng, lat]).
+    - venues: Venue table (see venue_table) already filtered to what should be drawn.
+    - layer: 'cluster' (FastMarkerCluster) or 'geojson'.
+    """
+    office_location = [office['location'][1], office['location'][0]]
+    result = folium.Map(location=office_location, zoom_start=15)
+
+    folium.Marker(
+        location=office_location,
+        popup=f"{office['office']} - Score: {office['score']:.2f}",
+        tooltip=office['office'],
+        icon=folium.Icon(color='red', icon='star')
+    ).add_to(result)
+
+    for radius, color, popup in RINGS:
+        folium.Circle(location=office_location, radius=radius, color=color, fill=True, fill_color=color,
+                      fill_opacity=0.1, popup=popup).add_to(result)
+
+    for category, group in venues.groupby('category', sort=True):
+        category_layer(group, category, layer).add_to(result)
+
+    folium.LayerControl().add_to(result)
+    return result
+
+
+def render_office_map(office, venues_by_type, map_file, radius=RADIUS, layer='cluster'):
+    """
+    Headless version of final_location for one office: venues are filtered to radius with
+    one vectorized distance computation and drawn as one layer per category, so the HTML
+    stays small as venue counts grow. Never opens a browser.
+
+    Returns:
+    - map_file.
+    """
+    all_venues = venue_table(venues_by_type)
+    lng, lat = office['location']
+    distances = scoring.distance_matrix([lat], [lng], all_venues['Lat'].to_numpy(), all_venues['Lng'].to_numpy())[0]
+    venues = all_venues[visible_mask(all_venues, distances, radius)]
+
+    with metrics.timer('folium.render'):
+        office_map(office, venues, layer).save(ensure_directory(map_file))
+    return map_file
+
+
+def office_file_name(position, office):
+    slug = ''.join(ch if ch.isalnum() else '_' for ch in str(office['office']).lower()).strip('_')
+    return f"{position:03d}-{slug[:60] or 'office'}.html"
+
+
+def render_office_maps(office_scores, venues_by_type, directory='./maps/offices', top=None, radius=RADIUS,
+                       layer='cluster'):
+    """
+    Render one map per office (best first) into directory. The venue table is built once
+    and the office-to-venue distances are computed in blocks of offices.
+
+    Parameters:
+    - office_scores: Ranked list returned by best_office_location().
+    - venues_by_type: Dict mapping venue collection name to its venue DataFrame.
+    - directory: Output directory; files are named {rank}-{office}.html.
+    - top: Only render the first top offices.
+    - radius, layer: As in render_office_map.
+
+    Returns:
+    - The list of written file paths, in ranking order.
+    """
+    offices = office_scores[:top] if top else office_scores
+    all_venues = venue_table(venues_by_type)
+    venue_lat = all_venues['Lat'].to_numpy()
+    venue_lng = all_venues['Lng'].to_numpy()
+    os.makedirs(directory, exist_ok=True)
+
+    paths = []
+    block = max(1, scoring.VENUE_BLOCK * 64 // max(len(all_venues), 1))
+    for start in range(0, len(offices), block):
+        chunk = offices[start:start + block]
+        coords = np.array([office['location'] for office in chunk], dtype=float)
+        distances = scoring.distance_matrix(coords[:, 1], coords[:, 0], venue_lat, venue_lng)
+        masks = visible_mask(all_venues, distances, radius)
+        for offset, (office, mask) in enumerate(zip(chunk, masks)):
+            map_file = os.path.join(directory, office_file_name(start + offset + 1, office))
+            with metrics.timer('folium.render'):
+                office_map(office, all_venues[mask], layer).save(map_file)
+            paths.append(map_file)
+    return paths
+
+
+def ensure_directory(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    return path
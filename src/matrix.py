@@ -0,0 +1,245 @@
+import json
+import time
+import hashlib
+from . import metrics
+from . import mongo
+from . import scoring
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+pymongo = lazy_module('pymongo')
+
+
+# Materialized nearest-venue distances: one document per (offices collection, office) with
+# the distance to the nearest venue of every category, stamped with the version of the
+# office and of each category's venues it was computed from.
+MATRIX_COLLECTION = 'office_distances'
+
+
+def office_version(name, coordinates):
+    """
+    Version stamp of an office: a checksum of its name and position. Offices are reinserted
+    by insert_offices_data_create_index(), so their _id is not stable across runs.
+    """
+    payload = json.dumps([name, [float(value) for value in coordinates]])
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def category_version(venue_coords):
+    """
+    Version stamp of a venue category: a checksum of its sorted venue positions, so it only
+    changes when a venue is added, removed or moved.
+    """
+    coords = np.asarray(venue_coords, dtype=float).reshape(-1, 2)
+    if len(coords):
+        coords = coords[np.lexsort((coords[:, 1], coords[:, 0]))]
+    return hashlib.sha1(np.ascontiguousarray(coords).tobytes()).hexdigest()
+
+
+def ensure_matrix_indexes(collection):
+    collection.create_index([('offices_collection', 1), ('office_version', 1)], unique=True)
+
+
+def row_operation(offices_collection, key, name, coordinates, distances, versions, now):
+    """
+    Upsert of the matrix cells of one office.
+
+    Parameters:
+    - key: office_version() of the office.
+    - distances: Dict mapping venue type to the nearest-venue distance (inf when the category
+      has no venues, stored as None).
+    - versions: Dict mapping venue type to the category_version() the distance was computed on.
+    """
+    update = {}
+    for venue_type, value in distances.items():
+        value = float(value)
+        update[f'distances.{venue_type}'] = value if np.isfinite(value) else None
+        update[f'versions.{venue_type}'] = versions[venue_type]
+    update.update({'name': name, 'location': [float(coordinates[0]), float(coordinates[1])], 'updated': now})
+    return pymongo.UpdateOne({'offices_collection': offices_collection, 'office_version': key}, {'$set': update},
+                             upsert=True)
+
+
+def update_rows(db, offices_collection, offices, venues_by_type, versions=None, matrix_collection=MATRIX_COLLECTION):
+    """
+    Compute and store the whole matrix row of a few offices, e.g. the offices a change
+    stream just added, without touching the other rows.
+
+    Parameters:
+    - offices: List of (name, [longitude, latitude]) tuples.
+    - venues_by_type: Dict mapping venue type to an (m, 2) array of [longitude, latitude].
+    - versions: category_version() of each type, when the caller already has them.
+
+    Returns:
+    - A tuple (keys, distances): the office_version() of each office and its (n, k)
+      nearest-venue distances, columns in the order of venues_by_type.
+    """
+    venue_types = list(venues_by_type)
+    if versions is None:
+        versions = {venue_type: category_version(coords) for venue_type, coords in venues_by_type.items()}
+    keys = [office_version(name, coordinates) for name, coordinates in offices]
+    coords = np.array([coordinates for _, coordinates in offices], dtype=float).reshape(-1, 2)
+    distances = np.empty((len(offices), len(venue_types)))
+    for column, venue_type in enumerate(venue_types):
+        distances[:, column] = scoring.nearest_distances(coords, venues_by_type[venue_type])
+
+    now = time.time()
+    operations = [row_operation(offices_collection, key, name, coordinates, dict(zip(venue_types, row)), versions, now)
+                  for key, (name, coordinates), row in zip(keys, offices, distances)]
+    if operations:
+        collection = db[matrix_collection]
+        ensure_matrix_indexes(collection)
+        collection.bulk_write(operations, ordered=False)
+    metrics.count('matrix.cells_computed', distances.size)
+    return keys, distances
+
+
+def delete_rows(db, offices_collection, keys, matrix_collection=MATRIX_COLLECTION):
+    """
+    Delete the matrix rows of the given office_version() keys. Returns the number deleted.
+    """
+    if not keys:
+        return 0
+    result = db[matrix_collection].delete_many({'offices_collection': offices_collection,
+                                                'office_version': {'$in': list(keys)}})
+    return result.deleted_count
+
+
+def refresh_distance_matrix(db, offices_collection='san_francisco_offices', venue_types=None, venues_collection=None,
+                            matrix_collection=MATRIX_COLLECTION):
+    """
+    Bring the stored distance matrix up to date with the current offices and venues.
+
+    Only stale cells are recomputed: the whole row of a new or moved office, and the column
+    of every category whose venues changed since it was last computed. Rows of offices that
+    no longer exist are deleted.
+
+    Parameters:
+    - db: MongoDB database instance.
+    - offices_collection: Collection holding the offices (with a GeoJSON 'location').
+    - venue_types: Venue categories (columns). Defaults to the keys of scoring.WEIGHTS.
+    - venues_collection: Read the venues from this single collection (see mongo.sync_venues)
+      instead of one df_* collection per type.
+    - matrix_collection: Collection holding the matrix.
+
+    Returns:
+    - A dict with the number of 'offices', recomputed 'rows', recomputed 'columns' (list of
+      venue types), 'cells' computed and stale rows 'deleted'.
+    """
+    if venue_types is None:
+        venue_types = list(scoring.WEIGHTS)
+
+    names, office_coords, venues_by_type = mongo.load_scoring_arrays(db, offices_collection, venue_types, venues_collection)
+    versions = {venue_type: category_version(venues_by_type[venue_type]) for venue_type in venue_types}
+
+    collection = db[matrix_collection]
+    ensure_matrix_indexes(collection)
+    stored = {
+        doc['office_version']: doc.get('versions', {})
+        for doc in collection.find({'offices_collection': offices_collection},
+                                   {'_id': 0, 'office_version': 1, 'versions': 1})
+    }
+
+    # One row per distinct office; duplicate offices (same name and position) share it
+    rows = {}
+    for name, coordinates in zip(names, office_coords):
+        rows.setdefault(office_version(name, coordinates), (name, coordinates))
+    keys = list(rows)
+    coords = np.array([rows[key][1] for key in keys], dtype=float).reshape(-1, 2)
+
+    new_rows = np.array([key not in stored for key in keys], dtype=bool)
+    stale = {
+        venue_type: np.array([key in stored and stored[key].get(venue_type) != versions[venue_type] for key in keys],
+                             dtype=bool)
+        for venue_type in venue_types
+    }
+
+    distances = {}
+    cells = 0
+    for venue_type in venue_types:
+        needed = new_rows | stale[venue_type]
+        if needed.any():
+            distances[venue_type] = np.full(len(keys), np.nan)
+            distances[venue_type][needed] = scoring.nearest_distances(coords[needed], venues_by_type[venue_type])
+            cells += int(needed.sum())
+
+    now = time.time()
+    operations = []
+    for position, key in enumerate(keys):
+        row = {venue_type: column[position] for venue_type, column in distances.items() if not np.isnan(column[position])}
+        if row:
+            operations.append(row_operation(offices_collection, key, *rows[key], row, versions, now))
+
+    removed = [key for key in stored if key not in rows]
+    if removed:
+        operations.append(pymongo.DeleteMany({'offices_collection': offices_collection, 'office_version': {'$in': removed}}))
+
+    deleted = 0
+    if operations:
+        result = collection.bulk_write(operations, ordered=False)
+        deleted = result.deleted_count
+
+    metrics.count('matrix.cells_computed', cells)
+    return {
+        'offices': len(keys),
+        'rows': int(new_rows.sum()),
+        'columns': [venue_type for venue_type in venue_types if stale[venue_type].any()],
+        'cells': cells,
+        'deleted': deleted
+    }
+
+
+def load_distance_matrix(db, offices_collection='san_francisco_offices', venue_types=None,
+                         matrix_collection=MATRIX_COLLECTION):
+    """
+    Load the stored matrix into memory.
+
+    Returns:
+    - A tuple (names, office_coords, distances, venue_types) where office_coords is an (n, 2)
+      array of [longitude, latitude] and distances an (n, k) array (inf for missing cells).
+    """
+    if venue_types is None:
+        venue_types = list(scoring.WEIGHTS)
+
+    names = []
+    office_coords = []
+    rows = []
+    for doc in db[matrix_collection].find({'offices_collection': offices_collection},
+                                          {'_id': 0, 'name': 1, 'location': 1, 'distances': 1}):
+        names.append(doc['name'])
+        office_coords.append(doc['location'])
+        stored = doc.get('distances', {})
+        rows.append([np.inf if stored.get(venue_type) is None else stored[venue_type] for venue_type in venue_types])
+
+    distances = np.array(rows, dtype=float).reshape(-1, len(venue_types))
+    return names, np.array(office_coords, dtype=float).reshape(-1, 2), distances, venue_types
+
+
+def rerank(matrix, weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE):
+    """
+    Rank the offices of a loaded matrix under new weights and cutoffs, purely in memory.
+
+    Parameters:
+    - matrix: Tuple returned by load_distance_matrix().
+    - weights, max_distance: As in scoring.score_offices(). Categories missing from the
+      matrix columns contribute 0.
+
+    Returns:
+    - The ranked office_scores list, in the same shape as mongo.best_office_location().
+    """
+    names, office_coords, distances, venue_types = matrix
+    scores = scoring.score_distances(distances, venue_types, weights, max_distance)
+    return scoring.rank_offices(names, office_coords, scores)
+
+
+def best_office_location(weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE, offices_collection='san_francisco_offices',
+                         venues_collection=None, database=None, refresh=True):
+    """
+    best_office_location() backed by the materialized matrix: refresh the stale cells (unless
+    refresh is False), load the matrix and rank it under the given weights and cutoffs.
+    """
+    db = mongo.get_database(database)
+    venue_types = sorted(set(scoring.WEIGHTS) | set(weights))
+    if refresh:
+        refresh_distance_matrix(db, offices_collection, venue_types, venues_collection)
+    return rerank(load_distance_matrix(db, offices_collection, venue_types), weights, max_distance)
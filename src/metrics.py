@@ -0,0 +1,341 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+
+# Process-wide run metrics. Stage timers wrap the pipeline steps (with peak memory and an
+# optional cProfile capture), timers accumulate the time of hot inner calls (HTTP, Mongo
+# commands, sleeps, geodesic math) and counters count events. Worker processes (grid,
+# cities) keep their own registry.
+PREFIX = 'office_locator'
+MEMORY_INTERVAL = 0.05  # seconds between peak-memory samples while a stage is open
+MAX_SAMPLES = 10000  # latency samples kept per timer (reservoir) for the quantiles
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+lock = threading.Lock()
+stages = {}
+timers = {}
+counters = {}
+samples = {}
+settings = {'profile_dir': None, 'memory_interval': MEMORY_INTERVAL}
+
+open_stages = []
+sampler = {'thread': None, 'stop': None}
+profiling = threading.local()
+
+
+def configure(profile_dir=None, memory_interval=MEMORY_INTERVAL):
+    """
+    Parameters:
+    - profile_dir: When set, every outermost stage runs under cProfile and its stats are
+      written to {profile_dir}/{stage}.prof (open them with pstats or snakeviz).
+    - memory_interval: Seconds between RSS samples while a stage is open; 0 only samples
+      at stage entry and exit.
+    """
+    settings['profile_dir'] = profile_dir
+    settings['memory_interval'] = memory_interval
+
+
+def reset():
+    with lock:
+        stages.clear()
+        timers.clear()
+        counters.clear()
+        samples.clear()
+
+
+def count(name, value=1):
+    """
+    Add value to the counter name (e.g. 'api.requests', 'cache.hits').
+    """
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def add_time(name, seconds, calls=1):
+    with lock:
+        entry = timers.setdefault(name, {'calls': 0, 'seconds': 0.0})
+        entry['calls'] += calls
+        entry['seconds'] += seconds
+
+
+def observe(name, seconds):
+    """
+    Keep one latency sample of name for quantiles(). Beyond MAX_SAMPLES the samples are a
+    uniform reservoir of every observation.
+    """
+    with lock:
+        entry = samples.setdefault(name, {'seen': 0, 'values': []})
+        entry['seen'] += 1
+        if len(entry['values']) < MAX_SAMPLES:
+            entry['values'].append(seconds)
+        else:
+            slot = random.randrange(entry['seen'])
+            if slot < MAX_SAMPLES:
+                entry['values'][slot] = seconds
+
+
+def quantiles(name):
+    """
+    The QUANTILES and the maximum of the samples of name, e.g. {'p50': ..., 'p99': ..., 'max': ...},
+    or None without samples.
+    """
+    with lock:
+        values = sorted(samples.get(name, {}).get('values', []))
+    if not values:
+        return None
+    result = {f'p{round(q * 100):d}': values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES}
+    result['max'] = values[-1]
+    return result
+
+
+@contextmanager
+def timer(name, sample=False):
+    """
+    Accumulate the wall-clock time of the block under timers[name]. Cheap enough for
+    per-request and per-distance calls, and safe to use from worker threads. With sample,
+    the duration is also kept for the quantiles of the report (e.g. HTTP tail latency).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        add_time(name, seconds)
+        if sample:
+            observe(name, seconds)
+
+
+def rss_bytes():
+    """
+    Current resident set size of the process, or its peak where the current value is not
+    available (non-Linux).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def sample_memory():
+    rss = rss_bytes()
+    with lock:
+        for record in open_stages:
+            record['peak_rss_bytes'] = max(record['peak_rss_bytes'], rss)
+    return rss
+
+
+def sampler_loop(stop, interval):
+    while not stop.wait(interval):
+        sample_memory()
+
+
+def start_sampler():
+    interval = settings['memory_interval']
+    if not interval or sampler['thread'] is not None:
+        return
+    stop = threading.Event()
+    thread = threading.Thread(target=sampler_loop, args=(stop, interval), name='metrics-memory', daemon=True)
+    sampler.update(thread=thread, stop=stop)
+    thread.start()
+
+
+def stop_sampler():
+    if sampler['thread'] is None:
+        return
+    sampler['stop'].set()
+    sampler['thread'].join()
+    sampler.update(thread=None, stop=None)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a pipeline stage and record the peak RSS seen while it runs. With a profile_dir
+    configured, the outermost stage of each thread is also profiled with cProfile.
+    """
+    record = {'peak_rss_bytes': rss_bytes()}
+    with lock:
+        open_stages.append(record)
+        first = len(open_stages) == 1
+    if first:
+        start_sampler()
+
+    profiler = None
+    if settings['profile_dir'] and not getattr(profiling, 'active', False):
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiling.active = True
+        try:
+            profiler.enable()
+        except ValueError:  # another profiler (e.g. an outer cProfile run) is already active
+            profiler = None
+            profiling.active = False
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        profile_path = None
+        if profiler is not None:
+            profiler.disable()
+            profiling.active = False
+            os.makedirs(settings['profile_dir'], exist_ok=True)
+            profile_path = os.path.join(settings['profile_dir'], f"{name.replace('/', '_')}.prof")
+            profiler.dump_stats(profile_path)
+
+        sample_memory()
+        with lock:
+            open_stages.remove(record)
+            last = not open_stages
+            entry = stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_rss_bytes': 0})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['peak_rss_bytes'] = max(entry['peak_rss_bytes'], record['peak_rss_bytes'])
+            if profile_path:
+                entry['profile'] = profile_path
+        if last:
+            stop_sampler()
+
+
+def mongo_listener():
+    """
+    A pymongo CommandListener counting Mongo round trips and returned documents and timing
+    each command under 'mongo.<command>'. Registered on every client from mongo.get_client().
+    """
+    from pymongo import monitoring
+
+    class MongoCommandListener(monitoring.CommandListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            reply = event.reply or {}
+            cursor = reply.get('cursor') or {}
+            batch = cursor.get('firstBatch', cursor.get('nextBatch'))
+            with lock:
+                counters['mongo.round_trips'] = counters.get('mongo.round_trips', 0) + 1
+                if batch is not None:
+                    counters['mongo.documents_returned'] = counters.get('mongo.documents_returned', 0) + len(batch)
+            add_time(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+
+        def failed(self, event):
+            count('mongo.round_trips')
+            count('mongo.failures')
+            add_time(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+
+    return MongoCommandListener()
+
+
+def report(**meta):
+    """
+    The run report: meta (timestamp, pid, peak RSS and any keyword given), stages, timers
+    (with the latency quantiles of sampled timers) and counters, as a JSON-serializable dict.
+    """
+    latencies = {name: quantiles(name) for name in list(samples)}
+    with lock:
+        result = {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'pid': os.getpid(),
+                'rss_bytes': rss_bytes(),
+                **meta
+            },
+            'stages': {name: dict(entry) for name, entry in stages.items()},
+            'timers': {name: dict(entry) for name, entry in timers.items()},
+            'counters': dict(counters)
+        }
+    for name, entry in result['timers'].items():
+        if latencies.get(name):
+            entry['quantiles'] = latencies[name]
+    return result
+
+
+def write_report(path, **meta):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(report(**meta), file, indent=2)
+    return path
+
+
+def metric_name(name):
+    return ''.join(ch if ch.isalnum() else '_' for ch in name).strip('_').lower()
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def quantile_label(key):
+    """
+    'p99' -> '0.99', 'max' -> '1'.
+    """
+    return '1' if key == 'max' else str(int(key[1:]) / 100)
+
+
+def prometheus_text(data=None):
+    """
+    Render a report() in the Prometheus text exposition format, e.g. for the node_exporter
+    textfile collector or a Pushgateway.
+    """
+    data = data or report()
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        if not samples:
+            return
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{PREFIX}_{name}{labels} {value!r}")
+
+    stage_items = sorted(data['stages'].items())
+    family('stage_seconds_total', 'counter', "Wall-clock seconds spent in each pipeline stage.",
+           [(f'{{stage="{label(name)}"}}', float(entry['seconds'])) for name, entry in stage_items])
+    family('stage_calls_total', 'counter', "Times each pipeline stage ran.",
+           [(f'{{stage="{label(name)}"}}', entry['calls']) for name, entry in stage_items])
+    family('stage_peak_rss_bytes', 'gauge', "Peak resident memory sampled while each stage ran.",
+           [(f'{{stage="{label(name)}"}}', entry['peak_rss_bytes']) for name, entry in stage_items])
+
+    timer_items = sorted(data['timers'].items())
+    family('timer_seconds_total', 'counter', "Accumulated seconds of instrumented calls.",
+           [(f'{{timer="{label(name)}"}}', float(entry['seconds'])) for name, entry in timer_items])
+    family('timer_calls_total', 'counter', "Number of instrumented calls.",
+           [(f'{{timer="{label(name)}"}}', entry['calls']) for name, entry in timer_items])
+    # A summary: quantile samples plus _sum and _count (the totals above) per sampled timer
+    summary = []
+    for name, entry in timer_items:
+        if not entry.get('quantiles'):
+            continue
+        summary += [(f'{{timer="{label(name)}",quantile="{quantile_label(key)}"}}', float(value))
+                    for key, value in entry['quantiles'].items()]
+        summary += [(f'_sum{{timer="{label(name)}"}}', float(entry['seconds'])),
+                    (f'_count{{timer="{label(name)}"}}', entry['calls'])]
+    family('timer_latency_seconds', 'summary', "Latency quantiles of sampled calls.", summary)
+
+    for name, value in sorted(data['counters'].items()):
+        family(f'{metric_name(name)}_total', 'counter', f"Counter {name}.", [('', value)])
+
+    family('rss_bytes', 'gauge', "Resident memory of the process when the report was taken.",
+           [('', data['meta'].get('rss_bytes', 0))])
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, data=None):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(prometheus_text(data))
+    return path
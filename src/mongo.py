@@ -1,26 +1,95 @@
-from pymongo import MongoClient
 import time
+import json
+import hashlib
 import logging
-import pandas as pd
 import math
-from geopy.distance import geodesic
-import folium
-from geopy.distance import great_circle
-import sys
-sys.path.append("./src")
-import api
-from dotenv import load_dotenv
 import os
+import threading
 import webbrowser
+from . import distance as tiers
+from . import maps
+from . import metrics
+from . import scoring
+from .lazy import lazy_module
 
-load_dotenv()
-token = os.getenv('token')
+pd = lazy_module('pandas')
+np = lazy_module('numpy')
+folium = lazy_module('folium')
+pymongo = lazy_module('pymongo')
+geopy_distance = lazy_module('geopy.distance')
+
+
+DATABASE = 'Ironhack'
+
+
+def mongo_settings():
+    """
+    Connection settings, overridable from the environment or the .env file:
+    MONGO_URI, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    MONGO_CONNECT_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS and MONGO_READ_PREFERENCE.
+    """
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return {
+        'uri': os.getenv('MONGO_URI', 'mongodb://localhost:27017/'),
+        'maxPoolSize': int(os.getenv('MONGO_MAX_POOL_SIZE', '50')),
+        'minPoolSize': int(os.getenv('MONGO_MIN_POOL_SIZE', '0')),
+        'serverSelectionTimeoutMS': int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+        'connectTimeoutMS': int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '5000')),
+        'socketTimeoutMS': int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', '30000')),
+        'readPreference': os.getenv('MONGO_READ_PREFERENCE', 'primary')
+    }
+
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+def client_options(**overrides):
+    settings = {**mongo_settings(), **overrides}
+    uri = settings.pop('uri')
+    return uri, settings
+
+
+def get_client(**overrides):
+    """
+    Return the shared MongoClient for the given settings, creating it on first use.
+
+    Every function in this module goes through here, so they all reuse one connection pool.
+    Clients are cached per process because a MongoClient must not be shared across fork().
+
+    Parameters:
+    - overrides: Settings replacing mongo_settings() (uri, maxPoolSize, timeouts, readPreference...).
+
+    Returns:
+    - A pymongo.MongoClient.
+    """
+    uri, options = client_options(**overrides)
+    key = (os.getpid(), uri, tuple(sorted(options.items())))
+    with clients_lock:
+        if key not in clients:
+            clients[key] = pymongo.MongoClient(uri, event_listeners=[metrics.mongo_listener()], **options)
+        return clients[key]
+
+
+def close_clients():
+    """
+    Close every client created by get_client() in this process.
+    """
+    with clients_lock:
+        for key in [key for key in clients if key[0] == os.getpid()]:
+            clients.pop(key).close()
+
+
+def get_database(database=None):
+    return get_client()[database or DATABASE]
 
 
 # Conecting to the database and collection that is in mongoDB
 def connection_database(database, collection):
     try:
-        client = MongoClient("mongodb://localhost:27017/")
+        client = get_client()
         print("Successful connection to MongoDB")
     except Exception as e:
         print(f"Unable to connect to MongoDB. Error: {e}")
@@ -34,8 +103,6 @@ def connection_database(database, collection):
         return None
     return db, c
 
-db, c = connection_database("Ironhack", "Companies")
-
 def count_offices_by_condition(collection, condition1, condition2):
     """
     Count the number of offices for companies meeting the specified conditions.
@@ -64,17 +131,84 @@ def count_offices_by_condition(collection, condition1, condition2):
     else:
         return pd.Series()  
 
-condition1 = {"category_code": "games_video"}
-condition2 = {"funding_rounds.raised_amount": {"$gt": 1000000}}
+def office_count_stages(query):
+    """
+    Aggregation stages that count offices per city for the companies matching query.
+    Only {_id: city, count: n} documents leave the server.
+    """
+    return [
+        {"$match": query},
+        {"$project": {"_id": 0, "offices.city": 1}},
+        {"$unwind": "$offices"},
+        {"$group": {"_id": "$offices.city", "count": {"$sum": 1}}},
+        {"$match": {"_id": {"$ne": None}}},
+        {"$sort": {"count": -1, "_id": 1}}
+    ]
+
+
+def office_counts_to_series(groups):
+    if not groups:
+        return pd.Series(dtype='int64')
+    return pd.Series([group['count'] for group in groups], index=[group['_id'] for group in groups], name='count')
+
+
+def count_offices_by_condition_agg(collection, condition1, condition2):
+    """
+    Server-side version of count_offices_by_condition: the unwinding and counting run in a
+    $unwind/$group aggregation, so only the per-city counts are transferred.
+
+    Parameters:
+        collection (pymongo.collection.Collection): The MongoDB collection to query.
+        condition1 (dict): First condition for filtering companies.
+        condition2 (dict): Second condition for filtering companies.
+
+    Returns:
+        pandas.Series: Office count per city, largest first.
+    """
+    pipeline = office_count_stages({"$and": [condition1, condition2]})
+    return office_counts_to_series(list(collection.aggregate(pipeline)))
 
-offices_by_condition = count_offices_by_condition(c, condition1, condition2)
-offices_by_condition
 
-condition_design = {"category_code": {"$in": ["design", "web"]}}
-condition_funding = {"funding_rounds.raised_amount": {"$gt": 1000000}}
+def count_offices_by_conditions(collection, condition_sets):
+    """
+    Count offices per city for several condition sets in a single round trip with $facet.
+
+    A leading $match on the union of all condition sets lets the server use its indexes and
+    skip companies no facet needs before the facets run.
+
+    Parameters:
+        collection (pymongo.collection.Collection): The MongoDB collection to query.
+        condition_sets (dict): Maps a name to a list/tuple of conditions that must all hold.
+
+    Returns:
+        dict: Maps each name to a pandas.Series with the office count per city, largest first.
+    """
+    if not condition_sets:
+        return {}
+
+    queries = {name: {"$and": list(conditions)} for name, conditions in condition_sets.items()}
+    pipeline = [
+        {"$match": {"$or": list(queries.values())}},
+        {"$facet": {name: office_count_stages(query) for name, query in queries.items()}}
+    ]
+
+    result = next(collection.aggregate(pipeline), {})
+    return {name: office_counts_to_series(result.get(name, [])) for name in queries}
+
+
+def gaming_startup_pipeline(city_name):
+    condition_city = {"offices.city": city_name}
+    condition_category = {"category_code": "games_video"}
+    condition_funding = {"funding_rounds.raised_amount": {"$gt": 1000000}}
+    query = {"$and": [condition_city, condition_category, condition_funding]}
+
+    return [
+        {"$match": query},
+        {"$unwind": "$offices"},
+        {"$match": {"offices.city": city_name}},
+        {"$project": {"_id": 0, "name": 1, "latitude": "$offices.latitude", "longitude": "$offices.longitude"}}
+    ]
 
-result_design_web = count_offices_by_condition(c, condition_design, condition_funding)
-result_design_web
 
 def gaming_startup_finder(collection, city_name):
     """
@@ -88,17 +222,7 @@ def gaming_startup_finder(collection, city_name):
     - A Pandas DataFrame containing the names, latitude, and longitude of the gaming startups in the specified city.
     """
     try:
-        condition_city = {"offices.city": city_name}
-        condition_category = {"category_code": "games_video"}
-        condition_funding = {"funding_rounds.raised_amount": {"$gt": 1000000}}
-        query = {"$and": [condition_city, condition_category, condition_funding]}
-
-        pipeline = [
-            {"$match": query},
-            {"$unwind": "$offices"},
-            {"$match": {"offices.city": city_name}},
-            {"$project": {"_id": 0, "name": 1, "latitude": "$offices.latitude", "longitude": "$offices.longitude"}}
-        ]
+        pipeline = gaming_startup_pipeline(city_name)
 
         result = list(collection.aggregate(pipeline))
 
@@ -109,9 +233,18 @@ def gaming_startup_finder(collection, city_name):
         print(f"An error occurred: {e}")
         return pd.DataFrame()
 
-city_name_sf = "San Francisco"
-gaming_startups_sf = gaming_startup_finder(c, city_name_sf)
-gaming_startups_sf.head()
+def design_web_startup_pipeline(city_name):
+    condition_city = {"offices.city": city_name}
+    condition_category = {"$or": [{"category_code": "design"}, {"category_code": "web"}]}
+    query = {"$and": [condition_city, condition_category]}
+
+    return [
+        {"$match": query},
+        {"$unwind": "$offices"},
+        {"$match": {"offices.city": city_name}},
+        {"$project": {"_id": 0, "name": 1, "latitude": "$offices.latitude", "longitude": "$offices.longitude", "category_code": 1}}
+    ]
+
 
 def design_web_startup_finder(collection, city_name):
     """
@@ -125,16 +258,7 @@ def design_web_startup_finder(collection, city_name):
     - A Pandas DataFrame containing the names, latitude, and longitude of the design and web startups in the specified city.
     """
     try:
-        condition_city = {"offices.city": city_name}
-        condition_category = {"$or": [{"category_code": "design"}, {"category_code": "web"}]}
-        query = {"$and": [condition_city, condition_category]}
-
-        pipeline = [
-            {"$match": query},
-            {"$unwind": "$offices"},
-            {"$match": {"offices.city": city_name}},
-            {"$project": {"_id": 0, "name": 1, "latitude": "$offices.latitude", "longitude": "$offices.longitude", "category_code": 1}}
-        ]
+        pipeline = design_web_startup_pipeline(city_name)
 
         result = list(collection.aggregate(pipeline))
 
@@ -145,9 +269,30 @@ def design_web_startup_finder(collection, city_name):
         print(f"An error occurred: {e}")
         return pd.DataFrame()
 
-city_name_sf = "San Francisco"
-design_web_startups_sf = design_web_startup_finder(c, city_name_sf)
-design_web_startups_sf.head()
+def offices_by_criteria_pipeline(city, min_employees, max_employees):
+    # Filter whole companies first so the $match can use the
+    # category_code/offices.city/number_of_employees index, then keep only the offices in the city
+    # (every office of the matching companies when city is None)
+    condition_city = {"offices.city": city} if city is not None else {}
+    condition_category = {"category_code": "games_video"}
+    condition_employees = {"number_of_employees": {"$gte": min_employees, "$lte": max_employees}}
+
+    return [
+        {"$match": {"$and": [condition_category, condition_city, condition_employees]}},
+        {"$unwind": "$offices"},
+        {"$match": condition_city},
+        {"$project": {
+            "_id": 0,
+            "name": 1,
+            "latitude": "$offices.latitude",
+            "longitude": "$offices.longitude",
+            "address": "$offices.address1",
+            "city": "$offices.city",
+            "employees": "$number_of_employees",
+            "category_code": 1
+        }}
+    ]
+
 
 def find_offices_by_criteria(collection, city, min_employees, max_employees):
     """
@@ -155,7 +300,7 @@ def find_offices_by_criteria(collection, city, min_employees, max_employees):
 
     Parameters:
     - collection: MongoDB collection
-    - city: Name of the city to search for offices
+    - city: Name of the city to search for offices (None: every city)
     - min_employees: Minimum number of employees the office can accommodate
     - max_employees: Maximum number of employees the office can accommodate
 
@@ -163,24 +308,7 @@ def find_offices_by_criteria(collection, city, min_employees, max_employees):
     - A Pandas DataFrame containing information about the offices that meet the criteria.
     """
     try:
-        condition_city = {"offices.city": city}
-        condition_category = {"category_code": "games_video"}
-        condition_employees = {"number_of_employees": {"$gte": min_employees, "$lte": max_employees}}
-
-        pipeline = [
-            {"$unwind": "$offices"},
-            {"$match": {"$and": [condition_city, condition_employees, condition_category]}},
-            {"$project": {
-                "_id": 0,
-                "name": 1,
-                "latitude": "$offices.latitude",
-                "longitude": "$offices.longitude",
-                "address": "$offices.address1",
-                "city": "$offices.city",
-                "employees": "$number_of_employees",
-                "category_code": 1
-            }}
-        ]
+        pipeline = offices_by_criteria_pipeline(city, min_employees, max_employees)
 
         result = list(collection.aggregate(pipeline))
 
@@ -196,7 +324,7 @@ def find_offices_by_criteria(collection, city, min_employees, max_employees):
         return pd.DataFrame()
     
 
-def insert_offices_data_create_index(city, min_employees, max_employees, collection_name, db):
+def insert_offices_data_create_index(city, min_employees, max_employees, collection_name, db, collection=None, offices_df=None):
 
     """
     Inserts office data into a MongoDB collection and creates a geospatial index. 
@@ -209,19 +337,29 @@ def insert_offices_data_create_index(city, min_employees, max_employees, collect
     - max_employees: Maximum number of employees the office can accommodate.
     - collection_name: Name of the MongoDB collection where data will be inserted.
     - db: MongoDB database instance.
+    - collection: Companies collection to search. Defaults to db['Companies'].
+    - offices_df: Result of find_offices_by_criteria if the caller already has it, to avoid
+      running the aggregation twice.
 
     Returns:
     - A confirmation message indicating successful data insertion and index creation.
     """
-    
-    city_sf = city
-    min_employees_sf = min_employees
-    max_employees_sf = max_employees
-    sf_offices_df = find_offices_by_criteria(c, city_sf, min_employees_sf, max_employees_sf)
-    sf_offices_df
-    
+    if collection is None:
+        collection = db['Companies']
+
+    if offices_df is None:
+        city_sf = city
+        min_employees_sf = min_employees
+        max_employees_sf = max_employees
+        sf_offices_df = find_offices_by_criteria(collection, city_sf, min_employees_sf, max_employees_sf)
+    else:
+        sf_offices_df = offices_df.copy()
+
     db[collection_name].drop()
 
+    if sf_offices_df.empty:
+        return f"No offices found for {city}, {collection_name} left empty"
+
     sf_offices_df['location'] = sf_offices_df.apply(lambda row: {'type': 'Point', 'coordinates': [row['longitude'], row['latitude']]}, axis=1)
 
     sf_offices_df.drop(['latitude', 'longitude'], axis=1, inplace=True)
@@ -234,102 +372,195 @@ def insert_offices_data_create_index(city, min_employees, max_employees, collect
 
     return f"Data inserted and index created for {collection_name}"
 
+def converting_to_collection(db, venues_by_type):
+    """
+    Load each venue DataFrame into its own MongoDB collection with a 2dsphere index.
+
+    Parameters:
+    - db: MongoDB database instance.
+    - venues_by_type: Dict mapping collection name (e.g. 'df_bars') to its venue DataFrame.
+    """
+    for collection_name, df in venues_by_type.items():
+        df = df.copy()
+        db[collection_name].drop()
 
+        df['location'] = df.apply(lambda row: {'type': 'Point', 'coordinates': [row['Lng'], row['Lat']]}, axis=1)
 
-city = "San Francisco"
-min_employees = 87
-max_employees = 150
-collection_name = 'san_francisco_offices'
-sf_offices_df = find_offices_by_criteria(c, city, min_employees, max_employees)
-inserting_offices = insert_offices_data_create_index(city,min_employees, max_employees, collection_name, db)
-inserting_offices
-sf_offices_df
+        records = df.to_dict(orient="records")
 
+        db[collection_name].insert_many(records)
 
-latitude = 37.7804301
-longitude = -122.4103305
-limit= 30
+        db[collection_name].create_index([("location", "2dsphere")])
 
-venue = "design talks"
-df_design_talks = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
+        with metrics.timer('sleep.converting_to_collection'):
+            time.sleep(2)
 
-venue = "bar"
-df_bars = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
 
-venue = "night club"
-df_clubs = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
+VENUES_COLLECTION = 'venues'
 
-venue = "airport"
-df_airport = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=5)
 
-venue = "train station"
-df_train = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
+def ensure_venue_indexes(collection):
+    """
+    Create the indexes of the single venues collection. create_index is a no-op when the
+    index already exists, so this only builds them on the first sync.
+    """
+    collection.create_index([("location", "2dsphere"), ("category", 1)])
+    collection.create_index([("category", 1), ("fsq_id", 1)], unique=True)
 
-venue = "ferry"
-df_ferry = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=5)
 
-venue = "vegan restaurant"
-df_vegan = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
+def venue_checksum(document):
+    payload = json.dumps([document['name'], document['location']['coordinates']], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
 
-venue = "basketball stadium"
-df_basketball = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
 
-venue = "pet grooming"
-df_grooming = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
+def sync_venues(db, venues_by_type, collection_name=VENUES_COLLECTION, prune=True):
+    """
+    Incrementally sync all venue categories into one collection with a 'category' field.
 
-venue = "school"
-df_school = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
+    Unlike converting_to_collection(), nothing is dropped: every venue is upserted by
+    (category, fsq_id) in a single unordered bulk_write, and venues whose name and position
+    are unchanged (same checksum) are not sent at all. The collection is never empty while
+    it is being refreshed. Venues are keyed per category because the same place can be
+    returned by several queries (e.g. 'bar' and 'night club').
 
-venue = "starbucks"
-df_starbucks = api.get_venues_dataframe(venue, token, latitude=latitude, longitude=longitude, limit=limit)
+    Parameters:
+    - db: MongoDB database instance.
+    - venues_by_type: Dict mapping venue collection name (e.g. 'df_bars') to its venue DataFrame.
+    - collection_name: Name of the target collection.
+    - prune: Delete venues of a synced category that are no longer in its DataFrame.
 
-def  converting_to_collection():
-    collections = {
-        "df_school": df_school,
-        "df_grooming": df_grooming,
-        "df_basketball": df_basketball,
-        "df_vegan": df_vegan,
-        "df_ferry": df_ferry,
-        "df_train": df_train,
-        "df_airport": df_airport,
-        "df_clubs": df_clubs,
-        "df_bars": df_bars,
-        "df_starbucks": df_starbucks,
-        "df_design_talks": df_design_talks
-    }
+    Returns:
+    - A dict with the number of inserted, updated, deleted and unchanged venues.
+    """
+    collection = db[collection_name]
+    ensure_venue_indexes(collection)
+
+    operations = []
+    unchanged = 0
+    for venue_type, df in venues_by_type.items():
+        category = scoring.VENUE_QUERIES.get(venue_type, venue_type)
+        existing = {
+            doc['fsq_id']: doc.get('checksum')
+            for doc in collection.find({'category': category}, {'_id': 0, 'fsq_id': 1, 'checksum': 1})
+        }
 
+        seen = set()
+        for record in df.dropna(subset=['Lat', 'Lng']).to_dict(orient='records'):
+            document = {
+                'name': record.get('name'),
+                'category': category,
+                'location': {'type': 'Point', 'coordinates': [float(record['Lng']), float(record['Lat'])]}
+            }
+            document['checksum'] = venue_checksum(document)
+            # Venues without a Foursquare id are keyed on their content instead
+            fsq_id = record.get('fsq_id')
+            document['fsq_id'] = fsq_id if isinstance(fsq_id, str) and fsq_id else document['checksum']
 
-    for collection_name, df in collections.items():
-        db[collection_name].drop()
+            if document['fsq_id'] in seen:
+                continue
+            seen.add(document['fsq_id'])
 
-        df['location'] = df.apply(lambda row: {'type': 'Point', 'coordinates': [row['Lng'], row['Lat']]}, axis=1)
+            if existing.get(document['fsq_id']) == document['checksum']:
+                unchanged += 1
+                continue
 
-        records = df.to_dict(orient="records")
+            operations.append(pymongo.UpdateOne(
+                {'category': category, 'fsq_id': document['fsq_id']},
+                {'$set': document},
+                upsert=True
+            ))
 
-        db[collection_name].insert_many(records)
+        stale = [fsq_id for fsq_id in existing if fsq_id not in seen]
+        if prune and stale:
+            operations.append(pymongo.DeleteMany({'category': category, 'fsq_id': {'$in': stale}}))
 
-        db[collection_name].create_index([("location", "2dsphere")])
+    summary = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': unchanged}
+    if operations:
+        result = collection.bulk_write(operations, ordered=False)
+        summary['inserted'] = result.upserted_count
+        summary['updated'] = result.modified_count
+        summary['deleted'] = result.deleted_count
 
-        time.sleep(2)
-        
-converting_to_collection()
+    return summary
 
-    
-    
-def best_office_location():
-    MAX_DISTANCE = {
-        'df_school': 3000, 
-        'df_grooming': 1000,  
-        'df_basketball': 10000,
-        'df_vegan': 1000,  
-        'df_ferry': 5000, 
-        'df_train': 1000,  
-        'df_airport': 20000,  
-        'df_clubs': 1000,  
-        'df_bars': 1000,  
-        'df_starbucks': 1000,  
-        'df_design_talks': 1000 
-    }
+
+def venue_source(db, venue_type, venues_collection=None):
+    """
+    Return the collection and base filter holding the venues of one type: its own df_*
+    collection, or the single venues collection filtered by category.
+    """
+    if venues_collection is None:
+        return db[venue_type], {}
+    return db[venues_collection], {'category': scoring.VENUE_QUERIES.get(venue_type, venue_type)}
+
+
+def load_scoring_arrays(db, offices_collection='san_francisco_offices', venue_types=None, venues_collection=None):
+    """
+    Load the offices and every venue category once into NumPy arrays for batch scoring.
+
+    Parameters:
+    - db: MongoDB database instance.
+    - offices_collection: Name of the collection holding the offices (with a GeoJSON 'location').
+    - venue_types: Venue collections to load. Defaults to the keys of scoring.WEIGHTS.
+    - venues_collection: Read the venues from this single collection (see sync_venues) instead
+      of one collection per type.
+
+    Returns:
+    - A tuple (names, office_coords, venues_by_type) where office_coords is an (n, 2) array of
+      [longitude, latitude] and venues_by_type maps each venue collection to an (m, 2) array.
+    """
+    names = []
+    office_coords = []
+    for office in db[offices_collection].find({}, {'_id': 0, 'name': 1, 'location.coordinates': 1}):
+        names.append(office['name'])
+        office_coords.append(office['location']['coordinates'])
+
+    venues_by_type = load_venue_arrays(db, venue_types, venues_collection)
+    return names, np.array(office_coords, dtype=float).reshape(-1, 2), venues_by_type
+
+
+def load_venue_arrays(db, venue_types=None, venues_collection=None):
+    """
+    The venues half of load_scoring_arrays(): a dict mapping each venue collection to an
+    (m, 2) array of [longitude, latitude].
+    """
+    if venue_types is None:
+        venue_types = list(scoring.WEIGHTS)
+
+    venues_by_type = {}
+    for venue_type in venue_types:
+        collection, query = venue_source(db, venue_type, venues_collection)
+        coords = [venue['location']['coordinates'] for venue in collection.find(query, {'_id': 0, 'location.coordinates': 1})]
+        venues_by_type[venue_type] = np.array(coords, dtype=float).reshape(-1, 2)
+    return venues_by_type
+
+
+def best_office_location(batch=False, index=None, venues_collection=None, database=None, tier=None,
+                         offices_collection='san_francisco_offices'):
+    """
+    Rank the offices in offices_collection by their weighted proximity to the venue categories.
+
+    Parameters:
+    - batch: When True, load offices and venues once and score them all with the vectorized
+      engine in scoring.py (12 Mongo round trips in total instead of one $near per office and
+      category). Distances agree with geopy's geodesic within 0.1 m, so unrounded scores
+      differ by less than 1e-4 and the rounded scores only differ when a value sits on a
+      rounding boundary.
+    - index: Optional venue index from spatial.build_venue_index(). When given, the nearest
+      venue per category is looked up in it instead of with a MongoDB $near query. A 'mongo'
+      backend index reproduces the default behaviour.
+    - venues_collection: Read the venues from this single collection (see sync_venues) instead
+      of one df_* collection per type.
+    - database: Database holding the offices and venues. Defaults to DATABASE.
+    - tier: Distance tier (see distance.TIERS). When given, distances are evaluated with a
+      cheap bound first and geopy's geodesic only runs for pairs near a category cutoff
+      (scores stay within distance.SCORE_TOLERANCE). None solves the geodesic for every pair.
+    - offices_collection: Collection of the offices to rank.
+
+    Returns:
+    - A list of dicts with 'office', 'score' and 'location', sorted by score (best first).
+    """
+    MAX_DISTANCE = scoring.MAX_DISTANCE
 
 
     def normalized_score(distance, max_distance):
@@ -338,27 +569,19 @@ def best_office_location():
         else:
             return math.sqrt(1 - (distance / max_distance) ** 2)
 
-    def calculate_distance(point1, point2):
+    def calculate_distance(point1, point2, max_distance=None):
         point1 = tuple(reversed(point1))
         point2 = tuple(reversed(point2))
+        if tier is not None:
+            return tiers.pair_distance(point1, point2, max_distance, tier)
         
-        distance = geodesic(point1, point2).meters  # distance in meters
+        metrics.count('distance.evaluations')
+        with metrics.timer('distance.geodesic'):
+            distance = geopy_distance.geodesic(point1, point2).meters  # distance in meters
         return distance
 
 
-    WEIGHTS = {
-        'df_school': 0.1,  
-        'df_grooming': 0.05,  
-        'df_basketball': 0.05,  
-        'df_vegan': 0.15,  
-        'df_ferry': 0.05,  
-        'df_train': 0.05,  
-        'df_airport': 0.05,  
-        'df_clubs': 0.1,  
-        'df_bars': 0.1,  
-        'df_starbucks': 0.15,  
-        'df_design_talks': 0.15 
-    }
+    WEIGHTS = scoring.WEIGHTS
 
     
     def calculate_proximity_score(office, db):
@@ -366,7 +589,17 @@ def best_office_location():
         office_location = office['location']['coordinates']
         
         for venue_type, weight in WEIGHTS.items():
-            nearest_venue = db[venue_type].find_one({
+            if index is not None:
+                nearest = index.nearest(venue_type, office_location[1], office_location[0])
+                if nearest:
+                    max_dist = MAX_DISTANCE.get(venue_type, 1000)
+                    distance = calculate_distance(office_location, [nearest['Lng'], nearest['Lat']], max_dist)
+                    score += normalized_score(distance, max_dist) * weight
+                continue
+
+            collection, query = venue_source(db, venue_type, venues_collection)
+            nearest_venue = collection.find_one({
+                **query,
                 'location': {
                     '$near': {
                         '$geometry': {
@@ -378,9 +611,9 @@ def best_office_location():
             })
                     
             if nearest_venue:
-                distance = calculate_distance(office_location, nearest_venue['location']['coordinates'])
-
                 max_dist = MAX_DISTANCE.get(venue_type, 1000)  # Default max distance
+                distance = calculate_distance(office_location, nearest_venue['location']['coordinates'], max_dist)
+
                 dist_score = normalized_score(distance, max_dist)
                             
                 score += dist_score * weight
@@ -389,10 +622,9 @@ def best_office_location():
         return score
 
     def find_best_office_location():
-        client = MongoClient("mongodb://localhost:27017/")
-        db = client['Ironhack']
+        db = get_database(database)
         
-        offices = db['san_francisco_offices'].find()
+        offices = db[offices_collection].find()
         
         office_scores = []
         for office in offices:
@@ -407,16 +639,45 @@ def best_office_location():
         
         return office_scores
 
+    def find_best_office_location_batch():
+        db = get_database(database)
+
+        names, office_coords, venues_by_type = load_scoring_arrays(db, offices_collection, list(WEIGHTS), venues_collection)
+        if tier is not None:
+            scores = tiers.score_offices(office_coords, venues_by_type, WEIGHTS, MAX_DISTANCE, tier)
+        else:
+            scores = scoring.score_offices(office_coords, venues_by_type, WEIGHTS, MAX_DISTANCE)
+
+        return scoring.rank_offices(names, office_coords, scores)
+
+    if batch:
+        return find_best_office_location_batch()
+
     office_scores = find_best_office_location()
     
     return office_scores
 
-office_scores = best_office_location()
+MAP_FILE = "./maps/office_best_location_and_venues.html"
+
 
-office_scores
+def final_location(office_scores, venues_by_type, map_file=MAP_FILE, open_browser=True, fast=False):
+    """
+    Render the best-scoring office and the venues around it to map_file and open it in the browser.
 
+    Parameters:
+    - office_scores: Ranked list returned by best_office_location().
+    - venues_by_type: Dict mapping venue collection name to its venue DataFrame.
+    - map_file: Output HTML file.
+    - open_browser: Open the map with webbrowser once it is saved.
+    - fast: Render with maps.render_office_map (vectorized radius filter, one clustered layer
+      per category) instead of one folium.Marker per venue.
+    """
+    if fast:
+        maps.render_office_map(office_scores[0], venues_by_type, map_file)
+        if not open_browser:
+            return map_file
+        return webbrowser.open('file://' + os.path.realpath(map_file))
 
-def final_location():
     def create_office_map(best_office, all_venues, radius=1000): 
         office_location = [best_office['location'][1], best_office['location'][0]] 
         office_map = folium.Map(location=office_location, zoom_start=15)
@@ -451,7 +712,7 @@ def final_location():
                 ).add_to(office_map)
         for _, venue in all_venues.iterrows():
             venue_location = [venue['Lat'], venue['Lng']]  
-            if great_circle(office_location, venue_location).meters <= radius:
+            if geopy_distance.great_circle(office_location, venue_location).meters <= radius:
                 venue_icon_color, venue_icon_name = icon_colors.get(venue['category'], ('gray', 'flag'))  
                 folium.Marker(
                     location=venue_location,
@@ -490,8 +751,11 @@ def final_location():
             popup='3.5 km radius'
         ).add_to(office_map)
 
-        map_file = "./maps/office_best_location_and_venues.html"
-        office_map.save(map_file)
+        with metrics.timer('folium.save'):
+            office_map.save(map_file)
+
+        if not open_browser:
+            return map_file
 
         final_map=  webbrowser.open('file://' + os.path.realpath(map_file))
         print("")
@@ -501,7 +765,8 @@ def final_location():
     best_office = office_scores[0] 
     radius = 4000  
 
-    all_venues = pd.concat([df_school, df_airport, df_bars, df_basketball, df_clubs, df_design_talks, df_ferry, df_grooming, df_starbucks, df_train])
+    all_venues = pd.concat([df for venue_type, df in venues_by_type.items() if venue_type not in maps.HIDDEN],
+                           ignore_index=True)
 
-    create_office_map(best_office, all_venues, radius)
-final_location()
+    with metrics.timer('folium.render'):
+        return create_office_map(best_office, all_venues, radius)
@@ -0,0 +1,178 @@
+import asyncio
+import weakref
+from . import distance as tiers
+from . import metrics
+from . import mongo
+from . import scoring
+from .lazy import lazy_module
+
+pd = lazy_module('pandas')
+geopy_distance = lazy_module('geopy.distance')
+
+
+# One Motor client per event loop: a Motor client is bound to the loop it first runs on. Keyed
+# on the loop object itself (weakly), so a finished loop's clients can never be handed to a
+# new loop that happens to get the same id()
+async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client(**overrides):
+    """
+    Return the shared Motor (asyncio) client for the running event loop, using the same
+    settings as mongo.get_client(). Close it with close_async_clients() before the loop ends,
+    or run the coroutine through run().
+
+    Requires the optional 'motor' package.
+    """
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient
+    except ImportError:
+        raise ImportError("The async data-access path requires motor: pip install motor")
+
+    uri, options = mongo.client_options(**overrides)
+    key = (uri, tuple(sorted(options.items())))
+    loop_clients = async_clients.setdefault(asyncio.get_running_loop(), {})
+    if key not in loop_clients:
+        loop_clients[key] = AsyncIOMotorClient(uri, event_listeners=[metrics.mongo_listener()], **options)
+    return loop_clients[key]
+
+
+def get_async_database(database=None):
+    return get_async_client()[database or mongo.DATABASE]
+
+
+def close_async_clients():
+    """
+    Close the Motor clients of the running event loop.
+    """
+    for client in async_clients.pop(asyncio.get_running_loop(), {}).values():
+        client.close()
+
+
+def run(coroutine):
+    """
+    asyncio.run() that closes the loop's Motor clients before the loop is closed.
+    """
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            close_async_clients()
+
+    return asyncio.run(main())
+
+
+async def aggregate_dataframe(collection, pipeline):
+    result = await collection.aggregate(pipeline).to_list(length=None)
+    return pd.DataFrame(result).drop_duplicates().dropna()
+
+
+async def find_offices_by_criteria(collection, city, min_employees, max_employees):
+    """
+    Async version of mongo.find_offices_by_criteria (same pipeline, same DataFrame).
+    """
+    return await aggregate_dataframe(collection, mongo.offices_by_criteria_pipeline(city, min_employees, max_employees))
+
+
+async def gaming_startup_finder(collection, city_name):
+    """
+    Async version of mongo.gaming_startup_finder.
+    """
+    return await aggregate_dataframe(collection, mongo.gaming_startup_pipeline(city_name))
+
+
+async def design_web_startup_finder(collection, city_name):
+    """
+    Async version of mongo.design_web_startup_finder.
+    """
+    return await aggregate_dataframe(collection, mongo.design_web_startup_pipeline(city_name))
+
+
+async def count_offices_by_condition(collection, condition1, condition2):
+    """
+    Async version of mongo.count_offices_by_condition_agg.
+    """
+    stages = mongo.office_count_stages({"$and": [condition1, condition2]})
+    return mongo.office_counts_to_series(await collection.aggregate(stages).to_list(length=None))
+
+
+async def run_finders(collection, city, min_employees, max_employees):
+    """
+    Issue the three finder aggregations concurrently.
+
+    Returns:
+    - A dict with the 'offices', 'gaming_startups' and 'design_web_startups' DataFrames.
+    """
+    offices, gaming, design_web = await asyncio.gather(
+        find_offices_by_criteria(collection, city, min_employees, max_employees),
+        gaming_startup_finder(collection, city),
+        design_web_startup_finder(collection, city)
+    )
+    return {'offices': offices, 'gaming_startups': gaming, 'design_web_startups': design_web}
+
+
+async def nearest_venue(db, venue_type, coordinates, venues_collection=None):
+    if venues_collection is None:
+        collection, query = db[venue_type], {}
+    else:
+        collection, query = db[venues_collection], {'category': scoring.VENUE_QUERIES.get(venue_type, venue_type)}
+    return await collection.find_one({
+        **query,
+        'location': {'$near': {'$geometry': {'type': 'Point', 'coordinates': coordinates}}}
+    })
+
+
+async def calculate_proximity_score(office, db, weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE,
+                                    venues_collection=None, tier=None):
+    """
+    Same score as the $near path of mongo.best_office_location, with the nearest-venue
+    queries of all categories issued concurrently. tier works as there.
+    """
+    office_location = office['location']['coordinates']
+    venue_types = list(weights)
+    nearest_venues = await asyncio.gather(*[
+        nearest_venue(db, venue_type, office_location, venues_collection) for venue_type in venue_types
+    ])
+
+    score = 0
+    for venue_type, venue in zip(venue_types, nearest_venues):
+        if venue:
+            max_dist = max_distance.get(venue_type, scoring.DEFAULT_MAX_DISTANCE)
+            if tier is not None:
+                distance = tiers.pair_distance(tuple(reversed(office_location)),
+                                               tuple(reversed(venue['location']['coordinates'])), max_dist, tier)
+            else:
+                metrics.count('distance.evaluations')
+                with metrics.timer('distance.geodesic'):
+                    distance = geopy_distance.geodesic(tuple(reversed(office_location)),
+                                                       tuple(reversed(venue['location']['coordinates']))).meters
+            score += float(scoring.normalized_scores(distance, max_dist)) * weights[venue_type]
+    return score
+
+
+async def best_office_location(offices_collection='san_francisco_offices', venues_collection=None,
+                               database=None, concurrency=32, tier=None):
+    """
+    Async version of mongo.best_office_location(): every office and category is queried
+    concurrently, with at most `concurrency` offices in flight.
+
+    Returns:
+    - The ranked office_scores list, in the same shape as the synchronous version.
+    """
+    db = get_async_database(database)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def score(office):
+        async with semaphore:
+            return {
+                'office': office['name'],
+                'score': round(await calculate_proximity_score(office, db, venues_collection=venues_collection,
+                                                                tier=tier), 2),
+                'location': office['location']['coordinates']
+            }
+
+    offices = await db[offices_collection].find({}, {'_id': 0, 'name': 1, 'location': 1}).to_list(length=None)
+    office_scores = list(await asyncio.gather(*[score(office) for office in offices]))
+    office_scores.sort(key=lambda x: x['score'], reverse=True)
+
+    return office_scores
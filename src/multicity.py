@@ -0,0 +1,145 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import api
+from . import mongo
+from . import pipeline
+from . import scoring
+
+
+STAGES = ('offices', 'collection', 'venues', 'scoring')
+
+
+def offices_collection_name(city):
+    """
+    Name of the per-city office collection, e.g. 'San Francisco' -> 'san_francisco_offices'.
+    """
+    slug = ''.join(ch if ch.isalnum() else '_' for ch in city.strip().lower())
+    return f"{slug}_offices"
+
+
+def top_cities(collection, condition1, condition2, top_n=5):
+    """
+    The top_n cities with the most offices of companies meeting both conditions.
+    """
+    counts = mongo.count_offices_by_condition_agg(collection, condition1, condition2)
+    counts = counts[[bool(city) and isinstance(city, str) for city in counts.index]]
+    return counts.head(top_n).index.tolist()
+
+
+def run_city(city, min_employees=pipeline.MIN_EMPLOYEES, max_employees=pipeline.MAX_EMPLOYEES,
+             limit=pipeline.LIMIT, rate=api.RATE_LIMIT, token=None):
+    """
+    Run the office, venue and scoring stages for one city. Runs in a worker process, so it
+    opens its own MongoDB connection.
+
+    The venues are fetched around the centroid of the city's candidate offices and the
+    offices are scored in memory with the batch scorer, so cities never share venue
+    collections.
+
+    Returns:
+    - A dict with 'city', 'centroid', 'offices', 'office_scores' (each entry tagged with its
+      city) and 'timings' (seconds per stage).
+    """
+    timings = {}
+    db, collection = mongo.connection_database(pipeline.DATABASE, pipeline.COMPANIES)
+
+    start = time.perf_counter()
+    offices_df = mongo.find_offices_by_criteria(collection, city, min_employees, max_employees)
+    timings['offices'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mongo.insert_offices_data_create_index(city, min_employees, max_employees, offices_collection_name(city), db,
+                                           collection, offices_df=offices_df)
+    timings['collection'] = time.perf_counter() - start
+
+    result = {'city': city, 'centroid': None, 'offices': len(offices_df), 'office_scores': [], 'timings': timings}
+    if offices_df.empty:
+        timings['venues'] = timings['scoring'] = 0.0
+        return result
+
+    centroid = (float(offices_df['latitude'].mean()), float(offices_df['longitude'].mean()))
+    result['centroid'] = centroid
+
+    start = time.perf_counter()
+    queries = {query: pipeline.VENUE_LIMITS.get(venue_type, limit) for venue_type, query in scoring.VENUE_QUERIES.items()}
+    places = api.fetch_many(queries, ll=centroid, token=token, rate=rate)
+    venues = scoring.venue_arrays({venue_type: api.venues_to_dataframe(places[query], query)
+                                   for venue_type, query in scoring.VENUE_QUERIES.items()})
+    timings['venues'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    office_coords = offices_df[['longitude', 'latitude']].to_numpy(dtype=float)
+    scores = scoring.score_offices(office_coords, venues)
+    office_scores = scoring.rank_offices(offices_df['name'].tolist(), office_coords, scores)
+    for office in office_scores:
+        office['city'] = city
+    result['office_scores'] = office_scores
+    timings['scoring'] = time.perf_counter() - start
+
+    return result
+
+
+def run_cities(cities=None, top_n=5, condition1=None, condition2=None, workers=None,
+               min_employees=pipeline.MIN_EMPLOYEES, max_employees=pipeline.MAX_EMPLOYEES, limit=pipeline.LIMIT):
+    """
+    Run the pipeline for several cities concurrently, one worker process per city, and merge
+    the results into a single cross-city ranking.
+
+    Parameters:
+    - cities: Cities to run. Defaults to the top_n cities from count_offices_by_condition.
+    - top_n: Number of cities when cities is not given.
+    - condition1, condition2: Conditions for count_offices_by_condition. Default to the
+      games_video / funding > $1M pair.
+    - workers: Worker processes. Defaults to one per city.
+    - min_employees, max_employees, limit: As in pipeline.run().
+
+    Returns:
+    - A dict with 'ranking' (all offices, best first), 'cities' (per-city results in the
+      input order) and 'wall_time' in seconds.
+    """
+    start = time.perf_counter()
+
+    if cities is None:
+        default1, default2 = pipeline.CONDITIONS['games_video']
+        _, collection = mongo.connection_database(pipeline.DATABASE, pipeline.COMPANIES)
+        cities = top_cities(collection, condition1 or default1, condition2 or default2, top_n)
+
+    if not cities:
+        return {'ranking': [], 'cities': [], 'wall_time': time.perf_counter() - start}
+
+    workers = workers or len(cities)
+    # The Foursquare quota is shared, so each worker gets its slice of it
+    rate = api.RATE_LIMIT / min(workers, len(cities))
+    token = api.get_token()
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_city, city, min_employees, max_employees, limit, rate, token): city
+                   for city in cities}
+        for future in as_completed(futures):
+            city = futures[future]
+            try:
+                results[city] = future.result()
+            except Exception as e:
+                print(f"An error occurred in {city}: {e}")
+                results[city] = {'city': city, 'centroid': None, 'offices': 0, 'office_scores': [],
+                                 'timings': {}, 'error': str(e)}
+
+    ranking = [office for city in cities for office in results[city]['office_scores']]
+    ranking.sort(key=lambda x: x['score'], reverse=True)
+
+    return {'ranking': ranking, 'cities': [results[city] for city in cities], 'wall_time': time.perf_counter() - start}
+
+
+def format_timings(result):
+    """
+    Per-city wall-clock breakdown of a run_cities() result as a text table.
+    """
+    lines = [f"{'city':<20}" + ''.join(f"{stage:>12}" for stage in STAGES) + f"{'total':>12}{'offices':>10}"]
+    for city_result in result['cities']:
+        timings = city_result['timings']
+        lines.append(f"{city_result['city'][:20]:<20}"
+                     + ''.join(f"{timings.get(stage, 0.0):>12.3f}" for stage in STAGES)
+                     + f"{sum(timings.values()):>12.3f}{city_result['offices']:>10}")
+    lines.append(f"wall time: {result['wall_time']:.3f} s")
+    return '\n'.join(lines)
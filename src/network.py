@@ -0,0 +1,306 @@
+import os
+import json
+import heapq
+import hashlib
+import tempfile
+from . import matrix
+from . import metrics
+from . import scoring
+from . import spatial
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+
+
+# Street-network distances. Straight lines misjudge access across hills, the bay and
+# freeways, so this mode measures walking distance along a street graph instead: one
+# multi-source Dijkstra per venue category gives every graph node its distance to the
+# nearest venue, and an office then costs one nearest-node lookup.
+GRAPH_FILE = './data/network/san_francisco.npz'
+NODES = 'nodes'  # venue type of the graph nodes in the snapping index
+MIN_LENGTH = 1e-6  # meters; zero-length edges are stored with this length so sparse matrices keep them
+
+
+def has_scipy():
+    try:
+        import scipy.sparse.csgraph  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class StreetGraph:
+    """
+    Street graph as a CSR adjacency of arcs pointing *towards* the venues: every street
+    segment u-v is stored as v -> u (and u -> v unless it is one-way), so a search started
+    from the venue nodes yields the distance from each node to its nearest venue.
+
+    Parameters:
+    - lat, lng: (N,) node coordinates in degrees.
+    - source, target: (E,) node positions of each street segment.
+    - length: (E,) segment lengths in meters. Defaults to the ellipsoidal distance between
+      the two nodes.
+    - oneway: (E,) booleans; one-way segments can only be travelled from source to target.
+    """
+
+    def __init__(self, lat, lng, source, target, length=None, oneway=None):
+        self.lat = np.asarray(lat, dtype=float).reshape(-1)
+        self.lng = np.asarray(lng, dtype=float).reshape(-1)
+        source = np.asarray(source, dtype=np.int64).reshape(-1)
+        target = np.asarray(target, dtype=np.int64).reshape(-1)
+        if length is None:
+            length = scoring.pair_distances(self.lat[source], self.lng[source], self.lat[target], self.lng[target])
+        length = np.maximum(np.asarray(length, dtype=float).reshape(-1), MIN_LENGTH)
+        two_way = np.ones(len(source), dtype=bool) if oneway is None else ~np.asarray(oneway, dtype=bool).reshape(-1)
+
+        tails = np.concatenate([target, source[two_way]])
+        heads = np.concatenate([source, target[two_way]])
+        weights = np.concatenate([length, length[two_way]])
+
+        # Keep the shortest of parallel arcs (sparse matrices would add them up)
+        order = np.lexsort((weights, heads, tails))
+        tails, heads, weights = tails[order], heads[order], weights[order]
+        keep = np.ones(len(tails), dtype=bool)
+        keep[1:] = (tails[1:] != tails[:-1]) | (heads[1:] != heads[:-1])
+        tails, heads, weights = tails[keep], heads[keep], weights[keep]
+
+        self.indptr = np.zeros(len(self.lat) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tails, minlength=len(self.lat)), out=self.indptr[1:])
+        self.indices = heads
+        self.weights = weights
+        self._index = None
+        self._version = None
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a graph converted offline (e.g. from an OSM extract with osmnx):
+
+        - .npz with arrays 'lat', 'lng', 'source', 'target' and optionally 'length', 'oneway';
+        - .json with {'nodes': [[id, lat, lng], ...], 'edges': [[u, v, length?, oneway?], ...]}
+          where u and v are node ids.
+        """
+        if path.endswith('.json'):
+            with open(path, 'r') as file:
+                data = json.load(file)
+            positions = {node[0]: position for position, node in enumerate(data['nodes'])}
+            edges = data['edges']
+            lengths = [edge[2] if len(edge) > 2 and edge[2] is not None else np.nan for edge in edges]
+            length = np.array(lengths, dtype=float)
+            graph = cls([node[1] for node in data['nodes']], [node[2] for node in data['nodes']],
+                        [positions[edge[0]] for edge in edges], [positions[edge[1]] for edge in edges],
+                        None if np.isnan(length).any() else length,
+                        [bool(edge[3]) if len(edge) > 3 else False for edge in edges])
+        else:
+            with np.load(path) as data:
+                graph = cls(data['lat'], data['lng'], data['source'], data['target'],
+                            data['length'] if 'length' in data else None, data['oneway'] if 'oneway' in data else None)
+        return graph
+
+    @property
+    def size(self):
+        return len(self.lat)
+
+    @property
+    def version(self):
+        """
+        Checksum of the nodes and arcs, stored with the precomputed node distances.
+        """
+        if self._version is None:
+            digest = hashlib.sha1()
+            for values in (self.lat, self.lng, self.indptr, self.indices, self.weights):
+                digest.update(np.ascontiguousarray(values).tobytes())
+            self._version = digest.hexdigest()
+        return self._version
+
+    def snap(self, lat, lng):
+        """
+        Nearest graph node of each point.
+
+        Returns:
+        - A tuple (nodes, offsets): the node positions and the straight-line distance in meters
+          from each point to its node.
+        """
+        if self._index is None:
+            self._index = spatial.VenueIndex.from_arrays({NODES: np.column_stack([self.lng, self.lat])})
+        return self._index.nearest_many(NODES, lat, lng)
+
+    def distances_from(self, nodes, offsets=None, limit=None):
+        """
+        Multi-source Dijkstra: distance from every node to the closest of the given nodes,
+        each starting with its offset (e.g. how far the venue is from the street).
+
+        Parameters:
+        - nodes: (s,) source node positions.
+        - offsets: (s,) initial distances in meters. Defaults to 0.
+        - limit: Stop the search at this distance; farther nodes get inf.
+
+        Returns:
+        - An (N,) array of distances in meters, inf where no source is reachable.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64).reshape(-1)
+        offsets = np.zeros(len(nodes)) if offsets is None else np.asarray(offsets, dtype=float).reshape(-1)
+        if not len(nodes):
+            return np.full(self.size, np.inf)
+
+        # One start per node, with the smallest offset of the sources snapped to it
+        start = np.full(self.size, np.inf)
+        np.minimum.at(start, nodes, offsets)
+        nodes = np.flatnonzero(np.isfinite(start))
+        offsets = start[nodes]
+
+        with metrics.timer('network.dijkstra'):
+            if has_scipy():
+                return self._scipy_distances(nodes, offsets, limit)
+            return self._heap_distances(nodes, offsets, limit)
+
+    def _scipy_distances(self, nodes, offsets, limit):
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import dijkstra
+
+        # A virtual super-source linked to every start node by its offset turns the
+        # multi-source search into one single-source run
+        size = self.size + 1
+        indptr = np.append(self.indptr, self.indptr[-1] + len(nodes))
+        indices = np.concatenate([self.indices, nodes])
+        weights = np.concatenate([self.weights, np.maximum(offsets, MIN_LENGTH)])
+        graph = csr_matrix((weights, indices, indptr), shape=(size, size))
+        distances = dijkstra(graph, directed=True, indices=self.size, limit=np.inf if limit is None else limit)
+        return distances[:self.size]
+
+    def _heap_distances(self, nodes, offsets, limit):
+        limit = np.inf if limit is None else limit
+        distances = np.full(self.size, np.inf)
+        distances[nodes] = offsets
+        heap = [(float(offset), int(node)) for node, offset in zip(nodes, offsets)]
+        heapq.heapify(heap)
+        indptr, indices, weights = self.indptr, self.indices.tolist(), self.weights.tolist()
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node] or distance > limit:
+                continue
+            for arc in range(indptr[node], indptr[node + 1]):
+                candidate = distance + weights[arc]
+                head = indices[arc]
+                if candidate < distances[head] and candidate <= limit:
+                    distances[head] = candidate
+                    heapq.heappush(heap, (candidate, head))
+        return distances
+
+
+def load_graph(path=GRAPH_FILE):
+    with metrics.timer('network.load'):
+        return StreetGraph.from_file(path)
+
+
+def node_distances(graph, venue_coords, limit=None):
+    """
+    Distance from every graph node to the nearest venue of one category, along the streets
+    plus the straight-line gap between the venue and its node.
+
+    Parameters:
+    - graph: StreetGraph.
+    - venue_coords: (m, 2) array of [longitude, latitude].
+    - limit: Search radius in meters (farther nodes get inf).
+
+    Returns:
+    - An (N,) array of distances in meters.
+    """
+    venue_coords = np.asarray(venue_coords, dtype=float).reshape(-1, 2)
+    nodes, offsets = graph.snap(venue_coords[:, 1], venue_coords[:, 0])
+    found = nodes >= 0
+    return graph.distances_from(nodes[found], offsets[found], limit)
+
+
+def cache_file(graph_path):
+    return f'{graph_path}.distances.npz'
+
+
+def precompute(graph, venues_by_type, path=None, limit=None):
+    """
+    Node distances of every venue category, reusing the categories of a cache file whose
+    graph, venues (matrix.category_version) and limit did not change.
+
+    Parameters:
+    - graph: StreetGraph.
+    - venues_by_type: Dict mapping venue type to an (m, 2) array of [longitude, latitude].
+    - path: Optional .npz cache file, rewritten when a category was recomputed.
+    - limit: Search radius in meters, see node_distances().
+
+    Returns:
+    - A dict mapping venue type to its (N,) node distances.
+    """
+    cached, versions = {}, {}
+    if path and os.path.exists(path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('graph') == graph.version and meta.get('limit') == limit:
+                versions = meta['categories']
+                cached = {venue_type: data[f'category_{position}'] for position, venue_type in enumerate(versions)}
+
+    result, current = {}, {}
+    for venue_type, coords in venues_by_type.items():
+        current[venue_type] = matrix.category_version(coords)
+        if venue_type in cached and versions[venue_type] == current[venue_type]:
+            result[venue_type] = cached[venue_type]
+            metrics.count('network.cached_categories')
+        else:
+            result[venue_type] = node_distances(graph, coords, limit)
+            metrics.count('network.searches')
+
+    if path and current != versions:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.npz')
+        os.close(fd)
+        arrays = {f'category_{position}': result[venue_type] for position, venue_type in enumerate(current)}
+        np.savez(tmp_path, meta=json.dumps({'graph': graph.version, 'limit': limit, 'categories': current}), **arrays)
+        os.replace(tmp_path, path)
+    return result
+
+
+def office_distances(graph, distances_by_type, office_coords, venue_types):
+    """
+    Network distance from each office to the nearest venue of each category: the office is
+    snapped to its nearest node once, then every category is a single array lookup.
+
+    Parameters:
+    - graph: StreetGraph.
+    - distances_by_type: Dict mapping venue type to its (N,) node distances (see precompute()).
+    - office_coords: (n, 2) array of [longitude, latitude].
+    - venue_types: The k venue types (columns of the result).
+
+    Returns:
+    - An (n, k) array of distances in meters (inf when unreachable or without venues).
+    """
+    office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+    nodes, offsets = graph.snap(office_coords[:, 1], office_coords[:, 0])
+    result = np.full((len(office_coords), len(venue_types)), np.inf)
+    found = nodes >= 0
+    for column, venue_type in enumerate(venue_types):
+        if venue_type in distances_by_type:
+            result[found, column] = offsets[found] + distances_by_type[venue_type][nodes[found]]
+    return result
+
+
+def score_offices(office_coords, venues_by_type, graph, weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE,
+                  cache_path=None):
+    """
+    Network-distance version of scoring.score_offices(): the nearest-venue score with
+    walking distances along the street graph instead of straight lines.
+
+    Parameters:
+    - office_coords: (n, 2) array of [longitude, latitude].
+    - venues_by_type: Dict mapping venue type to an (m, 2) array of [longitude, latitude].
+    - graph: StreetGraph.
+    - weights, max_distance: As in scoring.score_offices().
+    - cache_path: Optional cache file of the node distances (see precompute()).
+
+    Returns:
+    - A NumPy array of shape (n,) with the unrounded score of each office.
+    """
+    venue_types = list(weights)
+    distances_by_type = precompute(graph, {venue_type: venues_by_type[venue_type] for venue_type in venue_types
+                                           if venue_type in venues_by_type}, cache_path)
+    distances = office_distances(graph, distances_by_type, office_coords, venue_types)
+    return scoring.score_distances(distances, venue_types, weights, max_distance)
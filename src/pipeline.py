@@ -0,0 +1,321 @@
+from . import api
+from . import crawl
+from . import density
+from . import grid
+from . import indexes
+from . import maps
+from . import matrix
+from . import metrics
+from . import mongo
+from . import network
+from . import profiles
+from . import scoring
+from . import spatial
+from . import store
+from . import topk
+
+
+DATABASE = mongo.DATABASE
+COMPANIES = "Companies"
+
+CITY = "San Francisco"
+CENTER = (37.7804301, -122.4103305)  # Center of San Francisco
+LIMIT = 30
+VENUE_LIMITS = {'df_airport': 5, 'df_ferry': 5}
+
+MIN_EMPLOYEES = 87
+MAX_EMPLOYEES = 150
+OFFICES_COLLECTION = 'san_francisco_offices'
+
+FUNDING = {"funding_rounds.raised_amount": {"$gt": 1000000}}
+CONDITIONS = {
+    'games_video': ({"category_code": "games_video"}, FUNDING),
+    'design_web': ({"category_code": {"$in": ["design", "web"]}}, FUNDING),
+}
+
+
+def count_stage(collection, conditions=CONDITIONS):
+    """
+    Count offices per city for each named pair of conditions, all in one aggregation.
+
+    Returns:
+    - A dict mapping each condition name to a Series with the office count per city.
+    """
+    with metrics.stage('count'):
+        return mongo.count_offices_by_conditions(collection, conditions)
+
+
+def offices_stage(db, collection, city=CITY, min_employees=MIN_EMPLOYEES, max_employees=MAX_EMPLOYEES,
+                  collection_name=OFFICES_COLLECTION):
+    """
+    Find the candidate offices of a city and store them in their own geo-indexed collection.
+    """
+    with metrics.stage('offices'):
+        return mongo.insert_offices_data_create_index(city, min_employees, max_employees, collection_name, db, collection)
+
+
+def load_venues(latitude=CENTER[0], longitude=CENTER[1], limit=LIMIT, token=None):
+    """
+    Load every venue category around a point (from the cache or the Foursquare API).
+
+    Returns:
+    - A dict mapping venue collection name (e.g. 'df_bars') to its venue DataFrame.
+    """
+    token = token or api.get_token()
+    with metrics.stage('load_venues'):
+        return {
+            venue_type: api.get_venues_dataframe(query, token, latitude=latitude, longitude=longitude,
+                                                 limit=VENUE_LIMITS.get(venue_type, limit))
+            for venue_type, query in scoring.VENUE_QUERIES.items()
+        }
+
+
+def crawl_stage(bbox=grid.SAN_FRANCISCO_BBOX, queries=None, token=None, **options):
+    """
+    Crawl every venue of each category inside a bounding box with the adaptive quadtree
+    crawler (resumable, see crawl.crawl).
+
+    Returns:
+    - A dict mapping venue collection name to its venue DataFrame, like load_venues().
+    """
+    with metrics.stage('crawl'):
+        return crawl.crawl_venues(bbox, queries, token, **options)
+
+
+def load_venue_store(latitude=CENTER[0], longitude=CENTER[1], limit=LIMIT, token=None, directory=store.STORE_DIR):
+    """
+    Columnar version of load_venues(): the venues of every category around a point are kept
+    in a memory-mapped store.VenueStore that is rebuilt only when the cached JSON behind it
+    changes. Categories that are not cached (or whose cache entry expired) are fetched first.
+
+    Returns:
+    - The refreshed store.VenueStore; use .dataframes() or .arrays().
+    """
+    venue_store = store.VenueStore(directory)
+    token = token or api.get_token()
+    with metrics.stage('load_venues'):
+        sources = {}
+        for venue_type, query in scoring.VENUE_QUERIES.items():
+            venue_limit = VENUE_LIMITS.get(venue_type, limit)
+            path = api.venue_cache.source(query, latitude, longitude, None, venue_limit)
+            if path is None or venue_store.expired(venue_type, api.venue_cache.ttl):
+                api.foursquare_places(query, token, latitude=latitude, longitude=longitude, limit=venue_limit)
+                path = api.venue_cache.source(query, latitude, longitude, None, venue_limit)
+            if path is not None:
+                sources[venue_type] = {'path': path, 'query': query, 'limit': venue_limit}
+        venue_store.refresh(sources)
+    return venue_store
+
+
+def venues_stage(db, venues_by_type, sync=False):
+    """
+    Store the venues in MongoDB so they can be queried with $near. With sync=True they are
+    upserted incrementally into the single venues collection instead of reloading one
+    collection per category.
+    """
+    with metrics.stage('venues'):
+        if sync:
+            return mongo.sync_venues(db, venues_by_type)
+        return mongo.converting_to_collection(db, venues_by_type)
+
+
+def score_stage(batch=False, sync=False, use_async=False, mode='nearest', k=density.K, saturation=density.SATURATION,
+                network_graph=None, tier=None, offices_collection=OFFICES_COLLECTION, index_backend=None):
+    """
+    Rank the stored offices by proximity to the stored venues. use_async issues the $near
+    queries concurrently through the Motor client instead of one after another.
+
+    With a mode other than 'nearest' (see density.MODES) the offices are scored on venue
+    density instead: venue counts, Gaussian-kernel sums or k-nearest averages within each
+    category cutoff, computed on an in-memory spatial index.
+
+    With network_graph (path of a street graph, see network.StreetGraph.from_file) the
+    nearest-venue distances are walking distances along the streets; the per-category node
+    distances are cached next to the graph file.
+
+    tier (see distance.TIERS) evaluates the nearest-venue distances on a cheap bound first and
+    only solves the exact geodesic near the category cutoffs.
+
+    index_backend ('kdtree', 'grid' or 'mongo', see spatial.build_venue_index) looks the
+    nearest venues up in a spatial index built once over the stored venues instead of with
+    one $near query per office and category (per-office scoring only, not batch or async).
+    """
+    venues_collection = mongo.VENUES_COLLECTION if sync else None
+    if network_graph and mode != 'nearest':
+        raise ValueError("Street-network distances only support the 'nearest' scoring mode")
+    with metrics.stage('score'):
+        if mode != 'nearest' or network_graph:
+            db = mongo.get_database(DATABASE)
+            names, office_coords, venues = mongo.load_scoring_arrays(db, offices_collection, list(scoring.WEIGHTS),
+                                                                     venues_collection)
+            if network_graph:
+                scores = network.score_offices(office_coords, venues, network.load_graph(network_graph),
+                                               cache_path=network.cache_file(network_graph))
+            else:
+                scores = density.score_offices(office_coords, venues, mode, k=k, saturation=saturation)
+            return scoring.rank_offices(names, office_coords, scores)
+        if use_async and not batch:
+            from . import mongo_async
+
+            return mongo_async.run(mongo_async.best_office_location(offices_collection, venues_collection, tier=tier))
+        index = None
+        if index_backend and not batch:
+            db = mongo.get_database(DATABASE)
+            venues = None if index_backend == 'mongo' else \
+                mongo.load_venue_arrays(db, list(scoring.WEIGHTS), venues_collection)
+            with metrics.timer('spatial.build'):
+                index = spatial.build_venue_index(venues, index_backend, db, venues_collection)
+        return mongo.best_office_location(batch=batch, index=index, venues_collection=venues_collection, tier=tier,
+                                          offices_collection=offices_collection)
+
+
+def rerank_stage(weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE, sync=False, refresh=True,
+                 offices_collection=OFFICES_COLLECTION):
+    """
+    Rank the stored offices from the materialized distance matrix (matrix.py): only stale
+    cells are recomputed, then any weights and cutoffs are applied in memory.
+    """
+    venues_collection = mongo.VENUES_COLLECTION if sync else None
+    with metrics.stage('rerank'):
+        return matrix.best_office_location(weights, max_distance, offices_collection, venues_collection,
+                                           refresh=refresh)
+
+
+def profiles_stage(weight_profiles, k=10, samples=0, noise=0.2, sync=False, refresh=True,
+                   offices_collection=OFFICES_COLLECTION):
+    """
+    Rank the stored offices under many weight profiles at once from the distance matrix,
+    optionally with rank-stability statistics under perturbed weights.
+
+    Returns:
+    - The dict returned by profiles.bulk_rank().
+    """
+    venues_collection = mongo.VENUES_COLLECTION if sync else None
+    with metrics.stage('profiles'):
+        db = mongo.get_database(DATABASE)
+        if refresh:
+            matrix.refresh_distance_matrix(db, offices_collection, venues_collection=venues_collection)
+        return profiles.bulk_rank(matrix.load_distance_matrix(db, offices_collection), weight_profiles, k=k,
+                                  samples=samples, noise=noise)
+
+
+def map_stage(office_scores, venues_by_type, map_file=mongo.MAP_FILE, open_browser=True, fast=False):
+    """
+    Render the best office and its surrounding venues with folium.
+    """
+    with metrics.stage('map'):
+        return mongo.final_location(office_scores, venues_by_type, map_file, open_browser=open_browser, fast=fast)
+
+
+def maps_stage(office_scores, venues_by_type, directory='./maps/offices', top=None, layer='cluster'):
+    """
+    Render one headless map per ranked office with the fast renderer.
+
+    Returns:
+    - The list of written map files.
+    """
+    with metrics.stage('maps'):
+        return maps.render_office_maps(office_scores, venues_by_type, directory, top=top, layer=layer)
+
+
+def grid_stage(venues_by_type, bbox=grid.SAN_FRANCISCO_BBOX, spacing=grid.SPACING, top_n=20, workers=None,
+               raster_path='./data/grid/scores.npy', geojson_path=None, map_file=None, network_graph=None, tier=None):
+    """
+    Score every point of a lattice over the city and write the raster, GeoJSON and heatmap.
+    With network_graph the cells are scored on street-network distances, with tier on
+    tiered straight-line distances (see score_stage).
+
+    Returns:
+    - The dict returned by grid.grid_search().
+    """
+    street_network = None
+    if network_graph:
+        with metrics.stage('grid.network'):
+            graph = network.load_graph(network_graph)
+            street_network = (graph, network.precompute(graph, scoring.venue_arrays(venues_by_type),
+                                                        network.cache_file(network_graph)))
+    with metrics.stage('grid'):
+        result = grid.grid_search(venues_by_type, bbox, spacing, top_n=top_n, workers=workers, raster_path=raster_path,
+                                  network=street_network, tier=tier)
+    if geojson_path:
+        with metrics.stage('grid.geojson'):
+            grid.write_geojson(result, geojson_path, min_score=0.01)
+    if map_file:
+        with metrics.stage('grid.heatmap'):
+            grid.render_heatmap(result, map_file)
+    return result
+
+
+def topk_stage(k=10, source='offices', sync=False, min_employees=MIN_EMPLOYEES, max_employees=MAX_EMPLOYEES,
+               venues_by_type=None, bbox=grid.SAN_FRANCISCO_BBOX, spacing=grid.SPACING, cell_size=None,
+               offices_collection=OFFICES_COLLECTION):
+    """
+    The k best candidates by branch and bound (see topk.top_k), the same as scoring every
+    candidate and keeping the first k.
+
+    Parameters:
+    - source: 'offices' (the stored offices_collection), 'companies' (every office of every
+      company in Companies matching the employee range, across all cities) or 'grid' (the
+      lattice of grid_stage over bbox at spacing).
+    - sync: Read the stored venues from the single venues collection.
+    - venues_by_type: Venue DataFrames for the 'grid' source. The other sources score
+      against the venues stored in MongoDB.
+
+    Returns:
+    - For 'offices' and 'companies' a list in the shape of scoring.rank_offices() (with
+      'city' for 'companies'); for 'grid' the cells in the shape of grid_search()'s 'top'.
+    """
+    venues_collection = mongo.VENUES_COLLECTION if sync else None
+    with metrics.stage('topk'):
+        if source == 'grid':
+            return topk.grid_top_k(venues_by_type, bbox, spacing, k, cell_size=cell_size)
+
+        db = mongo.get_database(DATABASE)
+        if source == 'companies':
+            offices_df = mongo.find_offices_by_criteria(db[COMPANIES], None, min_employees, max_employees)
+            if offices_df.empty:
+                return []
+            offices_df = offices_df.reset_index(drop=True)
+            names = offices_df['name'].tolist()
+            office_coords = offices_df[['longitude', 'latitude']].to_numpy(dtype=float)
+            venues = mongo.load_venue_arrays(db, list(scoring.WEIGHTS), venues_collection)
+        else:
+            names, office_coords, venues = mongo.load_scoring_arrays(db, offices_collection, list(scoring.WEIGHTS),
+                                                                     venues_collection)
+        positions, scores = topk.top_k(office_coords, venues, k, cell_size=cell_size or topk.CELL_SIZE)
+        office_scores = scoring.rank_offices([names[position] for position in positions], office_coords[positions],
+                                             scores)
+        if source == 'companies':
+            # positions are already best first, so rank_offices() kept their order
+            for office, position in zip(office_scores, positions.tolist()):
+                office['city'] = offices_df['city'].iloc[position]
+        return office_scores
+
+
+def run(city=CITY, center=CENTER, limit=LIMIT, min_employees=MIN_EMPLOYEES, max_employees=MAX_EMPLOYEES,
+        collection_name=OFFICES_COLLECTION, batch=False, sync=False, render_map=True):
+    """
+    Run the whole pipeline: count offices, store the candidate offices, load and store the
+    venues, score the offices and render the map of the winner.
+
+    Returns:
+    - The ranked office_scores list.
+    """
+    db, collection = mongo.connection_database(DATABASE, COMPANIES)
+    indexes.ensure_indexes(collection)
+
+    for name, counts in count_stage(collection).items():
+        print(f"Offices by city ({name}):")
+        print(counts.head(10).to_string())
+
+    print(offices_stage(db, collection, city, min_employees, max_employees, collection_name))
+
+    venues_by_type = load_venues(center[0], center[1], limit)
+    venues_stage(db, venues_by_type, sync=sync)
+
+    office_scores = score_stage(batch=batch, sync=sync, offices_collection=collection_name)
+
+    if render_map and office_scores:
+        map_stage(office_scores, venues_by_type)
+
+    return office_scores
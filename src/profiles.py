@@ -0,0 +1,198 @@
+import json
+from . import scoring
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+
+
+# Elements of the (profiles x offices x categories) block scored at once when cutoffs differ
+# between profiles; bounds memory to a few tens of MB
+PROFILE_BLOCK = 4 * 1024 * 1024
+
+
+def profile_arrays(profiles, venue_types, weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE):
+    """
+    Convert weight profiles to the arrays score_profiles() works on.
+
+    Parameters:
+    - profiles: Dict mapping profile name to a profile, or a list of profiles (named by
+      position). A profile is a dict with optional 'weights' and 'max_distance' dicts keyed by
+      venue type, or directly a weights dict. Missing entries fall back to the defaults.
+    - venue_types: The k venue types, in the column order of the distance matrix.
+    - weights, max_distance: Defaults for entries a profile does not set.
+
+    Returns:
+    - A tuple (names, weights, max_distance) with two (p, k) arrays.
+    """
+    if not isinstance(profiles, dict):
+        profiles = {str(position): profile for position, profile in enumerate(profiles)}
+
+    names = list(profiles)
+    weight_rows = []
+    cutoff_rows = []
+    for name in names:
+        profile = profiles[name]
+        if 'weights' not in profile and 'max_distance' not in profile:
+            profile = {'weights': profile}
+        profile_weights = {**weights, **profile.get('weights', {})}
+        profile_cutoffs = {**max_distance, **profile.get('max_distance', {})}
+        weight_rows.append([profile_weights.get(venue_type, 0.0) for venue_type in venue_types])
+        cutoff_rows.append([profile_cutoffs.get(venue_type, scoring.DEFAULT_MAX_DISTANCE) for venue_type in venue_types])
+
+    shape = (len(names), len(venue_types))
+    return names, np.array(weight_rows, dtype=float).reshape(shape), np.array(cutoff_rows, dtype=float).reshape(shape)
+
+
+def score_profiles(distances, weights, max_distance):
+    """
+    Score every office under every profile in one vectorized pass.
+
+    When all profiles share the same cutoffs the normalized distances are computed once and
+    the scores are a single (p, k) x (k, n) matrix product; otherwise profiles are scored in
+    blocks of PROFILE_BLOCK elements.
+
+    Parameters:
+    - distances: (n, k) nearest-venue distances (inf when a category has no venues), e.g.
+      from matrix.load_distance_matrix().
+    - weights: (p, k) array of weights.
+    - max_distance: (p, k) array of cutoffs in meters, or (k,) when shared by all profiles.
+
+    Returns:
+    - A (p, n) array of unrounded scores.
+    """
+    distances = np.asarray(distances, dtype=float)
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    max_distance = np.asarray(max_distance, dtype=float)
+
+    if max_distance.ndim == 1 or np.all(max_distance == max_distance[:1]):
+        cutoffs = max_distance if max_distance.ndim == 1 else max_distance[0]
+        return weights @ scoring.normalized_scores(distances, cutoffs[None, :]).T
+
+    scores = np.empty((len(weights), len(distances)))
+    block = max(1, PROFILE_BLOCK // max(distances.size, 1))
+    for start in range(0, len(weights), block):
+        cutoffs = max_distance[start:start + block, None, :]
+        normalized = scoring.normalized_scores(distances[None, :, :], cutoffs)
+        scores[start:start + block] = np.einsum('pnk,pk->pn', normalized, weights[start:start + block])
+    return scores
+
+
+def top_k(scores, k=10):
+    """
+    Indices of the k best offices of each profile, best first. Ties keep the office order.
+
+    Returns:
+    - A (p, min(k, n)) array of office indices.
+    """
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((len(scores), 0), dtype=int)
+    return np.argsort(-scores, axis=1, kind='stable')[:, :k]
+
+
+def ranks(scores):
+    """
+    Rank (0 = best) of every office under every profile, ties broken by office order.
+    """
+    scores = np.atleast_2d(scores)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    result = np.empty_like(order)
+    np.put_along_axis(result, order, np.arange(scores.shape[1])[None, :], axis=1)
+    return result
+
+
+def perturbed_weights(weights, samples=1000, noise=0.2, seed=0):
+    """
+    Random variations of one weight profile: each weight is multiplied by lognormal noise
+    of the given sigma and the profile is rescaled to the original total weight.
+
+    Returns:
+    - A (samples, k) array of weights.
+    """
+    weights = np.asarray(weights, dtype=float)
+    rng = np.random.default_rng(seed)
+    perturbed = weights[None, :] * rng.lognormal(0.0, noise, size=(samples, len(weights)))
+    totals = perturbed.sum(axis=1, keepdims=True)
+    return np.divide(perturbed * weights.sum(), totals, out=np.zeros_like(perturbed), where=totals > 0)
+
+
+def rank_stability(names, distances, weights, max_distance, samples=1000, noise=0.2, top=3, seed=0):
+    """
+    How robust the ranking of one profile is to its exact weights: score all offices under
+    `samples` randomly perturbed copies of it and summarize each office's rank.
+
+    Parameters:
+    - names: The n office names.
+    - distances: (n, k) nearest-venue distances.
+    - weights: (k,) weights of the profile.
+    - max_distance: (k,) cutoffs of the profile.
+    - samples, noise, seed: See perturbed_weights().
+    - top: Size of the top group counted in 'top_share'.
+
+    Returns:
+    - A list of dicts with 'office', 'top_share' (fraction of samples where it ranks in the
+      top `top`), 'mean_rank', 'rank_std', 'best_rank' and 'worst_rank' (1 = best), sorted by
+      top_share then mean_rank.
+    """
+    sample_weights = perturbed_weights(weights, samples, noise, seed)
+    sample_ranks = ranks(score_profiles(distances, sample_weights, np.asarray(max_distance, dtype=float))) + 1
+
+    stats = [
+        {
+            'office': name,
+            'top_share': float(np.mean(sample_ranks[:, column] <= top)),
+            'mean_rank': float(sample_ranks[:, column].mean()),
+            'rank_std': float(sample_ranks[:, column].std()),
+            'best_rank': int(sample_ranks[:, column].min()),
+            'worst_rank': int(sample_ranks[:, column].max())
+        }
+        for column, name in enumerate(names)
+    ]
+    stats.sort(key=lambda x: (-x['top_share'], x['mean_rank']))
+    return stats
+
+
+def bulk_rank(matrix, profiles, k=10, samples=0, noise=0.2, top=3, seed=0):
+    """
+    Rank the offices of a distance matrix under many profiles at once.
+
+    Parameters:
+    - matrix: Tuple (names, office_coords, distances, venue_types) from matrix.load_distance_matrix().
+    - profiles: See profile_arrays().
+    - k: Offices kept per profile.
+    - samples: When > 0, also compute rank_stability() of every profile with that many
+      perturbed samples.
+    - noise, top, seed: See rank_stability().
+
+    Returns:
+    - A dict mapping each profile name to {'top': [office_scores entries, best first]} and,
+      with samples, 'stability' (the first k entries of rank_stability()).
+    """
+    names, office_coords, distances, venue_types = matrix
+    profile_names, weights, max_distance = profile_arrays(profiles, venue_types)
+    scores = score_profiles(distances, weights, max_distance)
+    best = top_k(scores, k)
+    office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+
+    result = {}
+    for row, profile_name in enumerate(profile_names):
+        result[profile_name] = {
+            'top': [
+                {'office': names[column], 'score': round(float(scores[row, column]), 2),
+                 'location': [float(office_coords[column, 0]), float(office_coords[column, 1])]}
+                for column in best[row]
+            ]
+        }
+        if samples:
+            result[profile_name]['stability'] = rank_stability(names, distances, weights[row], max_distance[row],
+                                                               samples, noise, top, seed)[:k]
+    return result
+
+
+def load_profiles(path):
+    """
+    Read profiles from a JSON file: an object of named profiles or a list (see profile_arrays).
+    """
+    with open(path, 'r') as file:
+        return json.load(file)
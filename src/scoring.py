@@ -0,0 +1,262 @@
+from . import metrics
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+
+
+# Maximum distance (meters) at which a venue category still contributes to the score
+MAX_DISTANCE = {
+    'df_school': 3000,
+    'df_grooming': 1000,
+    'df_basketball': 10000,
+    'df_vegan': 1000,
+    'df_ferry': 5000,
+    'df_train': 1000,
+    'df_airport': 20000,
+    'df_clubs': 1000,
+    'df_bars': 1000,
+    'df_starbucks': 1000,
+    'df_design_talks': 1000
+}
+
+WEIGHTS = {
+    'df_school': 0.1,
+    'df_grooming': 0.05,
+    'df_basketball': 0.05,
+    'df_vegan': 0.15,
+    'df_ferry': 0.05,
+    'df_train': 0.05,
+    'df_airport': 0.05,
+    'df_clubs': 0.1,
+    'df_bars': 0.1,
+    'df_starbucks': 0.15,
+    'df_design_talks': 0.15
+}
+
+DEFAULT_MAX_DISTANCE = 1000
+
+# Foursquare query behind each venue collection
+VENUE_QUERIES = {
+    'df_school': 'school',
+    'df_grooming': 'pet grooming',
+    'df_basketball': 'basketball stadium',
+    'df_vegan': 'vegan restaurant',
+    'df_ferry': 'ferry',
+    'df_train': 'train station',
+    'df_airport': 'airport',
+    'df_clubs': 'night club',
+    'df_bars': 'bar',
+    'df_starbucks': 'starbucks',
+    'df_design_talks': 'design talks'
+}
+
+# WGS-84 ellipsoid, the same one geopy's geodesic uses
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+# Venues per block in nearest_distances, bounds the distance matrix to len(offices) x VENUE_BLOCK
+VENUE_BLOCK = 2048
+# ...and offices x venues per block to PAIR_BLOCK. The Andoyer kernel holds about nine float64
+# temporaries of that size at once, so a call peaks near 9 * 8 * PAIR_BLOCK bytes (~300 MB)
+PAIR_BLOCK = 1 << 22
+
+
+def venue_block(offices):
+    """
+    Venues per block for a distance matrix against `offices` offices (see PAIR_BLOCK).
+    """
+    return max(1, min(VENUE_BLOCK, PAIR_BLOCK // max(offices, 1)))
+
+
+def andoyer_distance(lat1, lng1, lat2, lng2):
+    """
+    Andoyer-Lambert ellipsoidal distance in meters between broadcastable arrays of points
+    in radians. See distance_matrix() for the accuracy.
+    """
+    beta1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    beta2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+
+    h = np.sin((beta2 - beta1) / 2) ** 2 + np.cos(beta1) * np.cos(beta2) * np.sin((lng2 - lng1) / 2) ** 2
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (sigma - np.sin(sigma)) * np.sin(p) ** 2 * np.cos(q) ** 2 / np.cos(sigma / 2) ** 2
+        y = (sigma + np.sin(sigma)) * np.cos(p) ** 2 * np.sin(q) ** 2 / np.sin(sigma / 2) ** 2
+        distance = WGS84_A * (sigma - WGS84_F / 2 * (x + y))
+
+    return np.where(sigma > 0, distance, 0.0)
+
+
+def distance_matrix(lat1, lng1, lat2, lng2):
+    """
+    Ellipsoidal distance in meters between every pair of points of two sets.
+
+    Uses the Andoyer-Lambert first-order flattening correction on top of a haversine
+    central angle, fully vectorized with NumPy broadcasting. At city scale (pairs up to
+    ~50 km apart) it agrees with geopy's geodesic (Karney) within 0.1 m, i.e. a
+    relative error below 2e-6.
+
+    Parameters:
+    - lat1, lng1: Arrays of shape (n,) with the first set of points, in degrees.
+    - lat2, lng2: Arrays of shape (m,) with the second set of points, in degrees.
+
+    Returns:
+    - A NumPy array of shape (n, m) with the distances in meters.
+    """
+    lat1 = np.radians(np.asarray(lat1, dtype=float))[:, None]
+    metrics.count('distance.evaluations', lat1.shape[0] * np.size(lat2))
+    lng1 = np.radians(np.asarray(lng1, dtype=float))[:, None]
+    lat2 = np.radians(np.asarray(lat2, dtype=float))[None, :]
+    lng2 = np.radians(np.asarray(lng2, dtype=float))[None, :]
+
+    return andoyer_distance(lat1, lng1, lat2, lng2)
+
+
+def pair_distances(lat1, lng1, lat2, lng2):
+    """
+    Element-wise version of distance_matrix(): the distance between the i-th point of the
+    first set and the i-th point of the second, for arrays of the same shape.
+    """
+    lat1 = np.radians(np.asarray(lat1, dtype=float))
+    metrics.count('distance.evaluations', np.size(lat1))
+    return andoyer_distance(lat1, np.radians(np.asarray(lng1, dtype=float)),
+                            np.radians(np.asarray(lat2, dtype=float)), np.radians(np.asarray(lng2, dtype=float)))
+
+
+def normalized_scores(distances, max_distance):
+    """
+    Vectorized version of the normalized distance score: sqrt(1 - (d / max)^2) inside
+    the cutoff and 0 beyond it.
+
+    Parameters:
+    - distances: Array of distances in meters.
+    - max_distance: Cutoff distance in meters (scalar or broadcastable array).
+
+    Returns:
+    - A NumPy array of scores in [0, 1] with the same shape as distances.
+    """
+    ratio = np.asarray(distances, dtype=float) / max_distance
+    return np.where(ratio > 1, 0.0, np.sqrt(np.clip(1 - ratio ** 2, 0, 1)))
+
+
+def nearest_distances(office_coords, venue_coords):
+    """
+    Distance from each office to its nearest venue of one category.
+
+    Parameters:
+    - office_coords: Array of shape (n, 2) with [longitude, latitude] pairs (GeoJSON order).
+    - venue_coords: Array of shape (m, 2) with [longitude, latitude] pairs (GeoJSON order).
+
+    Returns:
+    - A NumPy array of shape (n,) with distances in meters, or inf when there are no venues.
+    """
+    office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+    venue_coords = np.asarray(venue_coords, dtype=float).reshape(-1, 2)
+
+    nearest = np.full(len(office_coords), np.inf)
+    block_size = venue_block(len(office_coords))
+    for start in range(0, len(venue_coords), block_size):
+        block = venue_coords[start:start + block_size]
+        distances = distance_matrix(office_coords[:, 1], office_coords[:, 0], block[:, 1], block[:, 0])
+        np.minimum(nearest, distances.min(axis=1), out=nearest)
+
+    return nearest
+
+
+def venue_arrays(venues_by_type):
+    """
+    Convert venue DataFrames (columns 'Lat' and 'Lng') to the (m, 2) [longitude, latitude]
+    arrays the vectorized scorer works on.
+
+    Parameters:
+    - venues_by_type: Dict mapping venue type to its venue DataFrame.
+
+    Returns:
+    - A dict mapping venue type to an (m, 2) NumPy array.
+    """
+    return {
+        venue_type: df.dropna(subset=['Lat', 'Lng'])[['Lng', 'Lat']].to_numpy(dtype=float).reshape(-1, 2)
+        for venue_type, df in venues_by_type.items()
+    }
+
+
+def score_offices(office_coords, venues_by_type, weights=WEIGHTS, max_distance=MAX_DISTANCE):
+    """
+    Score every office against every venue category in one vectorized pass.
+
+    Matches the scalar path in mongo.best_office_location(): for each category only the
+    nearest venue counts, its distance is normalized against the category cutoff and
+    weighted. Categories without venues contribute 0.
+
+    Parameters:
+    - office_coords: Array of shape (n, 2) with [longitude, latitude] pairs (GeoJSON order).
+    - venues_by_type: Dict mapping venue type (e.g. 'df_bars') to an (m, 2) array of [longitude, latitude].
+    - weights: Dict mapping venue type to its weight.
+    - max_distance: Dict mapping venue type to its cutoff distance in meters.
+
+    Returns:
+    - A NumPy array of shape (n,) with the unrounded score of each office.
+    """
+    office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+    scores = np.zeros(len(office_coords))
+
+    for venue_type, weight in weights.items():
+        venue_coords = venues_by_type.get(venue_type)
+        if venue_coords is None or len(venue_coords) == 0:
+            continue
+
+        distances = nearest_distances(office_coords, venue_coords)
+        max_dist = max_distance.get(venue_type, DEFAULT_MAX_DISTANCE)
+        scores += normalized_scores(distances, max_dist) * weight
+
+    return scores
+
+
+def rank_offices(names, office_coords, scores):
+    """
+    Build the ranked office_scores list in the same shape best_office_location() returns.
+
+    Parameters:
+    - names: Sequence of office names.
+    - office_coords: Array of shape (n, 2) with [longitude, latitude] pairs.
+    - scores: Array of shape (n,) with the score of each office.
+
+    Returns:
+    - A list of dicts with 'office', 'score' (rounded to 2 decimals) and 'location', best first.
+    """
+    office_scores = [
+        {'office': name, 'score': round(float(score), 2), 'location': [float(lng), float(lat)]}
+        for name, (lng, lat), score in zip(names, np.asarray(office_coords, dtype=float).reshape(-1, 2), scores)
+    ]
+    office_scores.sort(key=lambda x: x['score'], reverse=True)
+
+    return office_scores
+
+
+def score_distances(distances, venue_types, weights=WEIGHTS, max_distance=MAX_DISTANCE):
+    """
+    Score offices from precomputed nearest-venue distances (see matrix.py), so new weights
+    or cutoffs need no distance computation at all.
+
+    Parameters:
+    - distances: Array of shape (n, k) with the nearest-venue distance of each office per
+      category (inf when the category has no venues).
+    - venue_types: The k venue types of the columns.
+    - weights, max_distance: As in score_offices().
+
+    Returns:
+    - A NumPy array of shape (n,) with the unrounded score of each office.
+    """
+    distances = np.asarray(distances, dtype=float).reshape(-1, len(venue_types))
+    scores = np.zeros(len(distances))
+
+    for column, venue_type in enumerate(venue_types):
+        weight = weights.get(venue_type)
+        if not weight:
+            continue
+        max_dist = max_distance.get(venue_type, DEFAULT_MAX_DISTANCE)
+        scores += normalized_scores(distances[:, column], max_dist) * weight
+
+    return scores
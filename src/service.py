@@ -0,0 +1,480 @@
+import os
+import json
+import math
+import time
+import asyncio
+import hashlib
+from urllib.parse import urlsplit, parse_qs
+from . import matrix
+from . import metrics
+from . import mongo
+from . import scoring
+from . import spatial
+from . import store
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+pymongo = lazy_module('pymongo')
+
+
+# Long-running scoring service. The offices and venues are loaded once into memory with a
+# spatial index per category, so scoring an address is a handful of KD-tree lookups instead
+# of a pipeline run. A background task polls the data sources and swaps in a freshly built
+# snapshot when the venues or offices change; requests keep using the previous snapshot
+# until the new one is ready.
+HOST = '127.0.0.1'
+PORT = 8080
+RELOAD_INTERVAL = 30  # seconds between checks for changed offices or venues (0: never)
+OFFICES_COLLECTION = 'san_francisco_offices'
+MAX_CANDIDATES = 100000  # candidates accepted by one /rank request
+MAX_TOP = 1000
+MAX_BODY = 16 * 1024 * 1024  # bytes
+IDLE_TIMEOUT = 60  # seconds a keep-alive connection may wait for its next request
+READ_TIMEOUT = 10  # seconds to receive the rest of a request once it started
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+               500: 'Internal Server Error'}
+
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def data_version(names, office_coords, venues_by_type, venue_types):
+    """
+    Checksum of the offices and of the venues of every category (see matrix.category_version).
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps(list(names), default=str).encode())
+    digest.update(np.ascontiguousarray(np.asarray(office_coords, dtype=float).reshape(-1, 2)).tobytes())
+    for venue_type in venue_types:
+        coords = venues_by_type.get(venue_type, np.empty((0, 2)))
+        digest.update(f'{venue_type}:{matrix.category_version(coords)}'.encode())
+    return digest.hexdigest()
+
+
+class ScoringSnapshot:
+    """
+    Immutable in-memory scoring state: the offices with their precomputed scores, and a
+    VenueIndex over the venue coordinates of every weighted category.
+
+    Scores are those of scoring.score_offices() (nearest venue per category, ellipsoidal
+    distances), computed here through the index so that arbitrary points and the stored
+    offices go through the same code.
+
+    Parameters:
+    - names: Sequence of office names.
+    - office_coords: (n, 2) array of [longitude, latitude].
+    - venues_by_type: Dict mapping venue type to an (m, 2) array of [longitude, latitude].
+    - weights, max_distance: As in scoring.score_offices().
+    - backend: Spatial index backend (see spatial.VenueIndex).
+    """
+
+    def __init__(self, names, office_coords, venues_by_type, weights=scoring.WEIGHTS,
+                 max_distance=scoring.MAX_DISTANCE, backend=None):
+        self.weights = dict(weights)
+        self.max_distance = dict(max_distance)
+        self.venue_types = list(self.weights)
+        self.venues_by_type = {
+            venue_type: np.asarray(venues_by_type.get(venue_type, np.empty((0, 2))), dtype=float).reshape(-1, 2)
+            for venue_type in self.venue_types
+        }
+        self.index = spatial.VenueIndex.from_arrays(self.venues_by_type, backend)
+        self.names = list(names)
+        self.office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+        self.version = data_version(self.names, self.office_coords, self.venues_by_type, self.venue_types)
+        self.scores = self.score(self.office_coords[:, 1], self.office_coords[:, 0])
+        self.order = np.argsort(-self.scores, kind='stable')
+        self.loaded = time.time()
+
+    def nearest(self, lat, lng):
+        """
+        Nearest venue of every category for arrays of points.
+
+        Returns:
+        - A tuple (venues, distances) of (n, k) arrays: the position of the nearest venue
+          within its category (-1 when the category is empty) and its distance in meters.
+        """
+        lat = np.asarray(lat, dtype=float).reshape(-1)
+        lng = np.asarray(lng, dtype=float).reshape(-1)
+        venues = np.empty((len(lat), len(self.venue_types)), dtype=int)
+        distances = np.empty((len(lat), len(self.venue_types)))
+        for column, venue_type in enumerate(self.venue_types):
+            venues[:, column], distances[:, column] = self.index.nearest_many(venue_type, lat, lng)
+        return venues, distances
+
+    def score(self, lat, lng):
+        _, distances = self.nearest(lat, lng)
+        return scoring.score_distances(distances, self.venue_types, self.weights, self.max_distance)
+
+    def score_point(self, lat, lng):
+        """
+        Score one point, with the nearest venue and the contribution of every category.
+        """
+        categories = {}
+        total = 0.0
+        for venue_type in self.venue_types:
+            venue, distance = self.index.nearest_point(venue_type, lat, lng)
+            max_dist = self.max_distance.get(venue_type, scoring.DEFAULT_MAX_DISTANCE)
+            score = math.sqrt(1 - (distance / max_dist) ** 2) * self.weights[venue_type] if distance <= max_dist else 0.0
+            total += score
+            categories[venue_type] = {
+                'distance': distance if venue >= 0 else None,
+                'score': score,
+                'venue': self.venues_by_type[venue_type][venue].tolist() if venue >= 0 else None
+            }
+        return {'lat': lat, 'lng': lng, 'score': total, 'categories': categories}
+
+    def rank(self, names, lat, lng, top=None):
+        """
+        Rank candidate points, best first, in the shape of scoring.rank_offices().
+        """
+        scores = self.score(lat, lng)
+        order = np.argsort(-scores, kind='stable')[:top]
+        coords = np.column_stack([np.asarray(lng, dtype=float), np.asarray(lat, dtype=float)])
+        return scoring.rank_offices([names[i] for i in order], coords[order], scores[order])
+
+    def top(self, k):
+        order = self.order[:k]
+        return scoring.rank_offices([self.names[i] for i in order], self.office_coords[order], self.scores[order])
+
+    def summary(self):
+        return {
+            'version': self.version,
+            'loaded': self.loaded,
+            'offices': len(self.names),
+            'venues': {venue_type: len(coords) for venue_type, coords in self.venues_by_type.items()},
+            'backend': self.index.backend
+        }
+
+
+class DataSource:
+    """
+    Where the service reads its offices and venues: the offices collection, and the venues
+    from MongoDB (one df_* collection per type, or the single synced collection) or from the
+    columnar venue store written by `--columnar` runs.
+
+    Parameters:
+    - database: Database name. Defaults to mongo.DATABASE.
+    - offices_collection: Collection of the offices to rank.
+    - venues_collection: Single venues collection (see mongo.sync_venues), or None.
+    - store_directory: Read the venues from this store.VenueStore instead of MongoDB.
+    """
+
+    def __init__(self, database=None, offices_collection=OFFICES_COLLECTION, venues_collection=None,
+                 store_directory=None):
+        self.database = database
+        self.offices_collection = offices_collection
+        self.venues_collection = venues_collection
+        self.store_directory = store_directory
+
+    def collections(self):
+        names = [self.offices_collection]
+        if self.store_directory is None:
+            names += [self.venues_collection] if self.venues_collection else list(scoring.WEIGHTS)
+        return names
+
+    def version(self):
+        """
+        Cheap change check: the server-side dbHash of the collections read and the
+        fingerprint of the store's meta file. None when dbHash is not allowed, in which case
+        the data is loaded and compared by content.
+        """
+        db = mongo.get_database(self.database)
+        try:
+            version = [db.command('dbHash', collections=self.collections())['md5']]
+        except pymongo.errors.OperationFailure:
+            return None
+        if self.store_directory is not None:
+            meta = os.path.join(self.store_directory, 'meta.json')
+            version.append(store.fingerprint(meta) if os.path.exists(meta) else None)
+        return version
+
+    def load(self):
+        """
+        Returns:
+        - A tuple (names, office_coords, venues_by_type) as mongo.load_scoring_arrays() returns.
+        """
+        db = mongo.get_database(self.database)
+        venue_types = list(scoring.WEIGHTS)
+        if self.store_directory is None:
+            return mongo.load_scoring_arrays(db, self.offices_collection, venue_types, self.venues_collection)
+
+        names, office_coords, _ = mongo.load_scoring_arrays(db, self.offices_collection, [])
+        venues_by_type = store.VenueStore(self.store_directory).arrays() \
+            if os.path.exists(os.path.join(self.store_directory, 'meta.json')) else {}
+        return names, office_coords, venues_by_type
+
+
+class ScoringService:
+    """
+    Asyncio HTTP/1.1 server (keep-alive, JSON) in front of a ScoringSnapshot:
+
+    - GET  /score?lat=..&lng=..  score one point, with the nearest venue of every category;
+    - POST /rank                 rank {"candidates": [{"lat", "lng", "name"?} or [lat, lng], ...], "top"?};
+    - GET  /top?k=10             best stored offices;
+    - GET  /health               version and size of the loaded data;
+    - GET  /metrics              Prometheus text of the service metrics.
+
+    Scoring runs on the event loop: a point costs well under a millisecond, less than a
+    hop to a thread pool. Loading and index building run in the default executor.
+
+    Parameters:
+    - source: DataSource, or any object with load() and version().
+    - reload_interval: Seconds between change checks (0: never reload).
+    - backend: Spatial index backend (see spatial.VenueIndex).
+    """
+
+    def __init__(self, source, reload_interval=RELOAD_INTERVAL, backend=None, idle_timeout=IDLE_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        self.source = source
+        self.reload_interval = reload_interval
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.snapshot = None
+        self.source_version = None
+        self.reloads = 0
+        self.server = None
+        self.watcher = None
+
+    def load_data(self):
+        with metrics.timer('service.load'):
+            return self.source.load()
+
+    def build(self, data):
+        with metrics.timer('service.build'):
+            return ScoringSnapshot(*data, backend=self.backend)
+
+    async def load(self):
+        loop = asyncio.get_running_loop()
+        self.source_version = await loop.run_in_executor(None, self.source.version)
+        data = await loop.run_in_executor(None, self.load_data)
+        self.snapshot = await loop.run_in_executor(None, self.build, data)
+
+    async def reload(self):
+        """
+        Rebuild the snapshot when the source changed. Returns True when it was swapped.
+        """
+        loop = asyncio.get_running_loop()
+        version = await loop.run_in_executor(None, self.source.version)
+        if version is not None and version == self.source_version:
+            return False
+        data = await loop.run_in_executor(None, self.load_data)
+        self.source_version = version
+        if data_version(*data, self.snapshot.venue_types) == self.snapshot.version:
+            return False
+        self.snapshot = await loop.run_in_executor(None, self.build, data)
+        self.reloads += 1
+        metrics.count('service.reloads')
+        return True
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                if await self.reload():
+                    summary = self.snapshot.summary()
+                    print(f"Reloaded {summary['offices']} offices and {sum(summary['venues'].values())} venues")
+            except Exception as e:
+                # Mongo, store files or bad data: keep serving the previous snapshot and retry later
+                metrics.count('service.reload_errors')
+                print(f"Reload failed, still serving the previous data: {e}")
+
+    async def start(self, host=HOST, port=PORT):
+        """
+        Load the data and start listening. Returns the asyncio server.
+        """
+        if self.snapshot is None:
+            await self.load()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        if self.reload_interval:
+            self.watcher = asyncio.create_task(self.watch())
+        return self.server
+
+    async def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await self.start(host, port)
+        summary = self.snapshot.summary()
+        address = server.sockets[0].getsockname()
+        print(f"Serving {summary['offices']} offices and {sum(summary['venues'].values())} venues "
+              f"on http://{address[0]}:{address[1]}")
+        try:
+            await server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                except asyncio.TimeoutError:
+                    # Idle keep-alive client, or a request head that never ends
+                    metrics.count('service.timeouts')
+                    break
+                request_line, *header_lines = head.decode('latin-1').rstrip('\r\n').split('\r\n')
+                try:
+                    method, target, version = request_line.split(' ', 2)
+                except ValueError:
+                    break
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get('content-length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    # The body cannot be framed, so the connection cannot be reused either
+                    status, content_type, body = self.error(400, "Invalid Content-Length")
+                    keep_alive = False
+                elif length > MAX_BODY:
+                    status, content_type, body = self.error(413, f"Request body over {MAX_BODY} bytes")
+                    keep_alive = False
+                else:
+                    try:
+                        data = await asyncio.wait_for(reader.readexactly(length), self.read_timeout) if length else b''
+                    except asyncio.TimeoutError:
+                        metrics.count('service.timeouts')
+                        break
+                    status, content_type, body = self.respond(method, target, data)
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+
+                writer.write(f"{version if version in ('HTTP/1.0', 'HTTP/1.1') else 'HTTP/1.1'} {status} "
+                             f"{STATUS_TEXT.get(status, '')}\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(body)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def error(self, status, message):
+        metrics.count(f'service.status.{status}')
+        return status, 'application/json', json.dumps({'error': message}).encode()
+
+    def respond(self, method, target, data):
+        url = urlsplit(target)
+        route = url.path.rstrip('/') or '/'
+        handler = ROUTES.get(route)
+        if handler is None:
+            return self.error(404, f"Unknown path {url.path}")
+        if method != handler[0]:
+            return self.error(405, f"Use {handler[0]} {route}")
+
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        with metrics.timer(f'service.{route.strip("/")}', sample=True):
+            try:
+                result = getattr(self, handler[1])(self.snapshot, params, data)
+            except ServiceError as e:
+                return self.error(e.status, str(e))
+            except Exception as e:
+                metrics.count('service.errors')
+                print(f"{method} {target} failed: {e!r}")
+                return self.error(500, "Internal error")
+        if isinstance(result, str):
+            return 200, 'text/plain; version=0.0.4', result.encode()
+        return 200, 'application/json', json.dumps(result).encode()
+
+    def score_route(self, snapshot, params, data):
+        return snapshot.score_point(coordinate(params, 'lat', 90), coordinate(params, 'lng', 180))
+
+    def rank_route(self, snapshot, params, data):
+        try:
+            request = json.loads(data or b'{}')
+        except ValueError:
+            raise ServiceError(400, "The body must be JSON")
+        candidates = request.get('candidates') if isinstance(request, dict) else request
+        if not isinstance(candidates, list) or not candidates:
+            raise ServiceError(400, "Expected a non-empty list of candidates")
+        if len(candidates) > MAX_CANDIDATES:
+            raise ServiceError(413, f"At most {MAX_CANDIDATES} candidates per request")
+
+        names, lat, lng = [], [], []
+        for position, candidate in enumerate(candidates):
+            if isinstance(candidate, dict):
+                candidate_lat, candidate_lng = candidate.get('lat'), candidate.get('lng')
+                names.append(candidate.get('name', str(position)))
+            elif isinstance(candidate, (list, tuple)) and len(candidate) == 2:
+                candidate_lat, candidate_lng = candidate
+                names.append(str(position))
+            else:
+                raise ServiceError(400, f"Candidate {position} is not {{'lat', 'lng'}} or [lat, lng]")
+            lat.append(coordinate({'lat': candidate_lat}, 'lat', 90))
+            lng.append(coordinate({'lng': candidate_lng}, 'lng', 180))
+
+        top = request.get('top') if isinstance(request, dict) else None
+        return {'version': snapshot.version, 'results': snapshot.rank(names, lat, lng, positive_int(top, 'top'))}
+
+    def top_route(self, snapshot, params, data):
+        return {'version': snapshot.version, 'results': snapshot.top(positive_int(params.get('k', 10), 'k'))}
+
+    def health_route(self, snapshot, params, data):
+        return {**snapshot.summary(), 'reloads': self.reloads}
+
+    def metrics_route(self, snapshot, params, data):
+        return metrics.prometheus_text()
+
+
+ROUTES = {
+    '/score': ('GET', 'score_route'),
+    '/rank': ('POST', 'rank_route'),
+    '/top': ('GET', 'top_route'),
+    '/health': ('GET', 'health_route'),
+    '/metrics': ('GET', 'metrics_route')
+}
+
+
+def coordinate(params, name, bound):
+    try:
+        if isinstance(params[name], bool):
+            raise TypeError(name)
+        value = float(params[name])
+    except KeyError:
+        raise ServiceError(400, f"Missing {name}")
+    except (TypeError, ValueError):
+        raise ServiceError(400, f"{name} must be a number")
+    if not -bound <= value <= bound:
+        raise ServiceError(400, f"{name} must be within [-{bound}, {bound}]")
+    return value
+
+
+def positive_int(value, name):
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ServiceError(400, f"{name} must be an integer")
+    if not 0 < value <= MAX_TOP:
+        raise ServiceError(400, f"{name} must be within [1, {MAX_TOP}]")
+    return value
+
+
+def serve(host=HOST, port=PORT, reload_interval=RELOAD_INTERVAL, database=None, offices_collection=OFFICES_COLLECTION,
+          venues_collection=None, store_directory=None, backend=None):
+    """
+    Run the scoring service until interrupted.
+    """
+    source = DataSource(database, offices_collection, venues_collection, store_directory)
+    service = ScoringService(source, reload_interval, backend)
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,449 @@
+import math
+from . import distance
+from . import scoring
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+
+
+def has_scipy():
+    try:
+        import scipy.spatial  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+EARTH_RADIUS = 6371008.8  # mean Earth radius in meters, used to convert chords and ranking distances
+
+
+def to_unit_sphere(lat, lng):
+    """
+    Convert latitude/longitude in degrees to 3D points on the unit sphere.
+
+    Parameters:
+    - lat, lng: Arrays of latitudes and longitudes in degrees.
+
+    Returns:
+    - A NumPy array of shape (n, 3) with x, y, z coordinates.
+    """
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lng = np.radians(np.asarray(lng, dtype=float))
+    return np.column_stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)])
+
+
+def unit_vector(lat, lng):
+    """
+    Scalar to_unit_sphere(), without the NumPy overhead on a single point.
+    """
+    lat, lng = math.radians(lat), math.radians(lng)
+    return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+
+def meters_to_chord(meters):
+    return 2 * math.sin(min(meters / EARTH_RADIUS, math.pi) / 2)
+
+
+class KDTreeBackend:
+    """
+    Nearest-neighbour backend on a KD-tree of unit-sphere coordinates (requires scipy).
+    Chord length is monotone in great-circle distance; candidates are widened by 1% so the
+    final ellipsoidal ordering cannot miss a venue the sphere ranked just outside the top k.
+    """
+
+    def __init__(self, lat, lng):
+        if not has_scipy():
+            raise ImportError("The 'kdtree' backend requires scipy. Use backend='grid' instead.")
+        from scipy.spatial import cKDTree
+
+        self.size = len(lat)
+        self.tree = cKDTree(to_unit_sphere(lat, lng)) if self.size else None
+
+    def k_nearest(self, lat, lng, k):
+        if not self.size:
+            return np.array([], dtype=int)
+        k = min(k, self.size)
+        point = unit_vector(lat, lng)
+        chords, idx = self.tree.query(point, k=k)
+        kth_chord = np.atleast_1d(chords)[-1]
+        if kth_chord == 0:
+            return np.atleast_1d(idx)
+        return np.asarray(self.tree.query_ball_point(point, kth_chord * 1.01), dtype=int)
+
+    def within_radius(self, lat, lng, radius):
+        if not self.size:
+            return np.array([], dtype=int)
+        # Small slack on the chord so ellipsoidal distances right at the edge are not dropped
+        idx = self.tree.query_ball_point(to_unit_sphere([lat], [lng])[0], meters_to_chord(radius * 1.01))
+        return np.asarray(idx, dtype=int)
+
+    def k_nearest_many(self, lat, lng, k):
+        if not self.size:
+            return [np.array([], dtype=int) for _ in range(len(lat))]
+        k = min(k, self.size)
+        points = to_unit_sphere(lat, lng)
+        chords, _ = self.tree.query(points, k=k)
+        kth_chords = np.asarray(chords, dtype=float).reshape(len(points), -1)[:, -1]
+        return [np.asarray(idx, dtype=int) for idx in self.tree.query_ball_point(points, kth_chords * 1.01)]
+
+    def within_radius_many(self, lat, lng, radius):
+        if not self.size:
+            return [np.array([], dtype=int) for _ in range(len(lat))]
+        found = self.tree.query_ball_point(to_unit_sphere(lat, lng), meters_to_chord(radius * 1.01))
+        return [np.asarray(idx, dtype=int) for idx in found]
+
+
+class GridBackend:
+    """
+    Nearest-neighbour backend on a regular lat/lng bucket grid (pure NumPy, geohash-like).
+    Rings of cells are searched outwards until no unseen cell can hold a closer venue.
+    """
+
+    def __init__(self, lat, lng, cell_size=0.01):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lng = np.asarray(lng, dtype=float)
+        self.size = len(self.lat)
+        self.cell_size = cell_size
+        self.cells = {}
+
+        if not self.size:
+            return
+
+        rows = np.floor(self.lat / cell_size).astype(int)
+        cols = np.floor(self.lng / cell_size).astype(int)
+        for i, key in enumerate(zip(rows.tolist(), cols.tolist())):
+            self.cells.setdefault(key, []).append(i)
+        self.cells = {key: np.array(idx, dtype=int) for key, idx in self.cells.items()}
+
+        self.max_ring = max(rows.max() - rows.min(), cols.max() - cols.min()) + 1
+        self.row_range = (rows.min(), rows.max())
+        self.col_range = (cols.min(), cols.max())
+        self.max_abs_lat = float(np.abs(self.lat).max())
+
+    def _cell_meters(self, lat):
+        # Lower bound on the ground length of one cell edge between the query and the indexed area,
+        # shrunk by 1% to cover the sphere/ellipsoid difference
+        max_lat = min(max(abs(lat), self.max_abs_lat) + self.cell_size, 89.9)
+        return 0.99 * self.cell_size * math.pi / 180 * EARTH_RADIUS * math.cos(math.radians(max_lat))
+
+    def _ring(self, row, col, r):
+        if r == 0:
+            keys = [(row, col)]
+        else:
+            keys = [(row + dr, col + dc) for dr in range(-r, r + 1) for dc in (-r, r)]
+            keys += [(row + dr, col + dc) for dr in (-r, r) for dc in range(-r + 1, r)]
+        return [self.cells[key] for key in keys if key in self.cells]
+
+    def _distances(self, lat, lng, idx):
+        return scoring.distance_matrix([lat], [lng], self.lat[idx], self.lng[idx])[0]
+
+    def k_nearest(self, lat, lng, k):
+        if not self.size:
+            return np.array([], dtype=int)
+        k = min(k, self.size)
+        row = math.floor(lat / self.cell_size)
+        col = math.floor(lng / self.cell_size)
+
+        # Rings needed just to reach the indexed area from a far-away query point
+        start = max(self.row_range[0] - row, row - self.row_range[1], self.col_range[0] - col, col - self.col_range[1], 0)
+        cell_meters = self._cell_meters(lat)
+        candidates = []
+        r = -1
+        while True:
+            r += 1
+            # Once a ring has more cells than the index holds, scanning every venue is cheaper
+            if 8 * max(r, start) > len(self.cells):
+                idx = np.arange(self.size)
+                return idx[np.argsort(self._distances(lat, lng, idx), kind='stable')[:k]]
+            candidates.extend(self._ring(row, col, r))
+            if r < start or sum(len(c) for c in candidates) < k:
+                continue
+
+            idx = np.concatenate(candidates)
+            distances = self._distances(lat, lng, idx)
+            order = np.argsort(distances, kind='stable')[:k]
+            # Anything outside ring r is at least r full cells away
+            if distances[order[-1]] <= r * cell_meters or r >= start + self.max_ring:
+                return idx[order]
+
+    def within_radius(self, lat, lng, radius):
+        if not self.size:
+            return np.array([], dtype=int)
+        dlat = math.degrees(radius / EARTH_RADIUS) * 1.01
+        dlng = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 89.9))), 1e-6)
+        rows = range(math.floor((lat - dlat) / self.cell_size), math.floor((lat + dlat) / self.cell_size) + 1)
+        cols = range(math.floor((lng - dlng) / self.cell_size), math.floor((lng + dlng) / self.cell_size) + 1)
+
+        if len(rows) * len(cols) <= len(self.cells):
+            found = [self.cells[(row, col)] for row in rows for col in cols if (row, col) in self.cells]
+            return np.concatenate(found) if found else np.array([], dtype=int)
+
+        mask = (np.abs(self.lat - lat) <= dlat) & (np.abs(self.lng - lng) <= dlng)
+        return np.flatnonzero(mask)
+
+    def k_nearest_many(self, lat, lng, k):
+        return [self.k_nearest(point_lat, point_lng, k) for point_lat, point_lng in zip(lat, lng)]
+
+    def within_radius_many(self, lat, lng, radius):
+        return [self.within_radius(point_lat, point_lng, radius) for point_lat, point_lng in zip(lat, lng)]
+
+
+class VenueIndex:
+    """
+    In-memory spatial index over venue DataFrames, one sub-index per venue type.
+
+    Answers nearest, k-nearest and radius queries without a database round trip.
+    Results are dicts with 'name', 'Lat', 'Lng' and 'distance' (ellipsoidal meters),
+    sorted by distance.
+    """
+
+    BACKENDS = {'kdtree': KDTreeBackend, 'grid': GridBackend}
+
+    def __init__(self, venues_by_type, backend=None):
+        """
+        Parameters:
+        - venues_by_type: Dict mapping venue type (e.g. 'df_bars') to a DataFrame from
+          api.get_venues_dataframe (columns 'name', 'Lat', 'Lng', 'category').
+        - backend: 'kdtree' (needs scipy) or 'grid'. Defaults to 'kdtree' when scipy is installed.
+        """
+        if backend is None:
+            backend = 'kdtree' if has_scipy() else 'grid'
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown spatial index backend: {backend}")
+
+        self.backend = backend
+        self.venues = {}
+        self.indexes = {}
+        for venue_type, df in venues_by_type.items():
+            df = df.dropna(subset=['Lat', 'Lng'])
+            self.add(venue_type, df['name'].tolist(), df['Lat'].to_numpy(dtype=float), df['Lng'].to_numpy(dtype=float))
+
+    @classmethod
+    def from_arrays(cls, venues_by_type, backend=None):
+        """
+        Build the index from (m, 2) [longitude, latitude] arrays (as returned by
+        scoring.venue_arrays or mongo.load_scoring_arrays) instead of DataFrames. Venue names
+        are None.
+        """
+        index = cls({}, backend)
+        for venue_type, coords in venues_by_type.items():
+            coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+            index.add(venue_type, [None] * len(coords), coords[:, 1], coords[:, 0])
+        return index
+
+    def add(self, venue_type, names, lat, lng):
+        self.venues[venue_type] = (names, lat, lng)
+        self.indexes[venue_type] = self.BACKENDS[self.backend](lat, lng)
+
+    def _pairs(self, venue_type, lat, lng, candidates):
+        _, venue_lat, venue_lng = self.venues[venue_type]
+        points = np.repeat(np.arange(len(lat)), [len(idx) for idx in candidates])
+        venues = np.concatenate(candidates) if len(points) else np.array([], dtype=int)
+        distances = scoring.pair_distances(lat[points], lng[points], venue_lat[venues], venue_lng[venues])
+        return points, venues, distances
+
+    def _results(self, venue_type, lat, lng, idx, radius=None, k=None):
+        names, venue_lat, venue_lng = self.venues[venue_type]
+        if len(idx) == 0:
+            return []
+
+        distances = scoring.distance_matrix([lat], [lng], venue_lat[idx], venue_lng[idx])[0]
+        order = np.argsort(distances, kind='stable')[:k]
+        return [
+            {'name': names[idx[i]], 'Lat': float(venue_lat[idx[i]]), 'Lng': float(venue_lng[idx[i]]), 'distance': float(distances[i])}
+            for i in order
+            if radius is None or distances[i] <= radius
+        ]
+
+    def nearest(self, venue_type, lat, lng):
+        """
+        Return the venue of venue_type closest to (lat, lng), or None if the type has no venues.
+        """
+        results = self.k_nearest(venue_type, lat, lng, 1)
+        return results[0] if results else None
+
+    def nearest_point(self, venue_type, lat, lng):
+        """
+        Scalar version of nearest_many() for one query point, in plain Python arithmetic
+        (for latency-sensitive callers such as the scoring service).
+
+        Returns:
+        - A tuple (venue, distance): the position of the nearest venue within venue_type (-1
+          when the type has no venues) and its distance in meters (inf then).
+        """
+        if venue_type not in self.indexes:
+            return -1, math.inf
+        _, venue_lat, venue_lng = self.venues[venue_type]
+        best, best_distance = -1, math.inf
+        for venue in self.indexes[venue_type].k_nearest(lat, lng, 1).tolist():
+            venue_distance = distance.pair_ellipsoidal(lat, lng, float(venue_lat[venue]), float(venue_lng[venue]))
+            if venue_distance < best_distance:
+                best, best_distance = venue, venue_distance
+        return best, best_distance
+
+    def k_nearest(self, venue_type, lat, lng, k):
+        """
+        Return up to k venues of venue_type closest to (lat, lng).
+        """
+        if venue_type not in self.indexes:
+            return []
+        idx = self.indexes[venue_type].k_nearest(lat, lng, k)
+        return self._results(venue_type, lat, lng, idx, k=k)
+
+    def within_radius(self, venue_type, lat, lng, radius):
+        """
+        Return every venue of venue_type within radius meters of (lat, lng).
+        """
+        if venue_type not in self.indexes:
+            return []
+        idx = self.indexes[venue_type].within_radius(lat, lng, radius)
+        return self._results(venue_type, lat, lng, idx, radius)
+
+    def pairs_within(self, venue_type, lat, lng, radius):
+        """
+        Every (point, venue) pair closer than radius meters, for arrays of query points.
+
+        Returns:
+        - A tuple (points, venues, distances) of flat arrays: the position of the query point,
+          the position of the venue within venue_type and their distance in meters.
+        """
+        lat = np.asarray(lat, dtype=float).reshape(-1)
+        lng = np.asarray(lng, dtype=float).reshape(-1)
+        if venue_type not in self.indexes:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+        candidates = self.indexes[venue_type].within_radius_many(lat, lng, radius)
+        points, venues, distances = self._pairs(venue_type, lat, lng, candidates)
+        keep = distances <= radius
+        return points[keep], venues[keep], distances[keep]
+
+    def nearest_many(self, venue_type, lat, lng):
+        """
+        The nearest venue of venue_type to each of an array of query points.
+
+        Returns:
+        - A tuple (venues, distances) of (n,) arrays: the position of the nearest venue within
+          venue_type (-1 when the type has no venues) and its distance in meters (inf then).
+        """
+        lat = np.asarray(lat, dtype=float).reshape(-1)
+        lng = np.asarray(lng, dtype=float).reshape(-1)
+        nearest = np.full(len(lat), -1)
+        result = np.full(len(lat), np.inf)
+        if venue_type not in self.indexes or not len(lat):
+            return nearest, result
+
+        candidates = self.indexes[venue_type].k_nearest_many(lat, lng, 1)
+        points, venues, distances = self._pairs(venue_type, lat, lng, candidates)
+        order = np.lexsort((distances, points))
+        points, venues, distances = points[order], venues[order], distances[order]
+        first = np.ones(len(points), dtype=bool)
+        first[1:] = points[1:] != points[:-1]
+        nearest[points[first]] = venues[first]
+        result[points[first]] = distances[first]
+        return nearest, result
+
+    def nearest_lower_bounds(self, venue_type, lat, lng):
+        """
+        Lower bound on the nearest-venue distance of each of an array of query points, for
+        pruning. The kdtree backend only runs the chord query (the arc is longer than the
+        chord and the ellipsoid within distance.HAVERSINE_ERROR of the sphere), so points far
+        from every venue cost no distance evaluation; the grid backend returns the exact
+        nearest distances.
+
+        Returns:
+        - An (n,) array of distances in meters (inf when the type has no venues).
+        """
+        lat = np.asarray(lat, dtype=float).reshape(-1)
+        lng = np.asarray(lng, dtype=float).reshape(-1)
+        if venue_type not in self.indexes or not len(lat) or not self.indexes[venue_type].size:
+            return np.full(len(lat), np.inf)
+        if self.backend != 'kdtree':
+            return self.nearest_many(venue_type, lat, lng)[1]
+        chords, _ = self.indexes[venue_type].tree.query(to_unit_sphere(lat, lng), k=1)
+        return chords * EARTH_RADIUS * (1 - distance.HAVERSINE_ERROR)
+
+    def k_nearest_distances(self, venue_type, lat, lng, k):
+        """
+        Distances to the k nearest venues of venue_type, for arrays of query points.
+
+        Returns:
+        - An (n, k) array sorted by distance, padded with inf when the type has fewer than k venues.
+        """
+        lat = np.asarray(lat, dtype=float).reshape(-1)
+        lng = np.asarray(lng, dtype=float).reshape(-1)
+        result = np.full((len(lat), k), np.inf)
+        if venue_type not in self.indexes or k == 0:
+            return result
+
+        candidates = self.indexes[venue_type].k_nearest_many(lat, lng, k)
+        points, _, distances = self._pairs(venue_type, lat, lng, candidates)
+        order = np.lexsort((distances, points))
+        points, distances = points[order], distances[order]
+        # Position of each candidate within its query point's sorted run
+        starts = np.searchsorted(points, points, side='left')
+        positions = np.arange(len(points)) - starts
+        keep = positions < k
+        result[points[keep], positions[keep]] = distances[keep]
+        return result
+
+
+class MongoVenueIndex:
+    """
+    Fallback backend answering the same queries with MongoDB $near against the 2dsphere
+    indexes created by converting_to_collection(), or against the single venues collection
+    written by sync_venues() when venues_collection is given.
+    """
+
+    backend = 'mongo'
+
+    def __init__(self, db, venues_collection=None):
+        self.db = db
+        self.venues_collection = venues_collection
+
+    def _find(self, venue_type, near):
+        if self.venues_collection is None:
+            return self.db[venue_type].find({'location': {'$near': near}})
+        category = scoring.VENUE_QUERIES.get(venue_type, venue_type)
+        return self.db[self.venues_collection].find({'category': category, 'location': {'$near': near}})
+
+    def _results(self, lat, lng, documents):
+        results = []
+        for venue in documents:
+            venue_lng, venue_lat = venue['location']['coordinates']
+            distance = scoring.distance_matrix([lat], [lng], [venue_lat], [venue_lng])[0, 0]
+            results.append({'name': venue.get('name'), 'Lat': venue_lat, 'Lng': venue_lng, 'distance': float(distance)})
+        return results
+
+    def nearest(self, venue_type, lat, lng):
+        results = self.k_nearest(venue_type, lat, lng, 1)
+        return results[0] if results else None
+
+    def k_nearest(self, venue_type, lat, lng, k):
+        cursor = self._find(venue_type, {'$geometry': {'type': 'Point', 'coordinates': [lng, lat]}}).limit(k)
+        return self._results(lat, lng, cursor)
+
+    def within_radius(self, venue_type, lat, lng, radius):
+        cursor = self._find(venue_type, {'$geometry': {'type': 'Point', 'coordinates': [lng, lat]}, '$maxDistance': radius})
+        return self._results(lat, lng, cursor)
+
+
+def build_venue_index(venues_by_type=None, backend=None, db=None, venues_collection=None):
+    """
+    Build a venue index for the selected backend.
+
+    Parameters:
+    - venues_by_type: Dict mapping venue type to its venue DataFrame, or to an (m, 2)
+      [longitude, latitude] array (for the in-memory backends).
+    - backend: 'kdtree', 'grid' or 'mongo'.
+    - db: MongoDB database instance (required for the 'mongo' backend).
+    - venues_collection: For the 'mongo' backend, the single venues collection to query.
+
+    Returns:
+    - A VenueIndex or MongoVenueIndex.
+    """
+    if backend == 'mongo':
+        if db is None:
+            raise ValueError("The 'mongo' backend needs a database instance.")
+        return MongoVenueIndex(db, venues_collection)
+    if venues_by_type and all(isinstance(venues, np.ndarray) for venues in venues_by_type.values()):
+        return VenueIndex.from_arrays(venues_by_type, backend)
+    return VenueIndex(venues_by_type or {}, backend=backend)
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from . import cache
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+
+
+STORE_DIR = './data/store'
+COLUMNS = ('lat', 'lng', 'category', 'fsq_id', 'name_offsets', 'names')
+
+
+def fingerprint(path):
+    """
+    Cheap change detector for a source file: its size and modification time in ns.
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_source(path):
+    """
+    Read the Foursquare results of one raw JSON file: a plain list of places (data/*.json),
+    a venue cache entry ({'created', 'venues': [...]}) or a crawl checkpoint ({'venues': {fsq_id: place}}).
+
+    Returns:
+    - A tuple (venues, created) where created is the fetch time of cache entries, else None.
+    """
+    with open(path, 'r') as file:
+        data = json.load(file)
+    if isinstance(data, list):
+        return data, None
+    venues = data.get('venues', [])
+    if isinstance(venues, dict):
+        venues = list(venues.values())
+    return venues, data.get('created')
+
+
+def normalize_sources(sources):
+    """
+    Normalize {venue_type: path or {'path', 'query', 'limit'}} to the dict form.
+    """
+    normalized = {}
+    for venue_type, source in sources.items():
+        if not isinstance(source, dict):
+            source = {'path': source}
+        normalized[venue_type] = {
+            'path': os.path.abspath(source['path']),
+            'query': source.get('query', venue_type),
+            'limit': source.get('limit')
+        }
+    return normalized
+
+
+class VenueStore:
+    """
+    Columnar, memory-mapped copy of the venues of several raw Foursquare JSON files.
+
+    Each column is a .npy file: float64 lat/lng, int16 category codes, fixed-width fsq_ids
+    and the names as one NUL-terminated UTF-8 blob with offsets. Rows are grouped by category, so each
+    category is a contiguous slice of the mapped arrays. The store is rebuilt only when a
+    source file's contents change. Rows are those of api.venues_to_dataframe (venues without
+    coordinates included, as NaN), except that a repeated fsq_id within a category is stored
+    once, as mongo.sync_venues does.
+    """
+
+    def __init__(self, directory=STORE_DIR):
+        self.directory = directory
+        self._meta = None
+        self._columns = None
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            try:
+                with open(os.path.join(self.directory, 'meta.json'), 'r') as file:
+                    self._meta = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._meta = {}
+        return self._meta
+
+    def is_current(self, sources):
+        """
+        True when the store was built from exactly these sources and none of them changed.
+        Files whose size/mtime changed but whose contents did not are accepted (and their
+        fingerprint is updated).
+        """
+        stored = self.meta.get('sources')
+        sources = normalize_sources(sources)
+        if not stored or list(stored) != list(sources):
+            return False
+
+        touched = False
+        for venue_type, source in sources.items():
+            entry = stored[venue_type]
+            if {key: entry[key] for key in ('path', 'query', 'limit')} != source:
+                return False
+            try:
+                current = fingerprint(source['path'])
+            except FileNotFoundError:
+                return False
+            if current == entry['fingerprint']:
+                continue
+            if file_digest(source['path']) != entry['sha1']:
+                return False
+            entry['fingerprint'] = current
+            touched = True
+
+        if touched:
+            self._write_meta(self.directory, self.meta)
+        return True
+
+    def build(self, sources):
+        """
+        Parse the sources and write the columns to a new directory that replaces the store
+        atomically.
+
+        Parameters:
+        - sources: Dict mapping venue type to the path of its raw JSON file, or to a dict with
+          'path', 'query' (category label, defaults to the venue type) and 'limit' (keep only
+          the first results, like the venue cache does).
+        """
+        sources = normalize_sources(sources)
+        lat, lng, codes, fsq_ids, names = [], [], [], [], []
+        slices = {}
+        meta_sources = {}
+
+        for code, (venue_type, source) in enumerate(sources.items()):
+            venues, created = read_source(source['path'])
+            if source['limit']:
+                venues = venues[:source['limit']]
+
+            start = len(lat)
+            seen = set()
+            for venue in venues:
+                # Like api.venues_to_dataframe: a venue without coordinates is kept with NaN ones
+                if 'geocodes' not in venue:
+                    continue
+                location = venue['geocodes'].get('main', {})
+                fsq_id = venue.get('fsq_id') or ''
+                if fsq_id and fsq_id in seen:
+                    continue
+                seen.add(fsq_id)
+                lat.append(np.nan if location.get('latitude') is None else location['latitude'])
+                lng.append(np.nan if location.get('longitude') is None else location['longitude'])
+                codes.append(code)
+                fsq_ids.append(fsq_id.encode())
+                # Every name ends with a NUL so a slice of the blob decodes and splits in one go
+                names.append(str(venue.get('name', 'Unknown Name')).replace('\x00', '').encode() + b'\x00')
+            slices[venue_type] = [start, len(lat)]
+            meta_sources[venue_type] = {
+                **source,
+                'fingerprint': fingerprint(source['path']),
+                'sha1': file_digest(source['path']),
+                'created': created
+            }
+
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in names], out=offsets[1:])
+        width = max([len(fsq_id) for fsq_id in fsq_ids] + [1])
+        columns = {
+            'lat': np.array(lat, dtype=np.float64),
+            'lng': np.array(lng, dtype=np.float64),
+            'category': np.array(codes, dtype=np.int16),
+            'fsq_id': np.array(fsq_ids, dtype=f'S{width}'),
+            'name_offsets': offsets,
+            'names': np.frombuffer(b''.join(names), dtype=np.uint8)
+        }
+        meta = {
+            'count': len(lat),
+            'categories': list(sources),
+            'queries': [source['query'] for source in sources.values()],
+            'slices': slices,
+            'sources': meta_sources,
+            'built': time.time()
+        }
+
+        parent = os.path.dirname(os.path.abspath(self.directory))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent, prefix='.store-')
+        try:
+            for name, values in columns.items():
+                np.save(os.path.join(staging, f'{name}.npy'), values)
+            self._write_meta(staging, meta)
+            self._swap(staging)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        self._meta = meta
+        self._columns = None
+        return meta
+
+    def _swap(self, staging):
+        retired = None
+        if os.path.exists(self.directory):
+            retired = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.directory)), prefix='.store-old-')
+            os.rmdir(retired)
+            os.replace(self.directory, retired)
+        os.replace(staging, self.directory)
+        if retired:
+            shutil.rmtree(retired, ignore_errors=True)
+
+    @staticmethod
+    def _write_meta(directory, meta):
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, os.path.join(directory, 'meta.json'))
+
+    def refresh(self, sources):
+        """
+        Rebuild the store if the sources changed. Returns True when it was rebuilt.
+        """
+        if self.is_current(sources):
+            return False
+        self.build(sources)
+        return True
+
+    def columns(self):
+        """
+        The columns as read-only memory-mapped arrays (only touched pages are read).
+        """
+        if self._columns is None:
+            mode = 'r' if self.meta.get('count') else None  # empty arrays cannot be mapped
+            self._columns = {
+                name: np.load(os.path.join(self.directory, f'{name}.npy'), mmap_mode=mode) for name in COLUMNS
+            }
+        return self._columns
+
+    def expired(self, venue_type, ttl):
+        """
+        True when the source of venue_type is a venue cache entry older than ttl seconds, by
+        the rule of cache.expired(): legacy seed files (stored without 'created') never expire,
+        as in VenueCache.get().
+        """
+        return cache.expired(self.meta.get('sources', {}).get(venue_type, {}).get('created'), ttl)
+
+    def arrays(self):
+        """
+        The (m, 2) [longitude, latitude] array of every category, as scoring.venue_arrays returns
+        (venues without coordinates left out).
+        """
+        columns = self.columns()
+        result = {}
+        for venue_type, (start, stop) in self.meta['slices'].items():
+            coords = np.column_stack([columns['lng'][start:stop], columns['lat'][start:stop]])
+            result[venue_type] = coords[~np.isnan(coords).any(axis=1)]
+        return result
+
+    def names(self, start, stop):
+        """
+        Names of the venues in rows start:stop.
+        """
+        if stop <= start:
+            return []
+        columns = self.columns()
+        offsets = columns['name_offsets']
+        blob = columns['names'][int(offsets[start]):int(offsets[stop])].tobytes()
+        return blob.decode().split('\x00')[:-1]
+
+    def dataframes(self):
+        """
+        The venue DataFrames of every category, with the columns of api.venues_to_dataframe
+        ('category' is a pandas Categorical).
+        """
+        columns = self.columns()
+        queries = self.meta['queries']
+        result = {}
+        for venue_type, (start, stop) in self.meta['slices'].items():
+            result[venue_type] = pd.DataFrame({
+                'fsq_id': np.char.decode(columns['fsq_id'][start:stop]),
+                'name': self.names(start, stop),
+                'Lat': np.asarray(columns['lat'][start:stop]),
+                'Lng': np.asarray(columns['lng'][start:stop]),
+                'category': pd.Categorical.from_codes(np.asarray(columns['category'][start:stop]), categories=queries)
+            })
+        return result
@@ -0,0 +1,197 @@
+from . import distance
+from . import grid
+from . import metrics
+from . import scoring
+from . import spatial
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+
+
+# Branch-and-bound top-k search. The score only grows when a nearest-venue distance shrinks
+# (and the weights are non-negative), so a cell of candidates can be bounded from its centre:
+# no member is closer to a venue than the centre's nearest venue minus the cell radius. Cells
+# are scored exactly in decreasing order of that bound, and the search stops as soon as the
+# best remaining bound is below the k-th best score found so far.
+CELL_SIZE = 100  # meters, side of the square cells the candidates are grouped into
+BATCH = 4096  # candidates scored exactly per step
+BOUND_SLACK = 1e-5  # relative; covers the Andoyer error (distance.ELLIPSOIDAL_ERROR) in the triangle inequality
+
+
+def cell_ids(lat, lng, cell_size=CELL_SIZE):
+    """
+    Cell of every candidate on a square grid of cell_size meters (local equirectangular
+    projection, so cells are roughly square at any latitude).
+
+    Returns:
+    - A tuple (cells, members): cells is the (n,) cell number of each candidate, members the
+      candidate positions sorted by cell.
+    """
+    rows = np.floor(lat * grid.METERS_PER_DEGREE / cell_size).astype(np.int64)
+    cols = np.floor(lng * grid.METERS_PER_DEGREE * np.cos(np.radians(lat)) / cell_size).astype(np.int64)
+    _, cells = np.unique(rows * (1 << 32) + cols, return_inverse=True)
+    cells = cells.reshape(-1)
+    return cells, np.argsort(cells, kind='stable')
+
+
+def cell_bounds(index, lat, lng, cells, members, venue_types, weights=scoring.WEIGHTS,
+                max_distance=scoring.MAX_DISTANCE):
+    """
+    Upper bound on the score of every candidate of each cell.
+
+    The cell centre is the middle of its members' bounding box and its radius the largest
+    centre-member distance r. By the triangle inequality a member's nearest venue is at
+    least D - r away, D being (a lower bound on) the centre's nearest-venue distance, so
+    scoring D - r (less BOUND_SLACK for the ellipsoidal approximation) bounds every member's
+    category score.
+
+    Parameters:
+    - index: spatial.VenueIndex over the venues.
+    - lat, lng: (n,) candidate coordinates.
+    - cells, members: As returned by cell_ids().
+    - venue_types, weights, max_distance: The scoring model.
+
+    Returns:
+    - A tuple (bounds, starts): the (c,) score bound of each cell and the (c + 1,) offsets of
+      each cell's run in members.
+    """
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(cells[members])) + 1, [len(members)]])
+    member_lat, member_lng = lat[members], lng[members]
+    south = np.minimum.reduceat(member_lat, starts[:-1])
+    north = np.maximum.reduceat(member_lat, starts[:-1])
+    west = np.minimum.reduceat(member_lng, starts[:-1])
+    east = np.maximum.reduceat(member_lng, starts[:-1])
+    center_lat, center_lng = (south + north) / 2, (west + east) / 2
+
+    sizes = np.diff(starts)
+    radius = np.maximum.reduceat(scoring.pair_distances(np.repeat(center_lat, sizes), np.repeat(center_lng, sizes),
+                                                        member_lat, member_lng), starts[:-1])
+
+    lower = np.empty((len(sizes), len(venue_types)))
+    for column, venue_type in enumerate(venue_types):
+        nearest = index.nearest_lower_bounds(venue_type, center_lat, center_lng)
+        lower[:, column] = nearest * (1 - BOUND_SLACK) - radius * (1 + BOUND_SLACK) - distance.ABSOLUTE_ERROR
+    return scoring.score_distances(np.maximum(lower, 0.0), venue_types, weights, max_distance), starts
+
+
+def exact_scores(index, lat, lng, venue_types, weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE):
+    distances = np.empty((len(lat), len(venue_types)))
+    for column, venue_type in enumerate(venue_types):
+        _, distances[:, column] = index.nearest_many(venue_type, lat, lng)
+    return scoring.score_distances(distances, venue_types, weights, max_distance)
+
+
+def top_k(office_coords, venues_by_type, k=10, weights=scoring.WEIGHTS, max_distance=scoring.MAX_DISTANCE,
+          cell_size=CELL_SIZE, batch=BATCH, backend=None):
+    """
+    The k best candidates under the nearest-venue model, without scoring every candidate.
+
+    Returns exactly what exhaustive scoring ranks first: the positions of the k highest
+    scores of scoring.score_offices(), ties broken by position. The order is that of the
+    unrounded scores; scoring.rank_offices() sorts on scores rounded to 2 decimals, so offices
+    with the same rounded score can be listed in another order there. Cells whose bound is below
+    the current k-th best score are never scored, so the work depends on how many
+    candidates come close to the top rather than on the size of the candidate set.
+
+    Parameters:
+    - office_coords: (n, 2) array of [longitude, latitude] (offices, lattice points...).
+    - venues_by_type: Dict mapping venue type to an (m, 2) array of [longitude, latitude], or
+      an already built spatial.VenueIndex.
+    - k: Number of candidates to return.
+    - weights, max_distance: As in scoring.score_offices(). Weights must be non-negative.
+    - cell_size: Side of the cells in meters. Smaller cells give tighter bounds but more of them.
+    - batch: Candidates scored exactly per step (bounds are checked between steps).
+    - backend: Spatial index backend (see spatial.VenueIndex).
+
+    Returns:
+    - A tuple (positions, scores) of (min(k, n),) arrays, best first.
+    """
+    if any(weight < 0 for weight in weights.values()):
+        raise ValueError("Branch-and-bound needs non-negative weights")
+    office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+    lat, lng = office_coords[:, 1], office_coords[:, 0]
+    venue_types = list(weights)
+    if isinstance(venues_by_type, spatial.VenueIndex):
+        index = venues_by_type
+    else:
+        index = spatial.VenueIndex.from_arrays({venue_type: venues_by_type[venue_type] for venue_type in venue_types
+                                                if venue_type in venues_by_type}, backend)
+    if not len(office_coords) or k <= 0:
+        return np.array([], dtype=int), np.array([])
+
+    with metrics.timer('topk.bounds'):
+        cells, members = cell_ids(lat, lng, cell_size)
+        bounds, starts = cell_bounds(index, lat, lng, cells, members, venue_types, weights, max_distance)
+    order = np.argsort(-bounds, kind='stable')
+
+    best_positions, best_scores = np.array([], dtype=int), np.array([])
+    position = 0
+    scored_cells = 0
+    with metrics.timer('topk.exact'):
+        while position < len(order):
+            # Stop once no remaining cell can beat (or tie) the k-th best score
+            if len(best_scores) == k and bounds[order[position]] < best_scores[-1]:
+                break
+            step = [order[position]]
+            size = starts[order[position] + 1] - starts[order[position]]
+            position += 1
+            while position < len(order) and size < batch:
+                cell = order[position]
+                if len(best_scores) == k and bounds[cell] < best_scores[-1]:
+                    break
+                step.append(cell)
+                size += starts[cell + 1] - starts[cell]
+                position += 1
+            scored_cells += len(step)
+
+            candidates = np.concatenate([members[starts[cell]:starts[cell + 1]] for cell in step])
+            # A zero bound means every category is past its cutoff: the exact score is 0
+            positive = np.repeat(bounds[step] > 0, np.diff(starts)[step])
+            scores = np.zeros(len(candidates))
+            scores[positive] = exact_scores(index, lat[candidates[positive]], lng[candidates[positive]], venue_types,
+                                            weights, max_distance)
+            merged_positions = np.concatenate([best_positions, candidates])
+            merged_scores = np.concatenate([best_scores, scores])
+            keep = np.lexsort((merged_positions, -merged_scores))[:k]
+            best_positions, best_scores = merged_positions[keep], merged_scores[keep]
+            metrics.count('topk.candidates_scored', int(positive.sum()))
+
+    metrics.count('topk.cells', len(order))
+    metrics.count('topk.cells_pruned', len(order) - scored_cells)
+    return best_positions, best_scores
+
+
+def rank_top_k(names, office_coords, venues_by_type, k=10, weights=scoring.WEIGHTS,
+               max_distance=scoring.MAX_DISTANCE, cell_size=CELL_SIZE):
+    """
+    top_k() in the shape of scoring.rank_offices().
+    """
+    office_coords = np.asarray(office_coords, dtype=float).reshape(-1, 2)
+    positions, scores = top_k(office_coords, venues_by_type, k, weights, max_distance, cell_size)
+    return scoring.rank_offices([names[position] for position in positions], office_coords[positions], scores)
+
+
+def grid_top_k(venues_by_type, bbox=grid.SAN_FRANCISCO_BBOX, spacing=grid.SPACING, k=10, weights=scoring.WEIGHTS,
+               max_distance=scoring.MAX_DISTANCE, cell_size=None):
+    """
+    The k best points of the grid.grid_search() lattice, found by branch and bound instead
+    of scoring the whole raster.
+
+    Parameters:
+    - venues_by_type: Dict mapping venue type to its venue DataFrame or (m, 2) [lng, lat] array.
+    - bbox, spacing: The lattice, as in grid.grid_search().
+    - k, weights, max_distance: As in top_k().
+    - cell_size: Cell side in meters. Defaults to 3 lattice steps (at least CELL_SIZE).
+
+    Returns:
+    - A list of dicts with 'score', 'Lat', 'Lng', 'row' and 'col', best first, like the
+      'top' of grid.grid_search().
+    """
+    venues = {venue_type: venues if isinstance(venues, np.ndarray) else scoring.venue_arrays({venue_type: venues})[venue_type]
+              for venue_type, venues in venues_by_type.items()}
+    lats, lngs = grid.lattice_axes(bbox, spacing)
+    coords = np.column_stack([np.tile(lngs, len(lats)), np.repeat(lats, len(lngs))])
+    positions, scores = top_k(coords, venues, k, weights, max_distance, cell_size or max(CELL_SIZE, 3 * spacing))
+    return [{'score': round(float(score), 4), 'Lat': float(lats[position // len(lngs)]),
+             'Lng': float(lngs[position % len(lngs)]), 'row': int(position // len(lngs)), 'col': int(position % len(lngs))}
+            for position, score in zip(positions.tolist(), scores)]
@@ -0,0 +1,239 @@
+import json
+import time
+import hashlib
+from . import matrix
+from . import metrics
+from . import mongo
+from . import scoring
+from .lazy import lazy_module
+
+np = lazy_module('numpy')
+pymongo = lazy_module('pymongo')
+
+
+# Incremental maintenance of a per-city office collection from a change stream on Companies
+# (needs a replica set; a single-node one is fine). Every derived office document carries the
+# _id of its company, so a changed company only rewrites its own offices: the documents that
+# no longer come out of offices_by_criteria_pipeline are deleted, the new ones inserted and
+# the unchanged ones left alone. The distance-matrix rows (matrix.py) of the added offices
+# are computed right away, so `rerank --no-refresh` and the scoring service see them.
+STATE_COLLECTION = 'watch_state'  # resume tokens, one document per (Companies, offices collection)
+BATCH_SIZE = 500  # companies re-aggregated per round
+MAX_AWAIT_MS = 1000  # how long the stream waits for an event before a round is closed
+RELEVANT_FIELDS = ('name', 'category_code', 'number_of_employees', 'offices')
+OFFICE_FIELDS = ('company_id', 'name', 'address', 'city', 'employees', 'category_code', 'location')
+RESYNC_OPERATIONS = ('drop', 'rename', 'dropDatabase', 'invalidate')
+HISTORY_LOST = (280, 286)  # ChangeStreamFatalError, ChangeStreamHistoryLost
+NOT_A_REPLICA_SET = 40573
+
+
+def office_checksum(document):
+    payload = json.dumps([document.get(field) for field in OFFICE_FIELDS], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def office_records(collection, city, min_employees, max_employees, company_ids=None):
+    """
+    The derived office documents of some companies (all of them when company_ids is None):
+    the rows find_offices_by_criteria() returns, in the shape insert_offices_data_create_index()
+    stores, plus 'company_id' and a 'checksum' of the fields.
+
+    Returns:
+    - A dict mapping each checksum to its document (duplicate offices of a company collapse
+      into one, like drop_duplicates()).
+    """
+    stages = mongo.offices_by_criteria_pipeline(city, min_employees, max_employees)
+    stages[-1]['$project']['company_id'] = '$_id'
+    if company_ids is not None:
+        stages.insert(0, {'$match': {'_id': {'$in': list(company_ids)}}})
+
+    records = {}
+    for row in collection.aggregate(stages):
+        # dropna() in find_offices_by_criteria drops rows with any missing field
+        if any(row.get(field) is None for field in ('name', 'latitude', 'longitude', 'address', 'city', 'employees',
+                                                     'category_code')):
+            continue
+        if any(isinstance(row[field], float) and np.isnan(row[field]) for field in ('latitude', 'longitude')):
+            continue
+        document = {field: row[field] for field in ('company_id', 'name', 'address', 'city', 'employees',
+                                                    'category_code')}
+        document['location'] = {'type': 'Point', 'coordinates': [row['longitude'], row['latitude']]}
+        document['checksum'] = office_checksum(document)
+        records[document['checksum']] = document
+    return records
+
+
+def sync_offices(db, offices_collection, records, company_ids=None):
+    """
+    Make the offices of the given companies (all offices when company_ids is None) in
+    offices_collection equal to records, touching only the documents that differ.
+
+    Returns:
+    - A tuple (added, removed) of the inserted and deleted office documents.
+    """
+    collection = db[offices_collection]
+    query = {} if company_ids is None else {'company_id': {'$in': list(company_ids)}}
+    existing = {}
+    stale = []
+    for document in collection.find(query, {'_id': 1, **{field: 1 for field in OFFICE_FIELDS}, 'checksum': 1}):
+        checksum = document.get('checksum') or office_checksum(document)
+        # Documents written by insert_offices_data_create_index() have no company_id
+        if 'company_id' not in document or checksum in existing:
+            stale.append(document)
+        else:
+            existing[checksum] = document
+    removed = stale + [document for checksum, document in existing.items() if checksum not in records]
+    added = [document for checksum, document in records.items() if checksum not in existing]
+
+    operations = [pymongo.DeleteOne({'_id': document['_id']}) for document in removed]
+    operations += [pymongo.InsertOne(dict(document)) for document in added]
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    collection.create_index([("location", "2dsphere")])
+    collection.create_index([("company_id", 1)])
+    metrics.count('watch.offices_added', len(added))
+    metrics.count('watch.offices_removed', len(removed))
+    return added, removed
+
+
+def rescore(db, offices_collection, added, removed, venues_by_type, versions=None):
+    """
+    Bring the distance matrix in line with the changed offices: compute the rows of the added
+    ones and delete the rows of removed offices no other office shares (same name and position).
+
+    Returns:
+    - The scoring.rank_offices() list of the added offices.
+    """
+    offices = [(document['name'], document['location']['coordinates']) for document in added]
+    keys, distances = matrix.update_rows(db, offices_collection, offices, venues_by_type, versions)
+
+    gone = {matrix.office_version(document['name'], document['location']['coordinates']) for document in removed}
+    if gone:
+        for document in db[offices_collection].find({}, {'_id': 0, 'name': 1, 'location.coordinates': 1}):
+            gone.discard(matrix.office_version(document['name'], document['location']['coordinates']))
+        matrix.delete_rows(db, offices_collection, gone)
+
+    scores = scoring.score_distances(distances, list(venues_by_type))
+    return scoring.rank_offices([name for name, _ in offices], [coordinates for _, coordinates in offices], scores)
+
+
+def relevant(change):
+    """
+    False for updates that only touch fields the office documents do not depend on.
+    """
+    if change['operationType'] != 'update':
+        return True
+    description = change.get('updateDescription', {})
+    fields = list(description.get('updatedFields', {})) + list(description.get('removedFields', []))
+    fields += [truncated['field'] for truncated in description.get('truncatedArrays', [])]
+    return not fields or any(field.split('.')[0] in RELEVANT_FIELDS for field in fields)
+
+
+def apply_changes(db, companies, offices_collection, company_ids, city, min_employees, max_employees,
+                  venues_by_type=None, versions=None):
+    """
+    Re-derive the offices of the changed companies and re-score the offices that changed.
+
+    Returns:
+    - A dict with 'companies', 'added', 'removed' and the 'scores' of the added offices.
+    """
+    records = office_records(companies, city, min_employees, max_employees, company_ids)
+    added, removed = sync_offices(db, offices_collection, records, company_ids)
+    scores = rescore(db, offices_collection, added, removed, venues_by_type, versions) \
+        if venues_by_type is not None and (added or removed) else []
+    return {'companies': len(company_ids) if company_ids is not None else None, 'added': len(added),
+            'removed': len(removed), 'scores': scores}
+
+
+def state_key(companies, offices_collection):
+    return f'{companies.name}->{offices_collection}'
+
+
+def watch(city, min_employees, max_employees, offices_collection, database=None, companies_collection='Companies',
+          venues_collection=None, rescore_offices=True, batch_size=BATCH_SIZE, max_rounds=None):
+    """
+    Keep offices_collection in sync with Companies until interrupted.
+
+    On the first start (or when the stream's history was lost, or the settings changed) the
+    collection is reconciled with a full aggregation, diffed document by document instead of
+    dropped. Then every round collects up to batch_size changed companies from the change
+    stream, re-aggregates just those, applies the difference and stores the resume token,
+    so a restarted watcher carries on where it stopped.
+
+    Parameters:
+    - city, min_employees, max_employees: The criteria of find_offices_by_criteria().
+    - offices_collection: The derived collection, e.g. 'san_francisco_offices'.
+    - database: Database name. Defaults to mongo.DATABASE.
+    - companies_collection: The source collection.
+    - venues_collection: Read the venues for re-scoring from this single collection.
+    - rescore_offices: Keep the distance matrix rows of the changed offices up to date.
+    - batch_size: Changed companies applied per round.
+    - max_rounds: Stop after this many rounds with changes (for tests); None runs forever.
+    """
+    db = mongo.get_database(database)
+    companies = db[companies_collection]
+    key = state_key(companies, offices_collection)
+    settings = {'city': city, 'min_employees': min_employees, 'max_employees': max_employees}
+
+    venues_by_type = versions = None
+    if rescore_offices:
+        venues_by_type = mongo.load_venue_arrays(db, list(scoring.WEIGHTS), venues_collection)
+        versions = {venue_type: matrix.category_version(coords) for venue_type, coords in venues_by_type.items()}
+
+    rounds = 0
+    while max_rounds is None or rounds < max_rounds:
+        state = db[STATE_COLLECTION].find_one({'_id': key})
+        options = {}
+        if state and state.get('settings') == settings and state.get('token'):
+            options['resume_after'] = state['token']
+        else:
+            # Changes made while reconciling are replayed from here; applying them twice is harmless
+            options['start_at_operation_time'] = db.command('ping').get('operationTime')
+            with metrics.timer('watch.reconcile'):
+                summary = apply_changes(db, companies, offices_collection, None, city, min_employees, max_employees,
+                                        venues_by_type, versions)
+            print(f"Reconciled {offices_collection}: {summary['added']} offices added, {summary['removed']} removed")
+
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete', *RESYNC_OPERATIONS]}}}]
+        try:
+            with companies.watch(pipeline, max_await_time_ms=MAX_AWAIT_MS, **options) as stream:
+                while max_rounds is None or rounds < max_rounds:
+                    company_ids, events, resync = set(), 0, False
+                    change = stream.try_next()
+                    while change is not None:
+                        events += 1
+                        if change['operationType'] in RESYNC_OPERATIONS:
+                            resync = True
+                            break
+                        if relevant(change):
+                            company_ids.add(change['documentKey']['_id'])
+                        if len(company_ids) >= batch_size:
+                            break
+                        change = stream.try_next()
+                    metrics.count('watch.events', events)
+
+                    if company_ids:
+                        with metrics.timer('watch.apply'):
+                            summary = apply_changes(db, companies, offices_collection, company_ids, city,
+                                                    min_employees, max_employees, venues_by_type, versions)
+                        rounds += 1
+                        if summary['added'] or summary['removed']:
+                            print(f"{summary['companies']} companies changed: {summary['added']} offices added, "
+                                  f"{summary['removed']} removed")
+                            for office in summary['scores']:
+                                print(f"     {office['score']:.2f}  {office['office']}")
+                    if resync:
+                        db[STATE_COLLECTION].delete_one({'_id': key})
+                        break
+                    if events:
+                        db[STATE_COLLECTION].replace_one(
+                            {'_id': key}, {'token': stream.resume_token, 'settings': settings, 'updated': time.time()},
+                            upsert=True)
+        except pymongo.errors.OperationFailure as e:
+            if e.code == NOT_A_REPLICA_SET:
+                print("Change streams need a replica set: start mongod with --replSet rs0 and run rs.initiate() once")
+                return
+            if e.code not in HISTORY_LOST:
+                raise
+            print(f"Change stream history lost, reconciling {offices_collection} again")
+            db[STATE_COLLECTION].delete_one({'_id': key})